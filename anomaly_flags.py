@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+# Anomaly flagging of hourly demand for many BAs at once.
+#
+# Demand is held as an (hours x BAs) matrix with NANs for the hours which
+# are MISSING or EMPTY. Each hour of each BA gets a uint8 bitmask of the
+# checks which flagged it:
+#   NEGATIVE  demand below 0
+#   ZERO      demand of exactly 0
+#   RUN       the same value as the previous RUN_LENGTH-1 hours
+#   SPIKE     further from the median of the previous SPIKE_WINDOW hours
+#             than SPIKE_IQR_MULTIPLE times their interquartile range
+#   FORECAST  further from the day-ahead forecast than FORECAST_DEVIATION
+#             times the forecast
+#
+# All checks only look at earlier hours, so flags can be computed for just
+# the new hours of an incremental update, see flag_anomalies(start=...).
+#
+# If run as is this flags all usable BAs in the csv files in CSV_DIR,
+# prints how long it took and how many hours were flagged, and saves the
+# flags to the region store.
+
+import os
+import time
+import json
+import numpy as np
+
+import region_store
+import ba_mapping
+
+
+
+NEGATIVE = 1
+ZERO = 2
+RUN = 4
+SPIKE = 8
+FORECAST = 16
+FLAG_NAMES = {NEGATIVE : 'NEGATIVE', ZERO : 'ZERO', RUN : 'RUN', SPIKE : 'SPIKE', FORECAST : 'FORECAST'}
+ALL_FLAGS = NEGATIVE | ZERO | RUN | SPIKE | FORECAST
+
+RUN_LENGTH = 3
+SPIKE_WINDOW = 48
+SPIKE_IQR_MULTIPLE = 5.
+# Spikes are only looked for if at least this fraction of the window is reported
+SPIKE_MIN_REPORTED = 0.5
+FORECAST_DEVIATION = 0.5
+
+# Rows of the spike check done at once, this bounds the memory of the
+# windows to SPIKE_CHUNK x BAs x SPIKE_WINDOW values
+SPIKE_CHUNK = 2048
+
+
+
+# Number of earlier hours the checks need to flag an hour
+def lookback():
+    return max(RUN_LENGTH - 1, SPIKE_WINDOW)
+
+
+# Hours which equal the previous RUN_LENGTH-1 hours
+def flag_runs(values):
+    n = len(values)
+    same = np.zeros(values.shape, dtype=bool)
+    same[1:] = values[1:] == values[:-1]
+    rows = np.arange(n)[:, np.newaxis]
+    run_start = np.maximum.accumulate(np.where(same, 0, rows), axis=0)
+    return rows - run_start + 1 >= RUN_LENGTH
+
+
+# Quantiles q of windows of values with NANs sorted to the end,
+# linearly interpolated as in np.nanquantile
+def _window_quantile(ordered, counts, q):
+    pos = (counts - 1) * q
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, np.maximum(counts - 1, 0))
+    lo = np.maximum(lo, 0)
+    lo_value = np.take_along_axis(ordered, lo[..., np.newaxis], axis=-1)[..., 0]
+    hi_value = np.take_along_axis(ordered, hi[..., np.newaxis], axis=-1)[..., 0]
+    return lo_value + (hi_value - lo_value) * (pos - np.floor(pos))
+
+
+# Hours far from the median of the previous SPIKE_WINDOW hours relative to
+# their interquartile range. Only rows from start onwards are checked.
+def flag_spikes(values, start=0):
+    n, n_BAs = values.shape
+    flags = np.zeros(values.shape, dtype=bool)
+    padded = np.vstack([np.full((SPIKE_WINDOW, n_BAs), np.nan), values])
+    for first in range(start, n, SPIKE_CHUNK):
+        last = min(first + SPIKE_CHUNK, n)
+        # windows[i, j] are the SPIKE_WINDOW hours before row first+i of BA j
+        windows = np.lib.stride_tricks.sliding_window_view(
+                padded[first:last + SPIKE_WINDOW - 1], SPIKE_WINDOW, axis=0)
+        ordered = np.sort(windows, axis=-1)
+        counts = SPIKE_WINDOW - np.isnan(windows).sum(axis=-1)
+        median = _window_quantile(ordered, counts, 0.5)
+        iqr = _window_quantile(ordered, counts, 0.75) - _window_quantile(ordered, counts, 0.25)
+        with np.errstate(invalid='ignore'):
+            flags[first:last] = ((counts >= SPIKE_WINDOW * SPIKE_MIN_REPORTED) &
+                    (np.abs(values[first:last] - median) > SPIKE_IQR_MULTIPLE * iqr) & (iqr > 0))
+    return flags
+
+
+# Flag the anomalies of an (hours x BAs) matrix of demand, with NANs for
+# unreported hours, and optionally the matching day-ahead forecast matrix.
+# Only the hours from row start onwards are flagged, the earlier hours are
+# used as history by the RUN and SPIKE checks.
+# Returns an (hours - start) x BAs uint8 matrix of flags.
+def flag_anomalies(demand, forecast=None, start=0, checks=ALL_FLAGS):
+    demand = np.asarray(demand, dtype=np.float64)
+    if demand.ndim == 1:
+        demand = demand[:, np.newaxis]
+    first = max(start - lookback(), 0)
+    values = demand[first:]
+    new = slice(start - first, None)
+
+    flags = np.zeros(values[new].shape, dtype=np.uint8)
+    with np.errstate(invalid='ignore'):
+        if checks & NEGATIVE:
+            flags[values[new] < 0] |= NEGATIVE
+        if checks & ZERO:
+            flags[values[new] == 0] |= ZERO
+        if checks & RUN:
+            flags[flag_runs(values)[new]] |= RUN
+        if checks & SPIKE:
+            flags[flag_spikes(values, start - first)[new]] |= SPIKE
+        if checks & FORECAST and forecast is not None:
+            fcst = np.asarray(forecast, dtype=np.float64).reshape(demand.shape)[start:]
+            flags[np.abs(values[new] - fcst) > FORECAST_DEVIATION * np.abs(fcst)] |= FORECAST
+    return flags
+
+
+# Number of hours of each BA flagged by each check
+def count_flags(flags):
+    return {name : (flags & flag != 0).sum(axis=0) for flag, name in FLAG_NAMES.items()}
+
+
+
+# Save flags as an hours x BAs uint8 matrix in the region store,
+# store/<name>/hours.npy, flags.npy and columns.json, with each BA
+# contiguous on disk
+def write_flags(name, hours, names, flags, base=None):
+    base = region_store.store_base(base)
+    path = os.path.join(base, name)
+    os.makedirs(path, exist_ok=True)
+    region_store._save(os.path.join(path, 'hours.npy'), np.asarray(hours, dtype=np.int64))
+    region_store._save(os.path.join(path, 'flags.npy'), np.asfortranarray(flags, dtype=np.uint8))
+    with open(os.path.join(path, 'columns.json'), 'w') as f:
+        json.dump({'names' : list(names), 'flags' : {v : k for k, v in FLAG_NAMES.items()}}, f, indent=4)
+
+
+def read_flags(name, base=None, mmap=True):
+    base = region_store.store_base(base)
+    path = os.path.join(base, name)
+    with open(os.path.join(path, 'columns.json'), 'r') as f:
+        names = json.load(f)['names']
+    return (region_store._load(os.path.join(path, 'hours.npy'), mmap), names,
+            region_store._load(os.path.join(path, 'flags.npy'), mmap))
+
+
+# Replace the flags from hours[0] onwards with new flags.
+# This is used for incremental updates.
+def append_flags(name, hours, names, flags, base=None):
+    base = region_store.store_base(base)
+    if not os.path.exists(os.path.join(base, name, 'columns.json')) or len(hours) == 0:
+        return write_flags(name, hours, names, flags, base)
+    old_hours, old_names, old_flags = read_flags(name, base, mmap=False)
+    if old_names != list(names):
+        return write_flags(name, hours, names, flags, base)
+    keep = old_hours < hours[0]
+    write_flags(name, np.concatenate([old_hours[keep], hours]), names,
+            np.concatenate([old_flags[keep], flags]), base)
+
+
+
+# Read the demand and forecast of regions from their csv files into
+# (hours x regions) matrices, aligned on the hours of the first region
+def load_demand_matrix(regions, base='data/'):
+    hours = None
+    demand = forecast = None
+    for j, region in enumerate(regions):
+        series = region_store.Series.from_csv(base+region+'.csv')
+        if hours is None:
+            hours = series.hours
+            demand = np.full((len(hours), len(regions)), np.nan, order='F')
+            forecast = np.full((len(hours), len(regions)), np.nan, order='F')
+        rows = np.searchsorted(hours, series.hours)
+        ok = (rows < len(hours)) & (hours[np.minimum(rows, len(hours)-1)] == series.hours)
+        for matrix, col in [(demand, 'demand (MW)'), (forecast, 'forecast demand (MW)')]:
+            if col in series.columns:
+                matrix[rows[ok], j] = series.masked(col)[ok]
+    return hours, demand, forecast
+
+
+
+if '__main__' in __name__:
+
+    CSV_DIR = 'data/'
+    BAs = ba_mapping.usable_BAs()
+
+    t0 = time.time()
+    hours, demand, forecast = load_demand_matrix(BAs, CSV_DIR)
+    t1 = time.time()
+    flags = flag_anomalies(demand, forecast)
+    t2 = time.time()
+    print(f"Loaded {len(BAs)} BAs x {len(hours)} hours in {round(t1-t0, 2)}s, flagged in {round(t2-t1, 2)}s")
+
+    counts = count_flags(flags)
+    for j, BA in enumerate(BAs):
+        print("{}: {}".format(BA, ', '.join(f"{name} {counts[name][j]}" for name in FLAG_NAMES.values())))
+
+    write_flags('anomaly_flags', hours, BAs, flags)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# Mapping between EIA balancing authorities (BAs), EIA regions and
+# the interconnects.
+#
+# The BA to region mapping comes from EIA's Balancing Authority Acronym
+# table in data/balancing_authority_acronyms.csv. It is read once and
+# kept in memory, and only read again if the file changes. Lookups in
+# both directions are dictionary lookups.
+
+
+
+import os
+import csv
+import time
+import threading
+
+
+
+ACRONYM_FILE = 'data/balancing_authority_acronyms.csv'
+
+# Seconds between checks of whether the acronym table changed
+CHECK_INTERVAL = 1.0
+
+REGIONS = {
+        'CENT' : 'Central',
+        'MIDW' : 'Midwest',
+        'TEN' : 'Tennessee',
+        'SE' : 'Southeast',
+        'FLA' : 'Florida',
+        'CAR' : 'Carolinas',
+        'MIDA' : 'Mid-Atlantic',
+        'NY' : 'New York',
+        'NE' : 'New England',
+        'TEX' : 'Texas',
+        'CAL' : 'California',
+        'NW' : 'Northwest',
+        'SW' : 'Southwest'
+}
+
+INTERCONNECTS = {
+        'EASTERN' : ['CENT', 'MIDW', 'TEN', 'SE', 'FLA', 'CAR', 'MIDA', 'NY', 'NE'],
+        'TEXAS' : ['TEX'],
+        'WESTERN' : ['CAL', 'NW', 'SW'],
+}
+
+# BAs with demand data which are used in the analysis. The US BAs which are
+# missing are responsible for generation only and do not report demand
+# data to EIA, see the users guide linked from the README, or,
+# for OVEC and SEC, do not perform well in the imputation and comparisons.
+USABLE_BAS = [
+            'AEC', 'AECI', 'CPLE', 'CPLW',
+            'DUK', 'FMPP', 'FPC',
+            'FPL', 'GVL', 'HST', 'ISNE',
+            'JEA', 'LGEE', 'MISO', 'NSB',
+            'NYIS', 'PJM', 'SC',
+            'SCEG', 'SOCO',
+            'SPA', 'SWPP', 'TAL', 'TEC',
+            'TVA',
+            'ERCO',
+            'AVA', 'AZPS', 'BANC', 'BPAT',
+            'CHPD', 'CISO', 'DOPD',
+            'EPE', 'GCPD',
+            'IID',
+            'IPCO', 'LDWP', 'NEVP', 'NWMT',
+            'PACE', 'PACW', 'PGE', 'PNM',
+            'PSCO', 'PSEI', 'SCL', 'SRP',
+            'TEPC', 'TIDC', 'TPWR', 'WACM',
+            'WALC', 'WAUW',
+            # 'OVEC', 'SEC',
+            ]
+
+USABLE_REGIONS = list(REGIONS.keys())
+
+_usable = set(USABLE_BAS) | set(USABLE_REGIONS)
+_region_of_name = {v : k for k, v in REGIONS.items()}
+_region_interconnect = {region : ic for ic, regions in INTERCONNECTS.items() for region in regions}
+
+_cache = {'path' : None, 'key' : None, 'checked' : 0., 'mapping' : None}
+_lock = threading.Lock()
+
+
+
+# Read the acronym table into the BA to region mapping in both directions.
+# Canadian and Mexican BAs are skipped.
+def _read_mapping(file_path):
+
+    region_BAs = {region : [] for region in REGIONS}
+    BA_region = {}
+    # utf-8-sig drops the byte order mark of the file
+    with open(file_path, 'r', encoding='utf-8-sig', newline='') as f:
+        reader = csv.reader(f)
+        next(reader) # skip first row as it is source info
+        header = next(reader)
+        code_col, region_col = header.index('Code'), header.index('Region')
+        for row in reader:
+            if len(row) == 0 or row[region_col] in ['Canada', 'Mexico']:
+                continue
+            region = _region_of_name[row[region_col]]
+            region_BAs[region].append(row[code_col])
+            BA_region[row[code_col]] = region
+
+    return {'region_BAs' : region_BAs, 'BA_region' : BA_region}
+
+
+# Return the mapping, reading the acronym table only if it was
+# not read before or it changed since
+def get_mapping(file_path=ACRONYM_FILE):
+    path = os.path.abspath(file_path)
+    with _lock:
+        now = time.monotonic()
+        if _cache['path'] == path and now - _cache['checked'] < CHECK_INTERVAL:
+            return _cache['mapping']
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        if _cache['path'] != path or _cache['key'] != key:
+            _cache['mapping'] = _read_mapping(path)
+            _cache['path'] = path
+            _cache['key'] = key
+        _cache['checked'] = now
+        return _cache['mapping']
+
+
+# EIA region of a BA
+def BA_to_region(BA):
+    return get_mapping()['BA_region'][BA]
+
+
+# All US48 BAs of a region, including those which are not usable
+def region_to_BAs(region):
+    return list(get_mapping()['region_BAs'][region])
+
+
+def region_to_interconnect(region):
+    return _region_interconnect[region]
+
+
+def BA_to_interconnect(BA):
+    return _region_interconnect[BA_to_region(BA)]
+
+
+# True if name is in USABLE_BAS or USABLE_REGIONS
+def is_usable(name):
+    return name in _usable
+
+
+def usable_BAs():
+    return list(USABLE_BAS)
+
+
+def usable_regions():
+    return list(USABLE_REGIONS)
+
+
+# Map of each region to its BAs
+def BAs_per_region():
+    return {region : list(BAs) for region, BAs in get_mapping()['region_BAs'].items()}
+
+
+# Map of each interconnect to its BAs, optionally only the usable ones
+def BAs_per_interconnect(usable_only=True):
+    region_BAs = get_mapping()['region_BAs']
+    return {ic : [BA for region in regions for BA in region_BAs[region] if not usable_only or BA in _usable]
+            for ic, regions in INTERCONNECTS.items()}
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Run many jobs in one long-lived process, so repeated small jobs, such as
+# single region combines and mapping lookups, do not each pay for starting
+# python and importing numpy and pandas.
+#
+# Jobs are read as one json object per line from the given files, or from
+# stdin if there are none:
+#   {"job": "combine_regions", "args": [["CISO", "BANC"], "CAL"]}
+#   {"job": "prep_for_MEM", "args": ["data5_out2/CAL.csv"]}
+#   {"job": "BA_to_region", "args": ["CISO"], "id": 7}
+#   {"job": "pipeline", "kwargs": {"config": "pipeline.json", "stages": ["combine"]}}
+# and the result of each job is written to stdout as one json line as soon
+# as it finishes:
+#   {"id": 7, "job": "BA_to_region", "ok": true, "result": "CAL", "seconds": 0.0001}
+# Whatever the jobs print goes to stderr, so stdout only has the results.
+# A failed job reports its error and the next job is run.
+#
+# Module settings, such as the directories the scripts read and write, can
+# be changed between jobs with
+#   {"job": "set", "kwargs": {"combine_regional_files.DATA_DIR": "data/"}}
+#
+# A scheduler can keep one process running and send it jobs through a
+# pipe, or a file of jobs can be run at once:
+#   ./batch.py jobs.jsonl
+#   ./batch.py --preload < jobs.jsonl
+# --preload imports numpy, pandas and the scripts before the first job.
+
+import sys
+import json
+import time
+import argparse
+import importlib
+import contextlib
+
+import metrics
+
+
+
+# Jobs which can be run, as module:function. The modules are only
+# imported when the first of their jobs runs.
+JOBS = {
+    'combine_regions' : 'combine_regional_files:combine_regions',
+    'combine_many' : 'combine_regional_files:combine_many',
+    'prep_for_MEM' : 'combine_regional_files:prep_for_MEM',
+    'add_MICE_imputations_to_many_files' : 'combine_regional_files:add_MICE_imputations_to_many_files',
+    'mean_impute_file' : 'simple_mean_impute:mean_impute_file',
+    'mean_impute_files' : 'simple_mean_impute:mean_impute_files',
+    'BA_to_region' : 'ba_mapping:BA_to_region',
+    'region_to_BAs' : 'ba_mapping:region_to_BAs',
+    'BAs_per_region' : 'ba_mapping:BAs_per_region',
+    'BAs_per_interconnect' : 'ba_mapping:BAs_per_interconnect',
+    'usable_BAs' : 'ba_mapping:usable_BAs',
+    'usable_regions' : 'ba_mapping:usable_regions',
+    'forecast_errors' : 'forecast_errors:record_files',
+    'pipeline' : 'batch:run_pipeline',
+    'set' : 'batch:set_settings',
+    'metrics' : 'metrics:snapshot',
+}
+
+PRELOAD = ['numpy', 'pandas', 'combine_regional_files', 'simple_mean_impute', 'pipeline']
+
+
+
+def resolve(name):
+    if name not in JOBS:
+        raise ValueError("Unknown job '{}', choose from {}".format(name, ', '.join(JOBS)))
+    module_name, function_name = JOBS[name].split(':')
+    # This file is __main__ when run as a script
+    module = sys.modules[__name__] if module_name == 'batch' else importlib.import_module(module_name)
+    return getattr(module, function_name)
+
+
+# Set module level settings given as module.NAME : value
+def set_settings(**settings):
+    for name, value in settings.items():
+        module_name, attribute = name.rsplit('.', 1)
+        module = importlib.import_module(module_name)
+        if not hasattr(module, attribute):
+            raise AttributeError("{} has no setting {}".format(module_name, attribute))
+        setattr(module, attribute, value)
+
+
+# Run stages of pipeline.py with a config file, see pipeline.run_pipeline.
+# Returns the jobs which ran in each stage.
+def run_pipeline(config=None, stages=None, deps=False, force=False, dry_run=False):
+    import pipeline
+    return pipeline.run_pipeline(pipeline.load_config(config), stages or pipeline.STAGES, deps, force, dry_run)
+
+
+
+# numpy arrays and scalars and sets in the results are written as
+# json lists and numbers, anything else as text
+def to_json(value):
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if isinstance(value, set):
+        return sorted(value)
+    return str(value)
+
+
+def run_job(job):
+    name = job.get('job')
+    result = {'id' : job.get('id'), 'job' : name}
+    t0 = time.perf_counter()
+    try:
+        function = resolve(name)
+        with contextlib.redirect_stdout(sys.stderr):
+            result['result'] = function(*job.get('args', []), **job.get('kwargs', {}))
+        result['ok'] = True
+    except Exception as e:
+        result['ok'] = False
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds'] = round(time.perf_counter() - t0, 6)
+    metrics.observe('batch_job', result['seconds'], job=name)
+    return result
+
+
+# Run the jobs of each line and write their results to out as they finish.
+# Blank lines and lines starting with # are skipped.
+def run_batch(lines, out=sys.stdout):
+    for line in lines:
+        if line.strip() == '' or line.lstrip().startswith('#'):
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError("a job must be a json object")
+        except ValueError as e:
+            result = {'id' : None, 'job' : None, 'ok' : False, 'error' : 'Bad job line: {}'.format(e)}
+        else:
+            result = run_job(job)
+        out.write(json.dumps(result, default=to_json)+'\n')
+        out.flush()
+
+
+
+if '__main__' in __name__:
+
+    parser = argparse.ArgumentParser(description="Run many jobs, one json object per line, in one process")
+    parser.add_argument('files', nargs='*', help="files of jobs, stdin if none are given")
+    parser.add_argument('--preload', action='store_true', help="import numpy, pandas and the scripts before the first job")
+    args = parser.parse_args()
+
+    if args.preload:
+        for module_name in PRELOAD:
+            importlib.import_module(module_name)
+
+    if len(args.files) == 0:
+        # readline returns each job as soon as it arrives through a pipe
+        run_batch(iter(sys.stdin.readline, ''))
+    for file_path in args.files:
+        with open(file_path, 'r') as f:
+            run_batch(f)
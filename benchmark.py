@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the fetch -> combine -> impute -> prep_for_MEM steps on
+# synthetic data.
+#
+# Synthetic EIA series and BA csv files are generated for a number of BAs
+# and years of hourly data, with configurable rates of MISSING, EMPTY and
+# negative values. EIA is replaced by a local server answering from the
+# synthetic series, so the benchmarks run offline.
+#
+# Each step is timed at increasing scales and its throughput, in rows per
+# second, and its peak memory, as traced by tracemalloc in a separate run,
+# are reported. The results of each run are appended as one json line to
+# the output file along with the git commit, and compared with the previous
+# run at the same scales, so regressions can be tracked across changes.
+#
+# Usage:
+#   ./benchmark.py [--scales 5x1,20x2,54x4] [--missing 0.02] [--empty 0.01]
+#                  [--negative 0.005] [--repeat 3] [--output benchmark_results.jsonl]
+# A scale of 20x2 is 20 BAs with 2 years of hourly data.
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import datetime
+import tempfile
+import threading
+import contextlib
+import subprocess
+import tracemalloc
+import http.server
+import urllib.parse
+import numpy as np
+import pandas as pd
+
+import eia_cache
+import region_store
+import ba_mapping
+import simple_mean_impute
+import get_regional_demands as grd
+import combine_regional_files as crf
+
+
+
+RESULTS_FILE = 'benchmark_results.jsonl'
+START = datetime.datetime(2015, 7, 1)
+
+
+
+# Hourly demand of a BA with a daily cycle. Returns the hours, the values
+# with NaN for hours reported as EMPTY and which hours are reported at all.
+def synthetic_series(n_hours, rates, rng):
+    hours = grd.generate_full_time_series(START, START + datetime.timedelta(hours=n_hours)).astype(np.int64)
+    scale = rng.uniform(500, 50000)
+    values = np.round(scale * (1 + 0.3*np.sin(2*np.pi*(hours % 24)/24) + rng.normal(0, 0.05, n_hours)))
+    draw = rng.random(n_hours)
+    present = draw >= rates['missing']
+    values[(draw >= rates['missing']) & (draw < rates['missing'] + rates['empty'])] = np.nan
+    negative = rng.random(n_hours) < rates['negative']
+    values[negative] = -values[negative]
+    return hours, values, present
+
+
+# EIA series API response of a synthetic series, newest hour first as EIA
+# returns them, optionally limited to start and end times
+def series_json(series_id, hours, values, present, start=None, end=None):
+    times = region_store.format_eia_times(hours[present]).tolist()
+    points = [[t, None if v != v else v] for t, v in zip(times, values[present].tolist())
+            if (start == None or t >= start) and (end == None or t <= end)]
+    points.reverse()
+    return {'series' : [{'series_id' : series_id, 'data' : points}]}
+
+
+# Synthetic demand and forecast series of each BA
+def synthetic_data(BAs, n_hours, rates, seed=1):
+    rng = np.random.default_rng(seed)
+    series = {}
+    for BA in BAs:
+        series['EBA.{}-ALL.D.H'.format(BA)] = synthetic_series(n_hours, rates, rng)
+        series['EBA.{}-ALL.DF.H'.format(BA)] = synthetic_series(n_hours, rates, rng)
+    return series
+
+
+# Write the series as MEM formatted csv files, as get_regional_demands.py does
+def write_BA_files(series, BAs, data_dir):
+    for BA in BAs:
+        columns = {}
+        status = {}
+        for name, series_id in [('demand (MW)', 'EBA.{}-ALL.D.H'), ('forecast demand (MW)', 'EBA.{}-ALL.DF.H')]:
+            hours, values, present = series[series_id.format(BA)]
+            columns[name] = values
+            status[name] = np.where(present, np.where(np.isnan(values), region_store.EMPTY, region_store.OK), region_store.MISSING).astype(np.uint8)
+        region_store.write_csv(data_dir+BA+'.csv', hours, columns, status)
+
+
+
+# Local stand-in for the EIA API serving the synthetic series
+def start_fake_api(series, BAs):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            if url.path.startswith('/category'):
+                if query['category_id'] == '2122628':
+                    body = {'category' : {'childcategories' : [{'category_id' : i, 'name' : BA} for i, BA in enumerate(BAs)]}}
+                else:
+                    BA = BAs[int(query['category_id'])]
+                    body = {'category' : {'childseries' : [{'series_id' : 'EBA.{}-ALL.D.H'.format(BA)}]}}
+            else:
+                body = series_json(query['series_id'], *series[query['series_id']], query.get('start'), query.get('end'))
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+
+# Each benchmark gets the prepared context and returns the number of rows
+# it processed. Anything which is not part of the step is done in setup.
+
+def bench_generate_full_time_series(ctx):
+    return len(grd.generate_full_time_series(START, START + datetime.timedelta(hours=ctx['n_hours'])))
+
+
+def bench_fetch(ctx):
+    grd.DATA_DIR = ctx['dir']+'fetch/'
+    regions = grd.get_regions_data()['category']['childcategories']
+    failed = grd.fetch_all_regions(regions, ctx['grid'], 8)
+    if len(failed) > 0:
+        raise RuntimeError("Failed regions: {}".format(failed))
+    return len(ctx['BAs']) * ctx['n_hours']
+
+
+def setup_save_to_MEM_format(ctx):
+    ctx['responses'] = {BA : (series_json('EBA.{}-ALL.D.H'.format(BA), *ctx['series']['EBA.{}-ALL.D.H'.format(BA)]),
+            series_json('EBA.{}-ALL.DF.H'.format(BA), *ctx['series']['EBA.{}-ALL.DF.H'.format(BA)]))
+            for BA in ctx['BAs']}
+
+
+def bench_save_to_MEM_format(ctx):
+    grd.DATA_DIR = ctx['dir']+'save/'
+    for BA in ctx['BAs']:
+        grd.save_to_MEM_format('EBA.{}-ALL.D.H'.format(BA), *ctx['responses'][BA], ctx['grid'])
+    return len(ctx['BAs']) * ctx['n_hours']
+
+
+def bench_combine_regions(ctx):
+    crf.DATA_DIR = ctx['dir']
+    crf.combine_regions(ctx['BAs'], 'BENCH')
+    return len(ctx['BAs']) * ctx['n_hours']
+
+
+# Pairs of values of the first BA and each other BA as the legacy per row
+# combine_regions loop added them, with MISSING and EMPTY of the first BA
+# set to 0 by zero_missing_and_empty. add_values raises if the first value
+# is negative and the second MISSING or EMPTY, those pairs are left out.
+def setup_add_values(ctx):
+    crf.DATA_DIR = ctx['dir']
+    files = [crf.return_csv_file(BA) for BA in ctx['BAs']]
+    crf.zero_missing_and_empty(files[0])
+    ctx['pairs'] = []
+    for rows in files[1:]:
+        for first, row in zip(files[0][1:], rows[1:]):
+            for col in [5, 6]:
+                if not (float(first[col]) < 0 and row[col] in ['MISSING', 'EMPTY']):
+                    ctx['pairs'].append((first[col], row[col]))
+
+
+def bench_add_values(ctx):
+    add_values = crf.add_values
+    for val1, val2 in ctx['pairs']:
+        add_values(val1, val2)
+    return len(ctx['pairs'])
+
+
+def setup_impute_with_mean(ctx):
+    ctx['frames'] = {BA : simple_mean_impute.get_file(ctx['dir']+BA+'.csv') for BA in ctx['BAs']}
+
+
+def bench_impute_with_mean(ctx):
+    for BA, df in ctx['frames'].items():
+        simple_mean_impute.impute_with_mean(df.copy(), BA)
+    return len(ctx['BAs']) * ctx['n_hours']
+
+
+def setup_prep_for_MEM(ctx):
+    crf.DATA_DIR = ctx['dir']
+    crf.combine_regions(ctx['BAs'], 'BENCH')
+
+
+def bench_prep_for_MEM(ctx):
+    crf.prep_for_MEM(ctx['dir']+'BENCH.csv')
+    return ctx['n_hours']
+
+
+# The last week of demand of every BA with region_store.load. The row
+# index of each file is built in setup, as it is once per file change.
+def setup_load_week(ctx):
+    for BA in ctx['BAs']:
+        region_store.csv_index(ctx['dir']+BA+'.csv')
+
+
+def bench_load_week(ctx):
+    end = START + datetime.timedelta(hours=ctx['n_hours'])
+    series = region_store.load(ctx['BAs'], end - datetime.timedelta(days=7), end, ['demand (MW)'], ctx['dir'], use_store=False)
+    return sum([len(s) for s in series.values()])
+
+
+BENCHMARKS = [
+    ('generate_full_time_series', None, bench_generate_full_time_series),
+    ('fetch', None, bench_fetch),
+    ('save_to_MEM_format', setup_save_to_MEM_format, bench_save_to_MEM_format),
+    ('combine_regions', None, bench_combine_regions),
+    ('add_values', setup_add_values, bench_add_values),
+    ('impute_with_mean', setup_impute_with_mean, bench_impute_with_mean),
+    ('prep_for_MEM', setup_prep_for_MEM, bench_prep_for_MEM),
+    ('load_week', setup_load_week, bench_load_week),
+]
+
+
+
+# Best time of repeat runs of a benchmark and the peak memory of one
+# more run traced by tracemalloc, which slows the run itself down
+def measure(bench, ctx, repeat):
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(repeat):
+            t0 = time.perf_counter()
+            rows = bench(ctx)
+            times.append(time.perf_counter() - t0)
+        tracemalloc.start()
+        bench(ctx)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return rows, min(times), peak
+
+
+def run_scale(n_BAs, years, rates, repeat, names=None):
+
+    BAs = ba_mapping.usable_BAs()[:n_BAs]
+    n_hours = int(years * 8760)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ctx = {'dir' : tmp_dir+'/', 'BAs' : BAs, 'n_hours' : n_hours,
+                'grid' : grd.generate_full_time_series(START, START + datetime.timedelta(hours=n_hours))}
+        ctx['series'] = synthetic_data(BAs, n_hours, rates)
+        write_BA_files(ctx['series'], BAs, ctx['dir'])
+        for sub_dir in ['fetch', 'save']:
+            os.makedirs(ctx['dir']+sub_dir, exist_ok=True)
+
+        server = start_fake_api(ctx['series'], BAs)
+        old = (grd.EIA_API_URL, eia_cache.ENABLED, os.environ.get('EIA_API_KEY'), grd.DATA_DIR, crf.DATA_DIR)
+        grd.EIA_API_URL = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        eia_cache.ENABLED = False
+        os.environ['EIA_API_KEY'] = 'BENCHMARK'
+        try:
+            for name, setup, bench in BENCHMARKS:
+                if names != None and name not in names:
+                    continue
+                if setup != None:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        setup(ctx)
+                rows, seconds, peak = measure(bench, ctx, repeat)
+                results.append({'benchmark' : name, 'BAs' : len(BAs), 'years' : years, 'rows' : rows,
+                        'seconds' : round(seconds, 6), 'rows_per_s' : round(rows / seconds, 1) if seconds > 0 else None,
+                        'peak_MB' : round(peak / 1024**2, 2)})
+                print("{:<28} {:>3} BAs x {:<4} years {:>12,} rows {:>10.4f} s {:>14,.0f} rows/s {:>9.2f} MB".format(
+                    name, len(BAs), years, rows, seconds, results[-1]['rows_per_s'] or 0, results[-1]['peak_MB']))
+        finally:
+            server.shutdown()
+            grd.EIA_API_URL, eia_cache.ENABLED, api_key, grd.DATA_DIR, crf.DATA_DIR = old
+            if api_key == None:
+                del os.environ['EIA_API_KEY']
+            else:
+                os.environ['EIA_API_KEY'] = api_key
+    return results
+
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def load_last_run(file_path):
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, 'r') as f:
+        lines = [line for line in f if line.strip()]
+    return json.loads(lines[-1]) if len(lines) > 0 else None
+
+
+# Print the change in time of each result against the previous run
+def compare(results, previous):
+    before = {(r['benchmark'], r['BAs'], r['years']) : r for r in previous['results']}
+    print("\nCompared with the run of {} at commit {}:".format(previous['time'], previous['commit']))
+    for r in results:
+        old = before.get((r['benchmark'], r['BAs'], r['years']))
+        if old == None or old['seconds'] == 0:
+            continue
+        ratio = r['seconds'] / old['seconds']
+        print("{:<28} {:>3} BAs x {:<4} years  {:>6.2f}x the time{}".format(
+            r['benchmark'], r['BAs'], r['years'], ratio, '  SLOWER' if ratio > 1.2 else ''))
+
+
+def parse_scales(text):
+    scales = []
+    for scale in text.split(','):
+        n_BAs, years = scale.split('x')
+        scales.append((int(n_BAs), float(years)))
+    return scales
+
+
+
+if '__main__' in __name__:
+
+    parser = argparse.ArgumentParser(description="Benchmark the EIA demand data steps on synthetic data")
+    parser.add_argument('--scales', default='5x1,20x2,54x4', help="comma separated BAs x years, e.g. 5x1,54x4")
+    parser.add_argument('--missing', type=float, default=0.02, help="fraction of hours not reported")
+    parser.add_argument('--empty', type=float, default=0.01, help="fraction of hours reported as None")
+    parser.add_argument('--negative', type=float, default=0.005, help="fraction of negative values")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each benchmark, the best is kept")
+    parser.add_argument('--only', help="comma separated benchmarks to run: {}".format(', '.join([b[0] for b in BENCHMARKS])))
+    parser.add_argument('--output', default=RESULTS_FILE, help="json lines file the results are appended to")
+    args = parser.parse_args()
+
+    rates = {'missing' : args.missing, 'empty' : args.empty, 'negative' : args.negative}
+    names = args.only.split(',') if args.only else None
+    results = []
+    for n_BAs, years in parse_scales(args.scales):
+        results += run_scale(n_BAs, years, rates, args.repeat, names)
+
+    run = {
+        'time' : datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit' : git_commit(),
+        'python' : sys.version.split()[0],
+        'numpy' : np.__version__,
+        'pandas' : pd.__version__,
+        'rates' : rates,
+        'repeat' : args.repeat,
+        'results' : results,
+    }
+    previous = load_last_run(args.output)
+    if previous != None:
+        compare(results, previous)
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(run)+'\n')
+    print("\nResults appended to {}".format(args.output))
@@ -12,93 +12,745 @@
 # For MISSING, EMPTY, and negative values, replace with zero
 # BEFORE aggregating.
 
+import os
 import json
 import csv
-import pandas as pd
+import tempfile
+import threading
+import concurrent.futures
+import numpy as np
+
+import ba_mapping
+import region_store
+import forecast_errors
+import metrics
+
+# pandas takes longer to import than the rest of the script together, so
+# it is imported by the functions which read csv files with it and the
+# mapping and hierarchy helpers start quickly
+
+
+
+# Directory of the BA and region files which are combined and where the new
+# regions are written, and of the BA files the MICE imputations are added to
+DATA_DIR = 'data5_out2/'
+MICE_INPUT_DIR = 'data5/'
+
+# Formats of the files for MEM, see export_for_MEM: 'csv' for the _for_MEM.csv
+# file and 'npz' for a compressed numpy file with the same columns
+MEM_FORMATS = ['csv']
+
+# Text of the value columns which is read as missing: MISSING and EMPTY
+# from EIA, and NA and empty values as written by pandas, which is how
+# merge_MICE_imputations writes the hours without a MICE imputation
+MISSING_TEXT = ['MISSING', 'EMPTY', 'NA', '']
+
+# Severity of each status when regions are summed by aggregate_series,
+# an hour of the sum gets the most severe status of its regions
+AGGREGATE_SEVERITY = [region_store.OK, region_store.IMPUTED, region_store.NEGATIVE, region_store.EMPTY, region_store.MISSING]
+
+# Also write each new region to the region store, with the status of each
+# hour of each value column, see aggregate_series
+STORE = False
 
 
 
 def return_csv_file(region):
-    with open("data5_out2/{}.csv".format(region), 'r') as f:
+    with open("{}{}.csv".format(DATA_DIR, region), 'r') as f:
         info = list(csv.reader(f, delimiter=","))
     return info
 
 
+# Faster alternative to return_csv_file for the numeric work in combine_regions.
+# The time and calendar columns are kept as text and the value columns are
+# read as floats with NaN for MISSING_TEXT. EMPTY is kept as text, so it
+# can be told apart from MISSING, see load_value_matrix. 'round_trip' parses
+# floats exactly as float() does. usecols can limit which columns are parsed.
+def return_csv_frame(region, usecols=None):
+    import pandas as pd
+    return pd.read_csv("{}{}.csv".format(DATA_DIR, region), usecols=usecols,
+            dtype={'time' : str, 'year' : str, 'month' : str, 'day' : str, 'hour' : str},
+            na_values=[text for text in MISSING_TEXT if text != 'EMPTY'], keep_default_na=False,
+            float_precision='round_trip')
+
+
 def add_MICE_imputations_to_files(mice_file_path, region):
+    import pandas as pd
     print("Adding MICE imputations to {}".format(region))
     df_mice = pd.read_csv(mice_file_path)
-    df = pd.read_csv("data5/{}.csv".format(region))
+    df = pd.read_csv("{}{}.csv".format(MICE_INPUT_DIR, region))
     df['cleaned demand (MW)'] = df_mice[region]
-    df.to_csv("data5_out2/{}.csv".format(region), index=False, na_rep='NA')
+    df.to_csv("{}{}.csv".format(DATA_DIR, region), index=False, na_rep='NA')
+
+
+# Hours since the epoch of each row of a file with an EIA 'time' column or a
+# 'date_time' column, with -1 for rows whose time can not be read.
+# Returns None if there is no time column.
+def return_row_hours(df):
+    hours = np.full(len(df.index), -1, dtype=np.int64)
+    if 'time' in df.columns:
+        parsed, valid = region_store.parse_eia_times(df['time'].astype(str).to_numpy())
+        hours[valid] = parsed
+    elif 'date_time' in df.columns:
+        import pandas as pd
+        times = pd.to_datetime(df['date_time'], errors='coerce')
+        valid = times.notna().to_numpy()
+        hours[valid] = times[valid].to_numpy().astype('datetime64[h]').astype(np.int64)
+    else:
+        return None
+    return hours
+
+
+# Add the MICE imputations of one BA to its file from MICE_INPUT_DIR, or
+# input_dir, and write it to DATA_DIR, or output_dir. mice are the
+# imputations in the order of sorted_hours, or in row order if sorted_hours
+# is None. Either can be the path of a .npy file, which is memory mapped, so
+# worker processes share them without copying.
+# Returns the number of BA rows without an imputation.
+def merge_MICE_imputations(region, mice, sorted_hours=None, input_dir=None, output_dir=None):
+    import pandas as pd
+    if isinstance(mice, str):
+        mice = np.load(mice, mmap_mode='r')
+    if isinstance(sorted_hours, str):
+        sorted_hours = np.load(sorted_hours, mmap_mode='r')
+
+    df = pd.read_csv("{}{}.csv".format(MICE_INPUT_DIR if input_dir == None else input_dir, region))
+    if sorted_hours is None:
+        df['cleaned demand (MW)'] = pd.Series(mice)
+        unmatched = max(len(df.index) - len(mice), 0)
+    else:
+        hours = return_row_hours(df)
+        pos = np.minimum(np.searchsorted(sorted_hours, hours), len(sorted_hours)-1)
+        matched = (hours >= 0) & (sorted_hours[pos] == hours) if len(sorted_hours) > 0 else np.zeros(len(hours), dtype=bool)
+        if matched.all():
+            # Keep the dtype of the master column, as positional assignment does
+            df['cleaned demand (MW)'] = mice[pos]
+        else:
+            values = np.full(len(hours), np.nan)
+            values[matched] = mice[pos[matched]]
+            df['cleaned demand (MW)'] = values
+        unmatched = int((~matched).sum())
+    df.to_csv("{}{}.csv".format(DATA_DIR if output_dir == None else output_dir, region), index=False, na_rep='NA')
+    return unmatched
+
+
+# Same as add_MICE_imputations_to_files for many BAs, but the master file is
+# read once, only its time and BA columns are parsed and the BA files are
+# written by a pool of max_workers threads.
+# With processes=True the pool is of processes instead. The master columns
+# are then saved as .npy files in a temporary directory which the
+# processes memory map, so they are not pickled for each BA.
+# If the master file has a time column the imputations are matched to the
+# BA rows by their hour, otherwise by their position as before. Hours of a BA
+# without an imputation are reported and left as NA, which the combine
+# reads as missing, see MISSING_TEXT.
+# Returns the number of BA rows without an imputation for each region.
+def add_MICE_imputations_to_many_files(mice_file_path, regions, max_workers=4, processes=False):
+    import pandas as pd
+    print("Adding MICE imputations to {} BAs".format(len(regions)))
+    header = list(pd.read_csv(mice_file_path, nrows=0).columns)
+    time_cols = [col for col in ['time', 'date_time'] if col in header][:1]
+    not_found = [region for region in regions if region not in header]
+    if len(not_found) > 0:
+        print("No MICE imputations for {} in {}".format(not_found, mice_file_path))
+    regions = [region for region in regions if region in header]
+
+    df_mice = pd.read_csv(mice_file_path, usecols=time_cols+regions)
+    mice_hours = return_row_hours(df_mice)
+    order, sorted_hours = None, None
+    if mice_hours is not None:
+        order = np.argsort(mice_hours, kind='stable')
+        sorted_hours = mice_hours[order]
+        if (np.diff(sorted_hours) == 0).any():
+            print("Duplicate hours in {}, the first of each is used".format(mice_file_path))
+    else:
+        print("No time column in {}, matching rows by position".format(mice_file_path))
+
+    def column(region):
+        mice = df_mice[region].to_numpy()
+        return mice if order is None else mice[order]
+
+    if processes and max_workers > 1 and len(regions) > 1:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            hours_path = None
+            if sorted_hours is not None:
+                hours_path = os.path.join(tmp_dir, 'hours.npy')
+                np.save(hours_path, sorted_hours)
+            paths = []
+            for j, region in enumerate(regions):
+                paths.append(os.path.join(tmp_dir, '{}.npy'.format(j)))
+                np.save(paths[-1], column(region))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+                n = len(regions)
+                unmatched = {}
+                for region, (result, worker_metrics) in zip(regions, executor.map(metrics.collect, [merge_MICE_imputations]*n,
+                        regions, paths, [hours_path]*n, [MICE_INPUT_DIR]*n, [DATA_DIR]*n)):
+                    unmatched[region] = result
+                    metrics.merge(worker_metrics)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            unmatched = dict(zip(regions, executor.map(lambda region: merge_MICE_imputations(region, column(region), sorted_hours), regions)))
+    for region, n in unmatched.items():
+        if n > 0:
+            print("{}: {} hours without a MICE imputation".format(region, n))
+    return unmatched
+
+
+
+# Columns of the csv files which are summed when combining regions
+def value_columns(grab_MICE=False):
+    return [5, 6, 7] if grab_MICE else [5, 6]
+
+
+# Convert a column of csv text values to floats with NaN for MISSING_TEXT
+def text_to_values(text):
+    text = np.asarray(text, dtype=object)
+    missing = np.isin(text, MISSING_TEXT)
+    values = np.full(len(text), np.nan)
+    values[~missing] = text[~missing].astype(np.float64)
+    return values
+
+
+# Status of each value of a column, see region_store: MISSING for NaN,
+# NEGATIVE below 0 and EMPTY where empty, the hours whose text was EMPTY
+def value_status(values, empty=False):
+    return np.select([empty, np.isnan(values), values < 0],
+            [region_store.EMPTY, region_store.MISSING, region_store.NEGATIVE], region_store.OK).astype(np.uint8)
+
+
+# Contribution of each value to an aggregate, matching add_values:
+# values are truncated to integers and MISSING, EMPTY and negative
+# values count as zero.
+def contributions(values):
+    return np.maximum(np.trunc(np.nan_to_num(values, nan=0.)), 0.)
+
+
+# Load the csv files of regions into an (hours x regions) array for each
+# value column, with NaN for MISSING and EMPTY, and the status of each value
+# in 'status', see value_status. Hours a file has no row for are MISSING.
+# Files are aligned by the hour of each row, so files covering different
+# hours can be combined.
+# The hours are the sorted union of the hours of all files, 'covered'
+# marks which hours each file has a row for and 'rows' holds the position
+# in the hours of each row of each file, -1 if its time can not be read.
+# frames can map regions to already loaded return_csv_frame results.
+def load_value_matrix(regions, grab_MICE=False, frames=None):
+
+    cols = value_columns(grab_MICE)
+    if frames == None:
+        # Only the first file's calendar columns are used
+        frames = {region : return_csv_frame(region, None if j == 0 else [0] + cols) for j, region in enumerate(regions)}
+    frames = [frames[region] for region in regions]
+    names = [frames[0].columns[col] for col in cols]
+
+    # Files with the same times as the first file, as is usual, share its hours
+    first_times = frames[0]['time'].to_numpy(dtype=object)
+    first_hours = return_row_hours(frames[0])
+    file_hours = []
+    for df in frames:
+        times = df['time'].to_numpy(dtype=object)
+        same = len(times) == len(first_times) and (times == first_times).all()
+        file_hours.append(first_hours if same else return_row_hours(df))
+    if all([h is first_hours for h in file_hours]) and (first_hours >= 0).all() and (np.diff(first_hours) > 0).all():
+        hours = first_hours
+    else:
+        hours = np.unique(np.concatenate([h[h >= 0] for h in file_hours]))
+
+    rows = []
+    covered = np.zeros((len(hours), len(frames)), dtype=bool)
+    values = {col : np.full((len(hours), len(frames)), np.nan) for col in cols}
+    status = {col : np.full((len(hours), len(frames)), region_store.MISSING, dtype=np.uint8) for col in cols}
+    for j, (df, h) in enumerate(zip(frames, file_hours)):
+        if h is hours:
+            pos = np.arange(len(hours))
+        else:
+            pos = np.where(h >= 0, np.searchsorted(hours, h), -1)
+        ok = pos >= 0
+        if (~ok).any():
+            print("{} rows of {} have an unreadable time and are skipped".format((~ok).sum(), regions[j]))
+        if len(np.unique(pos[ok])) < ok.sum():
+            print("{} has duplicate hours, the last row of each is used".format(regions[j]))
+        covered[pos[ok], j] = True
+        rows.append(pos)
+        for col, name in zip(cols, names):
+            column = df[name]
+            empty = False
+            # Columns with text other than MISSING_TEXT, such as EMPTY, are read as text
+            if column.dtype.kind not in 'fiu':
+                text = column.to_numpy(dtype=object)
+                empty = text == 'EMPTY'
+                column = text_to_values(text)
+            else:
+                column = column.to_numpy(dtype=np.float64)
+            values[col][pos[ok], j] = column[ok]
+            status[col][pos[ok], j] = value_status(column, empty)[ok]
 
+    return {'regions' : list(regions), 'frames' : frames, 'hours' : hours, 'rows' : rows,
+            'covered' : covered, 'values' : values, 'status' : status, 'names' : dict(zip(cols, names))}
 
 
-# Combines csv files if they have the appropriate acronmy matching
-# a previously created file by get_regional_demands.py
-def combine_regions(regions, out_name, grab_mean_impute=False, grab_MICE=False):
-    
-    usable_BAs = return_usable_BAs()
-    usable_regions = return_usable_regions()
+# Hours of the combined hours of members, all by default, which each member
+# does not cover, as a list of gaps per region. Each gap is a dict of its
+# first and last hour as EIA times and its number of hours.
+def alignment_gaps(loaded, members=None):
 
-    is_first = True
+    if members == None:
+        members = list(range(len(loaded['regions'])))
+    covered = loaded['covered'][:, members]
+    rows = np.flatnonzero(covered.any(axis=1))
+    hours = loaded['hours'][rows]
+
+    gaps = {}
+    for j, member in enumerate(members):
+        missing = ~covered[rows, j]
+        if not missing.any():
+            continue
+        # Gaps start where a missing hour follows a covered one or a jump in hours
+        idx = np.flatnonzero(missing)
+        starts = np.r_[True, (np.diff(idx) != 1) | (np.diff(hours[idx]) != 1)]
+        first = idx[starts]
+        last = idx[np.r_[starts[1:], True]]
+        times = region_store.format_eia_times(hours)
+        gaps[loaded['regions'][member]] = [{'start' : str(times[a]), 'end' : str(times[b]), 'hours' : int(b - a + 1)}
+                for a, b in zip(first, last)]
+    return gaps
+
+
+def report_alignment(loaded, out_name, members=None):
+    gaps = alignment_gaps(loaded, members)
+    for region, region_gaps in gaps.items():
+        metrics.count('hours_misaligned', sum([gap['hours'] for gap in region_gaps]), aggregate=out_name, region=region)
+        print("For new region {}, {} is missing {} hours in {} gaps, the first from {} to {}".format(
+            out_name, region, sum([gap['hours'] for gap in region_gaps]), len(region_gaps),
+            region_gaps[0]['start'], region_gaps[0]['end']))
+    return gaps
+
+
+# Sum the regions of a loaded value matrix into the rows of a combined csv file.
+# members are the column indices of the regions to sum, all by default, and
+# the first member takes the role of the first file in combine_regions.
+# The combined file has a row for every hour covered by any member.
+# Hours covered by more than one member, or by a member other than the
+# first, are the masked sum of the members, see contributions. totals can
+# give these sums for each value column if they are already known.
+# Hours only the first member covers keep its values with MISSING
+# and EMPTY demand and forecast set to zero, see zero_missing_and_empty.
+def aggregate_value_matrix(loaded, members=None, grab_MICE=False, totals=None):
+
+    if members == None:
+        members = list(range(len(loaded['regions'])))
+    rows, only_first = first_only_rows(loaded, members)
+
+    # Position in the combined rows of each row of the first file
+    out_index = np.full(len(loaded['hours']), -1, dtype=np.int64)
+    out_index[rows] = np.arange(len(rows))
+    first_pos = loaded['rows'][members[0]]
+    first_ok = first_pos >= 0
+    first_out = out_index[first_pos[first_ok]]
+
+    # The original text is only needed for hours which are not summed
+    first_text = None
+    if only_first.any():
+        first_text = load_first_text(loaded, [members])[loaded['regions'][members[0]]]
+
+    out_cols = []
+    for col in value_columns(grab_MICE):
+        if totals == None:
+            total = contributions(loaded['values'][col][rows][:, members]).sum(axis=1)
+        else:
+            total = totals[col][rows]
+        out = total.astype(np.int64).astype(str).astype(object)
+        if first_text != None:
+            text = np.empty(len(rows), dtype=object)
+            text[first_out] = np.array([row[col] for row in first_text], dtype=object)[first_ok]
+            if col in [5, 6]:
+                text[(text == 'MISSING') | (text == 'EMPTY')] = '0'
+            out[only_first] = text[only_first]
+        out_cols.append(out)
+
+    return combined_rows(loaded, rows, members[0], out_cols)
+
+
+# The sum of members of a loaded value matrix, all by default, as a
+# region_store.Series of the hours aggregate_value_matrix writes. Where the
+# combined csv file writes MISSING and EMPTY as 0, each summed hour keeps
+# the most severe status of the members, see AGGREGATE_SEVERITY, and
+# members without a row for it count as MISSING. Hours only the first
+# member covers keep its values and status. totals are as for
+# aggregate_value_matrix.
+def aggregate_series(loaded, members=None, grab_MICE=False, totals=None):
+
+    if members == None:
+        members = list(range(len(loaded['regions'])))
+    rows, only_first = first_only_rows(loaded, members)
+    rank = np.zeros(max(AGGREGATE_SEVERITY)+1, dtype=np.uint8)
+    rank[AGGREGATE_SEVERITY] = np.arange(len(AGGREGATE_SEVERITY))
+
+    columns = {}
+    status = {}
+    for col in value_columns(grab_MICE):
+        name = loaded['names'][col]
+        values = loaded['values'][col][rows][:, members]
+        member_status = loaded['status'][col][rows][:, members]
+        total = contributions(values).sum(axis=1) if totals == None else totals[col][rows]
+        severity = np.array(AGGREGATE_SEVERITY, dtype=np.uint8)[rank[member_status].max(axis=1)]
+        columns[name] = np.where(only_first, values[:, 0], total)
+        status[name] = np.where(only_first, member_status[:, 0], severity).astype(np.uint8)
+    return region_store.Series(loaded['hours'][rows], columns, status)
+
+
+# Record the forecast errors of the sum of members of a loaded value matrix,
+# all by default, as out_name, see forecast_errors.py. Only hours which all
+# members report with a demand and forecast of at least 0 are counted.
+# totals can give the sums of the value columns if they are already known.
+def record_forecast_errors(loaded, out_name, members=None, totals=None):
+
+    if not forecast_errors.ENABLED:
+        return
+    if members == None:
+        members = list(range(len(loaded['regions'])))
+    reported = loaded['covered'][:, members].all(axis=1)
+    sums = []
+    for col in [5, 6]:
+        values = loaded['values'][col][:, members]
+        reported &= (values >= 0).all(axis=1)
+        sums.append(contributions(values).sum(axis=1) if totals == None else totals[col])
+    forecast_errors.record(out_name, loaded['hours'][reported], sums[0][reported], sums[1][reported], DATA_DIR)
+
+
+# The combined rows of members of a loaded value matrix, the hours any of
+# them covers, and which of those rows only the first member covers
+def first_only_rows(loaded, members):
+    covered = loaded['covered'][:, members]
+    rows = np.flatnonzero(covered.any(axis=1))
+    return rows, covered[rows, 0] & ~covered[rows, 1:].any(axis=1)
+
+
+# Rows of the csv files of the first members of groups of a loaded value
+# matrix which have hours only their first member covers, for which
+# aggregate_value_matrix keeps the original text. The files are read once
+# and kept in loaded, so combine_many reads them all before any group is
+# written, as a group can be the input of another, such as TEX in
+# TEXAS_from_REGIONS and the TEX summed from its BAs.
+def load_first_text(loaded, groups):
+    text = loaded.setdefault('text', {})
+    for members in groups:
+        region = loaded['regions'][members[0]]
+        if region not in text and first_only_rows(loaded, members)[1].any():
+            text[region] = return_csv_file(region)[1:]
+    return text
+
+
+# Rows of a combined csv file for the hours at rows of a loaded value
+# matrix and the text of the value columns. The time and calendar text
+# comes from the first file where it has a row, other hours are
+# formatted as in get_regional_demands.py.
+def combined_rows(loaded, rows, first, out_cols):
+
+    frame = loaded['frames'][first]
+    pos = loaded['rows'][first]
+    names = ['time', 'year', 'month', 'day', 'hour']
+    if len(pos) == len(rows) and np.array_equal(pos, rows):
+        columns = [frame[name].tolist() for name in names]
+    else:
+        hours = loaded['hours'][rows]
+        year, month, day, hour = region_store.mem_calendar(hours)
+        columns = [region_store.format_eia_times(hours).astype(object)]
+        columns += [calendar.astype(str).astype(object) for calendar in [year, month, day, hour]]
+        out_index = np.full(len(loaded['hours']), -1, dtype=np.int64)
+        out_index[rows] = np.arange(len(rows))
+        ok = pos >= 0
+        for column, name in zip(columns, names):
+            column[out_index[pos[ok]]] = frame[name].to_numpy(dtype=object)[ok]
+        columns = [column.tolist() for column in columns]
+    columns += [out.tolist() for out in out_cols]
+    return [list(row) for row in zip(*columns)]
+
+
+
+# Return the files to combine for out_name. Regions which are not in
+# return_usable_BAs() or return_usable_regions() are skipped.
+def select_regions(regions, out_name, grab_mean_impute=False):
+
+    to_combine = []
     for region in regions:
 
-        if region not in usable_BAs and region not in usable_regions:
+        if not ba_mapping.is_usable(region):
             print("BA/region {} is excluded because it is not included in return_usable_BAs() OR return_usable_regions()".format(region))
             continue
 
         if grab_mean_impute:
             region = region+'_mean_impute'
 
-        # Add subsequent to the first region
-        if is_first:
+        if len(to_combine) == 0:
             print("For new region {}, loading first region: {}".format(out_name, region))
-            is_first = False
-            master = return_csv_file(region)
-            zero_missing_and_empty(master)
-            continue
+        else:
+            print("For new region {}, loading subsequent region: {}".format(out_name, region))
+        to_combine.append(region)
 
-        # Load subsequent regions
-        print("For new region {}, loading subsequent region: {}".format(out_name, region))
-        this_region = return_csv_file(region)
+    return to_combine
 
-        # Loop over all lines and add values to corresponding row
-        # in master file
-        for i in range(1, len(this_region)):
 
-            # Check for errors in time alignment
-            if master[i][0] != this_region[i][0]:
-                print("Error in file alignment in combine_regions for regions {} and {} line {}".format(regions[0], region, i))
-                print(master[i], this_region[i])
-                break
 
-            master[i][5] = add_values(master[i][5], this_region[i][5])
-            master[i][6] = add_values(master[i][6], this_region[i][6])
-            if grab_MICE:
-                master[i][7] = add_values(master[i][7], this_region[i][7])
+# Combines csv files if they have the appropriate acronmy matching
+# a previously created file by get_regional_demands.py
+def combine_regions(regions, out_name, grab_mean_impute=False, grab_MICE=False):
 
-    if grab_mean_impute:
-        out_name=out_name+'_mean_impute'
-    save_new_file(master, out_name, grab_MICE)
+    to_combine = select_regions(regions, out_name, grab_mean_impute)
+
+    # All regions are loaded into one array, aligned by hour, and summed at once
+    with metrics.timer('combine', aggregate=out_name):
+        loaded = load_value_matrix(to_combine, grab_MICE)
+        report_alignment(loaded, out_name)
+        master = aggregate_value_matrix(loaded, grab_MICE=grab_MICE)
+
+        if grab_mean_impute:
+            out_name=out_name+'_mean_impute'
+        save_new_file(master, out_name, grab_MICE)
+        if STORE:
+            aggregate_series(loaded, grab_MICE=grab_MICE).to_store(out_name)
+        record_forecast_errors(loaded, out_name)
+    if forecast_errors.ENABLED:
+        forecast_errors.write_summary(DATA_DIR)
     
-def save_new_file(combined_data, out_name, grab_MICE=False):
 
-    with open('data5_out2/{}.csv'.format(out_name), 'w', newline='') as csvfile:
 
-        fieldnames = ['time', 'year', 'month', 'day', 'hour', 'demand (MW)', 'forecast demand (MW)']
-        if grab_MICE:
-            fieldnames.append('cleaned demand (MW)')
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
+# Combine many new regions at once. groups maps each out_name to the
+# regions it combines, as passed to combine_regions. Every input file is
+# read once into a shared value matrix from which all groups are summed,
+# and the outputs are written by a pool of max_workers threads.
+# The files for MEM of the new regions in for_MEM and the forecast errors
+# of all of them are written as well.
+def combine_many(groups, grab_mean_impute=False, grab_MICE=False, max_workers=4, for_MEM=None):
+
+    for_MEM = [] if for_MEM == None else for_MEM
+    members = {out_name : select_regions(regions, out_name, grab_mean_impute) for out_name, regions in groups.items()}
+    all_regions = list(dict.fromkeys([region for regions in members.values() for region in regions]))
+    print("Loading {} files for {} new regions".format(len(all_regions), len(groups)))
+
+    with metrics.timer('combine_load', files=len(all_regions)):
+        frames = {region : return_csv_frame(region) for region in all_regions}
+        loaded = load_value_matrix(all_regions, grab_MICE, frames)
+    position = {region : j for j, region in enumerate(all_regions)}
+    load_first_text(loaded, [[position[region] for region in regions] for regions in members.values()])
+
+    def combine_group(out_name):
+        with metrics.timer('combine', aggregate=out_name):
+            idx = [position[region] for region in members[out_name]]
+            report_alignment(loaded, out_name, idx)
+            master = aggregate_value_matrix(loaded, idx, grab_MICE)
+            save_new_file(master, out_name+'_mean_impute' if grab_mean_impute else out_name, grab_MICE, out_name in for_MEM)
+            if STORE:
+                aggregate_series(loaded, idx, grab_MICE).to_store(out_name+'_mean_impute' if grab_mean_impute else out_name)
+            record_forecast_errors(loaded, out_name+'_mean_impute' if grab_mean_impute else out_name, idx)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(combine_group, groups.keys()))
+    if forecast_errors.ENABLED:
+        forecast_errors.write_summary(DATA_DIR)
+
+
+
+# Default tree for combine_hierarchy: CONUS from the interconnects,
+# the interconnects from the EIA regions and the regions from their BAs
+def return_hierarchy():
+    return {
+        'CONUS' : [ic+'_from_BAs' for ic in ba_mapping.INTERCONNECTS],
+        **{ic+'_from_BAs' : regions for ic, regions in ba_mapping.INTERCONNECTS.items()},
+        **ba_mapping.BAs_per_region(),
+    }
 
-        for line in combined_data:
-            if line[0] == 'time': continue
-            if not grab_MICE:
-                writer.writerow({'time': line[0], 'year': line[1], 'month': line[2], 'day': line[3], 'hour': line[4],
-                        'demand (MW)': line[5], 'forecast demand (MW)': line[6]})
-            else:
-                writer.writerow({'time': line[0], 'year': line[1], 'month': line[2], 'day': line[3], 'hour': line[4],
-                    'demand (MW)': line[5], 'forecast demand (MW)': line[6], 'cleaned demand (MW)': line[7]})
+
+# BAs at the bottom of the tree below node, in order. Nodes which
+# are not keys of the tree are BAs.
+def hierarchy_leaves(tree, node):
+    if node not in tree:
+        return [node]
+    return [leaf for child in tree[node] for leaf in hierarchy_leaves(tree, child)]
+
+
+# Nodes of the tree ordered so that every node comes after its children
+def hierarchy_order(tree):
+    order = []
+    def visit(node):
+        if node in order:
+            return
+        for child in tree.get(node, []):
+            visit(child)
+        order.append(node)
+    for node in tree:
+        visit(node)
+    return order
+
+
+def hierarchy_parents(tree):
+    parents = {}
+    for node, children in tree.items():
+        for child in children:
+            parents.setdefault(child, []).append(node)
+    return parents
+
+
+# Sum every node of the tree from its children. BAs are converted to their
+# contributions first, see contributions, so MISSING, EMPTY and negative values
+# are zeroed exactly once, before the first summation. loaded['leaves'] are
+# the BA names of the loaded files. Returns the totals of every node for
+# each value column.
+def sum_hierarchy(tree, loaded, grab_MICE=False):
+
+    position = {leaf : j for j, leaf in enumerate(loaded['leaves'])}
+    totals = {}
+    for node in hierarchy_order(tree):
+        if node in tree:
+            children = [child for child in tree[node] if child in totals]
+            totals[node] = {col : sum([totals[child][col] for child in children], np.zeros(loaded['values'][col].shape[0]))
+                    for col in value_columns(grab_MICE)}
+        elif node in position:
+            totals[node] = {col : contributions(loaded['values'][col][:, position[node]])
+                    for col in value_columns(grab_MICE)}
+    return totals
+
+
+# Recompute the totals of a BA after its values in loaded changed, and
+# then of only its ancestors. Returns the nodes which were updated.
+def update_hierarchy(tree, totals, loaded, region, grab_MICE=False):
+
+    j = loaded['leaves'].index(region)
+    totals[region] = {col : contributions(loaded['values'][col][:, j]) for col in value_columns(grab_MICE)}
+
+    parents = hierarchy_parents(tree)
+    ancestors = set()
+    to_visit = [region]
+    while len(to_visit) > 0:
+        for parent in parents.get(to_visit.pop(), []):
+            if parent not in ancestors:
+                ancestors.add(parent)
+                to_visit.append(parent)
+
+    updated = [region]
+    for node in hierarchy_order(tree):
+        if node not in ancestors:
+            continue
+        totals[node] = {col : sum([totals[child][col] for child in tree[node] if child in totals],
+                np.zeros(len(totals[region][col]))) for col in value_columns(grab_MICE)}
+        updated.append(node)
+    return updated
+
+
+# Write the combined csv files of nodes of the tree from their totals,
+# and the files for MEM of the nodes in for_MEM, and record their forecast
+# errors
+def save_hierarchy(tree, totals, loaded, nodes, grab_mean_impute=False, grab_MICE=False, for_MEM=None):
+
+    for_MEM = [] if for_MEM == None else for_MEM
+    position = {leaf : j for j, leaf in enumerate(loaded['leaves'])}
+    for node in nodes:
+        if node not in tree:
+            continue
+        with metrics.timer('combine', aggregate=node):
+            usable = [position[leaf] for leaf in hierarchy_leaves(tree, node) if leaf in position]
+            master = aggregate_value_matrix(loaded, usable, grab_MICE, totals[node])
+            save_new_file(master, node+'_mean_impute' if grab_mean_impute else node, grab_MICE, node in for_MEM)
+            if STORE:
+                aggregate_series(loaded, usable, grab_MICE, totals[node]).to_store(node+'_mean_impute' if grab_mean_impute else node)
+            record_forecast_errors(loaded, node+'_mean_impute' if grab_mean_impute else node, usable, totals[node])
+    if forecast_errors.ENABLED:
+        forecast_errors.write_summary(DATA_DIR)
+
+
+# Combine every node of a tree, such as return_hierarchy(), summing each
+# level from the level below instead of from all of its BAs. BAs outside of
+# return_usable_BAs() are skipped as in combine_regions. Returns the loaded
+# BAs and the totals of every node which can be passed to update_hierarchy.
+# BA files are aligned by hour, see load_value_matrix.
+# The files for MEM of the nodes in for_MEM are written as well.
+def combine_hierarchy(tree, grab_mean_impute=False, grab_MICE=False, for_MEM=None):
+
+    leaves = list(dict.fromkeys([leaf for node in tree for leaf in hierarchy_leaves(tree, node) if leaf in ba_mapping.USABLE_BAS]))
+    files = [leaf+'_mean_impute' if grab_mean_impute else leaf for leaf in leaves]
+    print("Loading {} BAs for {} new regions".format(len(files), len(tree)))
+
+    with metrics.timer('combine_load', files=len(files)):
+        frames = {region : return_csv_frame(region) for region in files}
+        loaded = load_value_matrix(files, grab_MICE, frames)
+    loaded['leaves'] = leaves
+    report_alignment(loaded, 'CONUS')
+
+    with metrics.timer('combine_sum', aggregate='hierarchy'):
+        totals = sum_hierarchy(tree, loaded, grab_MICE)
+    save_hierarchy(tree, totals, loaded, tree.keys(), grab_mean_impute, grab_MICE, for_MEM)
+    return loaded, totals
+
+
+# Reload the file of one BA after it changed and rewrite only the
+# nodes of the tree above it. loaded and totals are those returned by
+# combine_hierarchy. Returns the nodes which were updated.
+def update_combined_hierarchy(tree, loaded, totals, region, grab_mean_impute=False, grab_MICE=False, for_MEM=None):
+
+    j = loaded['leaves'].index(region)
+    frame = return_csv_frame(loaded['regions'][j])
+    reloaded = load_value_matrix([loaded['regions'][j]], grab_MICE, {loaded['regions'][j] : frame})
+    if not np.isin(reloaded['hours'], loaded['hours']).all():
+        raise ValueError("Updated file for {} has hours which the other BAs do not cover".format(region))
+    pos = np.where(reloaded['rows'][0] >= 0, np.searchsorted(loaded['hours'], reloaded['hours'])[reloaded['rows'][0]], -1)
+    loaded['rows'][j] = pos
+    loaded['covered'][:, j] = False
+    loaded['covered'][pos[pos >= 0], j] = True
+    for col in value_columns(grab_MICE):
+        loaded['values'][col][:, j] = np.nan
+        loaded['values'][col][pos[pos >= 0], j] = reloaded['values'][col][reloaded['rows'][0][pos >= 0], 0]
+        loaded['status'][col][:, j] = region_store.MISSING
+        loaded['status'][col][pos[pos >= 0], j] = reloaded['status'][col][reloaded['rows'][0][pos >= 0], 0]
+    loaded['frames'][j] = frame
+    # The text kept for hours only this BA covers is read again when needed
+    loaded.get('text', {}).pop(loaded['regions'][j], None)
+
+    updated = update_hierarchy(tree, totals, loaded, region, grab_MICE)
+    save_hierarchy(tree, totals, loaded, updated, grab_mean_impute, grab_MICE, for_MEM)
+    return updated
+
+
+
+# Temporary file a file is written to before it replaces the file, so a
+# file being written is never read half written. It keeps the extension,
+# which np.savez_compressed would otherwise add.
+def temp_path(file_path):
+    root, ext = os.path.splitext(file_path)
+    return '{}.{}.tmp{}'.format(root, threading.get_ident(), ext)
+
+
+# Write a new region. With for_MEM=True its files for MEM are written
+# from the same rows, see export_for_MEM.
+def save_new_file(combined_data, out_name, grab_MICE=False, for_MEM=False):
+
+    fieldnames = ['time', 'year', 'month', 'day', 'hour', 'demand (MW)', 'forecast demand (MW)']
+    if grab_MICE:
+        fieldnames.append('cleaned demand (MW)')
+    rows = [line[:len(fieldnames)] for line in combined_data if line[0] != 'time']
+
+    file_path = '{}{}.csv'.format(DATA_DIR, out_name)
+    with open(temp_path(file_path), 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(fieldnames)
+        writer.writerows(rows)
+    os.replace(temp_path(file_path), file_path)
+    metrics.count('rows_written', len(rows), region=out_name)
+
+    if for_MEM:
+        with metrics.timer('export_for_MEM', region=out_name):
+            export_for_MEM(fieldnames, rows, '{}{}.csv'.format(DATA_DIR, out_name))
+
+
+# Write a copy of the new region name as new_name, such as CONUS_from_BAs
+# of CONUS, with its files for MEM if for_MEM, its forecast errors and,
+# with STORE, its region store
+def save_copy(name, new_name, grab_MICE=False, for_MEM=False):
+    save_new_file(return_csv_file(name), new_name, grab_MICE, for_MEM)
+    if STORE:
+        region_store.Series.from_store(name).to_store(new_name)
+    if forecast_errors.ENABLED:
+        forecast_errors.copy_errors(name, new_name, DATA_DIR)
+        forecast_errors.write_summary(DATA_DIR)
 
 
 # Set initial MISSING and EMPTY to zero in first file.
@@ -130,175 +782,141 @@ def add_values(val1, val2):
 
 
 
-def return_BAs_per_region_map():
-    
-    regions = {
-            'CENT' : 'Central', 
-            'MIDW' : 'Midwest', 
-            'TEN' : 'Tennessee', 
-            'SE' : 'Southeast', 
-            'FLA' : 'Florida', 
-            'CAR' : 'Carolinas', 
-            'MIDA' : 'Mid-Atlantic', 
-            'NY' : 'New York', 
-            'NE' : 'New England',
-            'TEX' : 'Texas', 
-            'CAL' : 'California', 
-            'NW' : 'Northwest', 
-            'SW' : 'Southwest'
-    }
-
-    rtn_map = {}
-    for k, v in regions.items():
-        rtn_map[k] = []
-
-    # Load EIA's Blancing Authority Acronym table
-    # https://www.eia.gov/realtime_grid/
-    df = pd.read_csv('data/balancing_authority_acronyms.csv', 
-            skiprows=1) # skip first row as it is source info
+# Map of each EIA region to its US48 BAs, see ba_mapping
+def return_BAs_per_region_map(verbose=False):
 
-    # Loop over all rows and fill map
-    for idx in df.index:
+    rtn_map = ba_mapping.BAs_per_region()
 
-        # Skip Canada and Mexico
-        if df.loc[idx, 'Region'] in ['Canada', 'Mexico']:
-            continue
-
-        reg_acronym = ''
-        # Get region to acronym
-        for k, v in regions.items():
-            if v == df.loc[idx, 'Region']:
-                reg_acronym = k
-                break
-        assert(reg_acronym != '')
-
-        rtn_map[reg_acronym].append(df.loc[idx, 'Code'])
-        
-    tot = 0
-    print("\nBA to Region mapping:")
-    for k, v in rtn_map.items():
-        print(k, v)
-        tot += len(v)
-    print("\n\nTotal US48 BAs mapped {}.  Recall 10 are generation only.".format(tot))
+    if verbose:
+        tot = 0
+        print("\nBA to Region mapping:")
+        for k, v in rtn_map.items():
+            print(k, v)
+            tot += len(v)
+        print("\n\nTotal US48 BAs mapped {}.  Recall 10 are generation only.".format(tot))
 
     return rtn_map
 
 
 
 def return_usable_BAs():
-    return [
-                'AEC', 'AECI', 'CPLE', 'CPLW', 
-                'DUK', 'FMPP', 'FPC', 
-                'FPL', 'GVL', 'HST', 'ISNE', 
-                'JEA', 'LGEE', 'MISO', 'NSB', 
-                'NYIS', 'PJM', 'SC', 
-                'SCEG', 'SOCO', 
-                'SPA', 'SWPP', 'TAL', 'TEC', 
-                'TVA', 
-                'ERCO',
-                'AVA', 'AZPS', 'BANC', 'BPAT', 
-                'CHPD', 'CISO', 'DOPD', 
-                'EPE', 'GCPD',
-                'IID', 
-                'IPCO', 'LDWP', 'NEVP', 'NWMT', 
-                'PACE', 'PACW', 'PGE', 'PNM', 
-                'PSCO', 'PSEI', 'SCL', 'SRP', 
-                'TEPC', 'TIDC', 'TPWR', 'WACM', 
-                'WALC', 'WAUW',
-                # 'OVEC', 'SEC',
-                ]
+    return ba_mapping.usable_BAs()
 
 def return_usable_regions():
-    return [
-                'CENT', 'MIDW', 'TEN', 'SE', 'FLA', 'CAR', 'MIDA', 'NY', 'NE',
-                'TEX', 'CAL', 'NW', 'SW'
-                ]
+    return ba_mapping.usable_regions()
+
+
+# New regions summed from the BAs and from the EIA regions for each
+# interconnect and CONUS. There are 10 US BAs from the EIA database which
+# are excluded from these lists. They are the ones who are responsible for
+# generation only and do not report demand data to EIA. See the users
+# guide (linked from the README) for details.
+def return_ICs_from_BAs():
+    ICs_from_BAs = {ic+'_from_BAs' : BAs for ic, BAs in ba_mapping.BAs_per_interconnect().items()}
+    ICs_from_BAs['CONUS_from_BAs'] = return_usable_BAs()
+    return ICs_from_BAs
+
+
+# Medium regions already have EIA data cleaning and imputation applied
+# and can provide a comparison against the more graunual SMALL_REGIONS
+def return_ICs_from_REGIONS():
+    ICs_from_REGIONS = {ic+'_from_REGIONS' : regions for ic, regions in ba_mapping.INTERCONNECTS.items()}
+    ICs_from_REGIONS['CONUS_from_REGIONS'] = return_usable_regions()
+    return ICs_from_REGIONS
+
+
+
+# Text which pandas reads as NA by default. pandas only has this list in a
+# private module, pandas._libs.parsers.STR_NA_VALUES since 1.0, so it is
+# copied here.
+PANDAS_NA_TEXT = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+        '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+
+
+# Convert a column of csv text the way reading it with pandas and writing
+# it back does: integers are written as integers, a column with any other
+# number or with NAs as floats, and NAs as 'NA'. Returns the text and the
+# values, or None for the values if the column is not numeric.
+def mem_column(text):
+
+    text = [str(t) for t in text]
+    try:
+        ints = [int(t) for t in text]
+        return [str(i) for i in ints], np.array(ints, dtype=np.int64)
+    except ValueError:
+        pass
+
+    # None of PANDAS_NA_TEXT is an integer
+    import pandas as pd
+    na = [t in PANDAS_NA_TEXT for t in text]
+    try:
+        ints = [0 if is_na else int(t) for t, is_na in zip(text, na)]
+        values = np.where(na, np.nan, np.array(ints, dtype=np.float64))
+    except ValueError:
+        # Floats are parsed by pandas, which can differ from float() in the last digit
+        try:
+            values = np.full(len(text), np.nan)
+            values[~np.array(na, dtype=bool)] = pd.to_numeric(pd.Series([t for t, is_na in zip(text, na) if not is_na],
+                    dtype=object)).to_numpy(dtype=np.float64)
+        except ValueError:
+            return ['NA' if is_na else t for t, is_na in zip(text, na)], None
+    return ['NA' if is_na else repr(v) for v, is_na in zip(values.tolist(), na)], values
+
+
+# Write the files for MEM of a region from the header and rows of its csv
+# file at file_path. The cleaned demand replaces the demand if it exists,
+# only the calendar and demand columns are kept and all analysis starts on
+# July 2, 2015, 20 rows in. Each format in formats, or MEM_FORMATS, is
+# written next to file_path with a single write.
+def export_for_MEM(header, rows, file_path, formats=None):
+
+    rows = rows[20:] # Start all analysis on July 2, 2015
+    demand_col = 'cleaned demand (MW)' if 'cleaned demand (MW)' in header else 'demand (MW)'
+    names = ['year', 'month', 'day', 'hour', 'demand (MW)']
+    columns = [mem_column([row[header.index(name)] for row in rows])
+            for name in ['year', 'month', 'day', 'hour', demand_col]]
+
+    for out_format in (MEM_FORMATS if formats == None else formats):
+        out_path = file_path.replace('.csv', '_for_MEM.'+out_format)
+        if out_format == 'csv':
+            text = ''.join([','.join(row)+os.linesep for row in zip(*[column[0] for column in columns])])
+            with open(temp_path(out_path), 'w', newline='') as f:
+                f.write(','.join(names)+os.linesep+text)
+        elif out_format == 'npz':
+            np.savez_compressed(temp_path(out_path), **{name.split(' ')[0] : column[0] if column[1] is None else column[1]
+                    for name, column in zip(names, columns)})
+        else:
+            raise ValueError("Unknown MEM format '{}'".format(out_format))
+        os.replace(temp_path(out_path), out_path)
 
 
 # For analysis copy the 'cleaned' colum over the normal 'demand' column and drop 'cleaned'.
 # Drop the first day of data which shows issues for some BAs.
 # Start all analysis on July 2, 2015.
-def prep_for_MEM(file_path):
+# The files are written by export_for_MEM.
+def prep_for_MEM(file_path, formats=None):
     print(f"prep_for_MEM: {file_path}")
-    df = pd.read_csv(file_path)
-    if 'cleaned demand (MW)' in df.columns:
-        df['demand (MW)'] = df['cleaned demand (MW)']
-    df = df.drop(['time','cleaned demand (MW)','forecast demand (MW)'], axis=1)
-    df = df.drop(df.index[[i for i in range(20)]]) # Start all analysis on July 2, 2015
-    df.to_csv(file_path.replace('.csv', '_for_MEM.csv'), index=False, na_rep='NA')
+    with metrics.timer('export_for_MEM', region=os.path.basename(file_path).replace('.csv', '')):
+        with open(file_path, 'r', newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            rows = list(reader)
+        export_for_MEM(header, rows, file_path, formats)
 
 
 if '__main__' in __name__:
-    # There are 10 US BAs from the EIA database which are excluded from
-    # this dictionary. They are the ones who are responsible for generation
-    # only and do not report demand data to EIA. See the users guide (linked
-    # from the README) for details.
-    ICs_from_BAs = {
-        'EASTERN_from_BAs' : [
-                'AEC', 'AECI', 'CPLE', 'CPLW', 
-                'DUK', 'FMPP', 'FPC', 
-                'FPL', 'GVL', 'HST', 'ISNE', 
-                'JEA', 'LGEE', 'MISO', 'NSB', 
-                'NYIS', 'PJM', 'SC', 
-                'SCEG', 'SOCO', 
-                'SPA', 'SWPP', 'TAL', 'TEC', 
-                'TVA', 
-                'OVEC', 'SEC',
-                ],
-        'TEXAS_from_BAs' : [
-                'ERCO',
-                ],
-        'WESTERN_from_BAs' : [
-                'AVA', 'AZPS', 'BANC', 'BPAT', 
-                'CHPD', 'CISO', 'DOPD', 
-                'EPE', 'GCPD',
-                'IID', 
-                'IPCO', 'LDWP', 'NEVP', 'NWMT', 
-                'PACE', 'PACW', 'PGE', 'PNM', 
-                'PSCO', 'PSEI', 'SCL', 'SRP', 
-                'TEPC', 'TIDC', 'TPWR', 'WACM', 
-                'WALC', 'WAUW',
-                ],
-        'CONUS_from_BAs' : return_usable_BAs(),
-        }
-    # Medium regions already have EIA data cleaning and imputation applied
-    # and can provide a comparison against the more graunual SMALL_REGIONS
-    ICs_from_REGIONS = {
-        'EASTERN_from_REGIONS' : [
-            'CENT', 'MIDW', 'TEN', 'SE', 'FLA', 'CAR', 'MIDA', 'NY', 'NE'
-                ],
-        'TEXAS_from_REGIONS' : [
-                'TEX',
-                ],
-        'WESTERN_from_REGIONS' : [
-                'CAL', 'NW', 'SW'
-                ],
-        'CONUS_from_REGIONS' : [
-            'CENT', 'MIDW', 'TEN', 'SE', 'FLA', 'CAR', 'MIDA', 'NY', 'NE',
-                'TEX',
-                'CAL', 'NW', 'SW'
-                ]
-        }
+    ICs_from_BAs = return_ICs_from_BAs()
+    ICs_from_REGIONS = return_ICs_from_REGIONS()
 
 
     # Can be used to combine and study initial data queried from EIA
     do_raw_eia = False
     if do_raw_eia:
-        for IC, regs in ICs_from_REGIONS.items():
-            combine_regions(regs, IC)
-
-
-        for IC, BAs in ICs_from_BAs.items():
-            combine_regions(BAs, IC)
-
-
         REGIONS_from_BAs = return_BAs_per_region_map()
         grab_mean_impute = False
         grab_MICE = False # Get data from Dave's MICE runs
-        for REGION, BAs in REGIONS_from_BAs.items():
-            print(REGION, BAs)
-            combine_regions(BAs, REGION, grab_mean_impute, grab_MICE)
-        combine_regions(return_usable_BAs(), 'CONUS', grab_mean_impute, grab_MICE)
+        combine_many({**ICs_from_REGIONS, **ICs_from_BAs, **REGIONS_from_BAs,
+            'CONUS' : return_usable_BAs()}, grab_mean_impute, grab_MICE)
 
 
     # Use to create combinations using the simple anomaly IDing and simple imputations
@@ -306,10 +924,13 @@ if '__main__' in __name__:
     do_simple = False
     if do_simple:
         grab_mean_impute = True
-        for IC, BAs in ICs_from_BAs.items():
-            combine_regions(BAs, IC, grab_mean_impute)
+        combine_many(ICs_from_BAs, grab_mean_impute)
+
 
 
+    # The files for MEM of these new regions are written as they are combined
+    prepare_for_MEM = True
+    for_MEM = ['EASTERN_from_BAs', 'TEXAS_from_BAs', 'WESTERN_from_BAs', 'CONUS_from_BAs'] if prepare_for_MEM else []
 
     add_mice_imputations = True
     if add_mice_imputations:
@@ -317,28 +938,18 @@ if '__main__' in __name__:
         # Add the imputed demand to the original csv files
         #----------------------------------------------------
         usable_BAs = return_usable_BAs()
-        for BA in usable_BAs:
-            #add_MICE_imputations_to_files('~/Downloads/mean_impute_csv_MASTER_v12_2day_mice_Sept13.csv', BA)
-            add_MICE_imputations_to_files('~/tmp_data4/csv_MASTER_XXX_v12_2day_mean_impute.csv', BA)
+        #add_MICE_imputations_to_many_files('~/Downloads/mean_impute_csv_MASTER_v12_2day_mice_Sept13.csv', usable_BAs)
+        add_MICE_imputations_to_many_files(os.path.expanduser('~/tmp_data4/csv_MASTER_XXX_v12_2day_mean_impute.csv'), usable_BAs)
 
 
-        REGIONS_from_BAs = return_BAs_per_region_map()
         grab_mean_impute = False
         grab_MICE = True # Get data from Dave's MICE runs
-        combine_regions(return_usable_BAs(), 'CONUS', grab_mean_impute, grab_MICE)
-
-        for REGION, BAs in REGIONS_from_BAs.items():
-            print(REGION, BAs)
-            combine_regions(BAs, REGION, grab_mean_impute, grab_MICE)
-
-        for IC, BAs in ICs_from_BAs.items():
-            combine_regions(BAs, IC, grab_mean_impute, grab_MICE)
-
-    prepare_for_MEM = True
-    if prepare_for_MEM:
-        for REG in ['EASTERN_from_BAs.csv',
-                    'TEXAS_from_BAs.csv',
-                    'WESTERN_from_BAs.csv',
-                    'CONUS_from_BAs.csv']:
-            prep_for_MEM(f'data5_out2/{REG}')
+        # CONUS is summed from the interconnects which are summed from the regions
+        combine_hierarchy(return_hierarchy(), grab_mean_impute, grab_MICE, for_MEM)
+        save_copy('CONUS', 'CONUS_from_BAs', grab_MICE, 'CONUS_from_BAs' in for_MEM)
+
+    elif prepare_for_MEM:
+        # Write the files for MEM of previously combined regions
+        for REG in for_MEM:
+            prep_for_MEM(f'{DATA_DIR}{REG}.csv')
 
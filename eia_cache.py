@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# On-disk cache of EIA API responses used by get_regional_demands.py
+#
+# Responses are keyed by their url with the api_key removed, so a cache
+# directory can be shared or kept as a set of recorded fixtures.
+# Each entry is stored as two files in CACHE_DIR:
+#   <key>.body  the raw response
+#   <key>.json  the url, ETag, Last-Modified and the time it was fetched
+#
+# Cached responses younger than the requested TTL are used directly,
+# older ones are revalidated with If-None-Match / If-Modified-Since.
+# In offline mode (EIA_OFFLINE=1) only cached responses are used and
+# the network is never touched.
+# The least recently used entries are removed once the cache
+# grows beyond MAX_CACHE_BYTES.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import http.client
+import threading
+import urllib.parse
+
+
+
+CACHE_DIR = os.environ.get('EIA_CACHE_DIR', 'cache')
+ENABLED = os.environ.get('EIA_CACHE', '1') != '0'
+OFFLINE = os.environ.get('EIA_OFFLINE', '0') != '0'
+MAX_CACHE_BYTES = int(os.environ.get('EIA_CACHE_MAX_BYTES', 2 * 1024**3))
+
+_lock = threading.Lock()
+
+
+
+# Remove the api_key from a url so it is not written to disk
+# and does not change the cache key
+def strip_api_key(url):
+    parts = urllib.parse.urlsplit(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query) if k != 'api_key']
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+
+def cache_key(url):
+    return hashlib.sha256(strip_api_key(url).encode('utf-8')).hexdigest()
+
+
+def _paths(url):
+    key = cache_key(url)
+    return os.path.join(CACHE_DIR, key+'.body'), os.path.join(CACHE_DIR, key+'.json')
+
+
+# Return the metadata of a cached response, or None if the url is not cached
+def load_meta(url):
+    if not ENABLED:
+        return None
+    body_path, meta_path = _paths(url)
+    if not os.path.exists(body_path):
+        return None
+    try:
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+# Open the cached response body of a url as a binary file.
+# This marks the entry as recently used.
+def open_body(url):
+    body_path = _paths(url)[0]
+    f = open(body_path, 'rb')
+    os.utime(body_path)
+    return f
+
+
+def is_fresh(meta, ttl):
+    return meta != None and time.time() - meta['fetched'] < ttl
+
+
+# Headers for a conditional request revalidating a cached response
+def revalidation_headers(meta):
+    headers = {}
+    if meta == None:
+        return headers
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+
+# Write data, or copy it if it is a file object, to a temporary file
+# which then replaces path. Returns the number of bytes or characters written.
+# If fewer than expected_size bytes were copied, as when the connection drops
+# in the middle of a response, IncompleteRead is raised and path is left as it was.
+def _write(path, data, mode, expected_size=None):
+    tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+    try:
+        with open(tmp_path, mode) as f:
+            if hasattr(data, 'read'):
+                shutil.copyfileobj(data, f)
+            else:
+                f.write(data)
+            size = f.tell()
+        if expected_size != None and size < expected_size:
+            raise http.client.IncompleteRead(b'', expected_size - size)
+        os.replace(tmp_path, path)
+    finally:
+        # Left behind if the copy failed part way
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return size
+
+
+def _write_meta(url, meta):
+    _write(_paths(url)[1], json.dumps(meta, sort_keys=True, indent=4), 'w')
+
+
+# Store a response body along with its validators from the response headers.
+# body can be bytes or a file object, such as the http response itself,
+# which is copied to disk in chunks.
+def store(url, body, headers):
+    if not ENABLED:
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    length = headers.get('Content-Length')
+    size = _write(_paths(url)[0], body, 'wb', int(length) if length and length.isdigit() else None)
+    meta = {
+        'url' : strip_api_key(url),
+        'etag' : headers.get('ETag'),
+        'last_modified' : headers.get('Last-Modified'),
+        'fetched' : time.time(),
+        'size' : size,
+    }
+    _write_meta(url, meta)
+    evict()
+
+
+# Mark a cached response as fresh again after EIA answered
+# a conditional request with 304 Not Modified
+def refresh(url, meta):
+    if not ENABLED:
+        return
+    meta['fetched'] = time.time()
+    _write_meta(url, meta)
+
+
+# Remove least recently used entries until the cache is below max_bytes
+def evict(max_bytes=None):
+    max_bytes = MAX_CACHE_BYTES if max_bytes == None else max_bytes
+    with _lock:
+        entries = []
+        total = 0
+        for name in os.listdir(CACHE_DIR):
+            if not name.endswith('.body'):
+                continue
+            try:
+                stat = os.stat(os.path.join(CACHE_DIR, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name[:-len('.body')]))
+            total += stat.st_size
+
+        for _, size, key in sorted(entries):
+            if total <= max_bytes:
+                break
+            for ext in ['.body', '.json']:
+                try:
+                    os.remove(os.path.join(CACHE_DIR, key+ext))
+                except FileNotFoundError:
+                    pass
+            total -= size
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+# Errors of the EIA day-ahead demand forecast against the realized demand,
+# for each BA and each combined region, by year, month and hour of the day.
+#
+# The errors are summed while the data is written, from the arrays which
+# are already in memory: get_regional_demands.save_to_MEM_format records
+# each BA and combine_regional_files each new region. Only hours with a
+# demand above 0, as MISSING and EMPTY hours are 0 in the combined files,
+# and a forecast of at least 0 are counted, and for combined regions only
+# hours which all of their BAs report. For each group the summary has
+#   hours  number of hours counted
+#   mae    mean absolute error, MW
+#   mape   mean absolute error in % of the demand
+#   bias   mean of forecast minus demand, MW
+# and the 'all' group has the errors over all hours.
+#
+# Each region is saved to its own small file in the ERRORS_DIR of its data
+# directory, so regions written at the same time by different threads or
+# processes do not share a file. write_summary joins them into one table
+# without reading the region files again.
+#
+# The demand and forecast of the last KEEP_HOURS hours counted are kept as
+# well, in a .npz file per region, with the sums of the errors of the hours
+# before them. After an incremental update only the rewritten hours are
+# passed to record, and only the kept hours are summed again with them,
+# instead of reading the whole region file back.
+#
+# If run as is this computes the errors of the region files in the given
+# directories, for files written before the errors were recorded, and
+# prints those over all hours.
+#
+# With EIA_FORECAST_ERRORS=0 in the environment nothing is recorded.
+
+import os
+import sys
+import csv
+import numpy as np
+
+import region_store
+
+
+
+ENABLED = os.environ.get('EIA_FORECAST_ERRORS', '1') != '0'
+ERRORS_DIR = 'forecast_errors'
+SUMMARY_FILE = 'summary.csv'
+
+GROUPS = ['all', 'year', 'month', 'hour']
+COLUMNS = ['region', 'group', 'key', 'hours', 'mae', 'mape', 'bias']
+
+# Hours at the end of a region whose demand and forecast are kept so an
+# incremental update can rewrite them, see record. This has to be more than
+# the revision_hours of get_regional_demands.py.
+KEEP_HOURS = 24 * 14
+
+
+
+# Sums of the errors of each group of hours. add can be called with
+# consecutive chunks of a region and gives the same result as all at once.
+class ErrorSums:
+
+    def __init__(self):
+        # (group, key) : [hours, abs error, error, abs error / demand]
+        self.sums = {}
+
+    def add(self, hours, demand, forecast):
+        hours, demand, forecast = counted(hours, demand, forecast)
+        if len(hours) == 0:
+            return self
+        error = forecast - demand
+        terms = [np.ones(len(error)), np.abs(error), error, np.abs(error) / demand]
+
+        year, month, day, hour = region_store.mem_calendar(hours)
+        for group, keys in zip(GROUPS, [np.zeros(len(error), dtype=np.int64), year, month, hour]):
+            unique, inverse = np.unique(keys, return_inverse=True)
+            sums = np.stack([np.bincount(inverse, weights=term, minlength=len(unique)) for term in terms], axis=1)
+            for key, s in zip(unique.tolist(), sums):
+                key = (group, 'all' if group == 'all' else key)
+                self.sums[key] = self.sums[key] + s if key in self.sums else s
+        return self
+
+    def copy(self):
+        sums = ErrorSums()
+        sums.sums = dict(self.sums)
+        return sums
+
+    # The sums as arrays which np.savez can save, see from_arrays
+    def to_arrays(self):
+        items = list(self.sums.items())
+        return {'sum_groups' : np.array([GROUPS.index(group) for (group, key), s in items], dtype=np.int64),
+                'sum_keys' : np.array([0 if group == 'all' else key for (group, key), s in items], dtype=np.int64),
+                'sum_values' : np.array([s for key, s in items], dtype=np.float64).reshape(-1, 4)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        sums = cls()
+        for group, key, s in zip(arrays['sum_groups'].tolist(), arrays['sum_keys'].tolist(), arrays['sum_values']):
+            sums.sums[(GROUPS[group], 'all' if GROUPS[group] == 'all' else key)] = s
+        return sums
+
+    # Rows of the summary table for region, in the order of GROUPS
+    def rows(self, region):
+        rows = []
+        for (group, key), s in sorted(self.sums.items(), key=lambda item: (GROUPS.index(item[0][0]), str(item[0][1]).zfill(4))):
+            n, abs_error, error, relative_error = s.tolist()
+            rows.append([region, group, key, int(n), round(abs_error / n, 2), round(100. * relative_error / n, 3), round(error / n, 2)])
+        return rows
+
+
+
+# The hours, demand and forecast of the hours which are counted
+def counted(hours, demand, forecast):
+    demand = np.asarray(demand, dtype=np.float64)
+    forecast = np.asarray(forecast, dtype=np.float64)
+    ok = np.isfinite(demand) & np.isfinite(forecast) & (demand > 0) & (forecast >= 0)
+    return np.asarray(hours, dtype=np.int64)[ok], demand[ok], forecast[ok]
+
+
+def errors_dir(data_dir):
+    return os.path.join(data_dir, ERRORS_DIR)
+
+
+# Sum the errors of one region and save them. With start, the hours are
+# those of the region from start on, and the earlier hours are the ones
+# saved by the last record of the region. Returns False, without saving
+# anything, if those were not saved up to start, or start is before the
+# last KEEP_HOURS of the region when it was saved, in which case all hours
+# of the region have to be passed.
+def record(region, hours, demand, forecast, data_dir, start=None):
+    # The last hours of a region are often not counted, so the last hour
+    # passed is saved as well
+    end = hours[-1] if len(hours) > 0 else -1
+    hours, demand, forecast = counted(hours, demand, forecast)
+    before = ErrorSums()
+    cutoff = np.iinfo(np.int64).min
+    if start != None:
+        saved = load_hours(region, data_dir)
+        if saved == None or saved['end'] < start - 1 or saved['cutoff'] > start:
+            return False
+        end = max(end, start - 1)
+        before = saved['before']
+        cutoff = saved['cutoff']
+        keep = saved['hours'] < start
+        hours = np.concatenate([saved['hours'][keep], hours])
+        demand = np.concatenate([saved['demand'][keep], demand])
+        forecast = np.concatenate([saved['forecast'][keep], forecast])
+
+    # Hours which are no longer kept are added to the sums of the earlier hours
+    cutoff = max(cutoff, end + 1 - KEEP_HOURS)
+    old = hours < cutoff
+    before.add(hours[old], demand[old], forecast[old])
+    save_hours(region, hours[~old], demand[~old], forecast[~old], end, data_dir, cutoff, before)
+    save_errors(region, before.copy().add(hours[~old], demand[~old], forecast[~old]), data_dir)
+    return True
+
+
+# Save the kept hours of a region, from cutoff on, and the sums of the
+# errors of the hours before them
+def save_hours(region, hours, demand, forecast, end, data_dir, cutoff=None, before=None):
+    os.makedirs(errors_dir(data_dir), exist_ok=True)
+    file_path = os.path.join(errors_dir(data_dir), region+'.npz')
+    cutoff = np.iinfo(np.int64).min if cutoff == None else cutoff
+    before = ErrorSums() if before == None else before
+    # np.savez adds .npz to names without it
+    tmp_path = file_path[:-4]+'.{}.tmp.npz'.format(os.getpid())
+    np.savez(tmp_path, hours=hours, demand=demand, forecast=forecast, end=np.int64(end), cutoff=np.int64(cutoff),
+            **before.to_arrays())
+    os.replace(tmp_path, file_path)
+
+
+# The kept hours of a region as saved by save_hours, with the sums of the
+# errors of the earlier hours as 'before', or None if it has none
+def load_hours(region, data_dir):
+    file_path = os.path.join(errors_dir(data_dir), region+'.npz')
+    if not os.path.exists(file_path):
+        return None
+    with np.load(file_path) as saved:
+        saved = {name : saved[name] for name in saved.files}
+    # Files saved before the sums were kept have all hours
+    if 'cutoff' not in saved:
+        return {**saved, 'cutoff' : np.iinfo(np.int64).min, 'before' : ErrorSums()}
+    saved['before'] = ErrorSums.from_arrays(saved)
+    return saved
+
+
+# Save the errors of region as those of new_region too, for a region file
+# which is copied, such as CONUS_from_BAs from CONUS. Returns False if
+# region has no errors saved.
+def copy_errors(region, new_region, data_dir):
+    saved = load_hours(region, data_dir)
+    if saved == None:
+        return False
+    save_hours(new_region, saved['hours'], saved['demand'], saved['forecast'], saved['end'], data_dir,
+            saved['cutoff'], saved['before'])
+    save_errors(new_region, saved['before'].copy().add(saved['hours'], saved['demand'], saved['forecast']), data_dir)
+    return True
+
+
+def save_errors(region, sums, data_dir):
+    os.makedirs(errors_dir(data_dir), exist_ok=True)
+    file_path = os.path.join(errors_dir(data_dir), region+'.csv')
+    tmp_path = file_path+'.{}.tmp'.format(os.getpid())
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        writer.writerows(sums.rows(region))
+    os.replace(tmp_path, file_path)
+
+
+# Join the errors of all regions of data_dir into its summary table.
+# Returns the path of the summary, or None if no errors were recorded.
+def write_summary(data_dir):
+    directory = errors_dir(data_dir)
+    if not os.path.isdir(directory):
+        return None
+    rows = []
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith('.csv') or file_name == SUMMARY_FILE:
+            continue
+        with open(os.path.join(directory, file_name), 'r', newline='') as f:
+            rows += list(csv.reader(f))[1:]
+    file_path = os.path.join(directory, SUMMARY_FILE)
+    tmp_path = file_path+'.{}.tmp'.format(os.getpid())
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        writer.writerows(rows)
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+def read_summary(data_dir):
+    import pandas as pd
+    return pd.read_csv(os.path.join(errors_dir(data_dir), SUMMARY_FILE))
+
+
+# Compute the errors of existing region files of data_dir, all of the
+# files with a forecast column by default
+def record_files(data_dir, regions=None):
+    if regions == None:
+        regions = sorted([file_name[:-4] for file_name in os.listdir(data_dir) if file_name.endswith('.csv')])
+    for region in regions:
+        file_path = os.path.join(data_dir, region+'.csv')
+        with open(file_path, 'r') as f:
+            if 'forecast demand (MW)' not in f.readline():
+                continue
+        series = region_store.Series.from_csv(file_path, ['demand (MW)', 'forecast demand (MW)'])
+        record(region, series.hours, series.masked('demand (MW)'), series.masked('forecast demand (MW)'), data_dir)
+    return write_summary(data_dir)
+
+
+
+if '__main__' in __name__:
+
+    for data_dir in sys.argv[1:] or ['data/']:
+        summary = record_files(data_dir)
+        if summary == None:
+            print("No region files with a forecast in {}".format(data_dir))
+            continue
+        print("Forecast errors of {} saved to {}".format(data_dir, summary))
+        df = read_summary(data_dir)
+        print(df[df['group'] == 'all'].drop(columns=['group', 'key']).to_string(index=False))
@@ -11,22 +11,142 @@
 
 import urllib.request
 import urllib.parse
+import urllib.error
+import http.client
 import json
-import csv
 import os
+import re
+import time
+import random
+import socket
 import datetime
-from collections import OrderedDict
+import concurrent.futures
+from array import array
+import numpy as np
+
+import eia_cache
+import http_pool
+import region_store
+import forecast_errors
+import metrics
+from region_store import parse_eia_times, format_eia_times
+
+
+
+# Base url of the EIA API. This can be pointed at a local stand-in server
+# for testing by setting EIA_API_URL in the environment.
+EIA_API_URL = os.environ.get('EIA_API_URL', 'https://api.eia.gov')
+
+# Per-request timeout in seconds and retry settings used by query_eia
+REQUEST_TIMEOUT = 60
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 2.
+# Fraction by which each retry wait is randomly shortened or lengthened, so
+# threads which were rate limited at the same time do not retry at once
+BACKOFF_JITTER = 0.5
+
+# HTTP status codes which indicate EIA is rate limiting us or is temporarily
+# unavailable. These are retried, all other HTTP errors are raised.
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# How long, in seconds, cached responses are used without revalidating
+# them with EIA. Category metadata almost never changes.
+CATEGORY_CACHE_TTL = 7 * 24 * 3600
+SERIES_CACHE_TTL = 3600
+
+# Directory the MEM formatted region files are written to
+DATA_DIR = 'data/'
+
+# File in DATA_DIR listing the regions fetch_all_regions completed, so an
+# interrupted or partly failed run resumes where it stopped, see load_manifest
+MANIFEST_FILE = '.fetch_manifest.json'
+
+
+
+# Label of the metrics of a request, its series_id or category
+def request_label(url):
+    query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+    return query.get('series_id', 'category')
+
+
+# Open an EIA API url and return the response body as a binary file object.
+# Responses are cached on disk by eia_cache and the body is streamed to the
+# cache file, so it is never held in memory as a whole. A cached response
+# younger than ttl seconds is used directly, otherwise it is revalidated with EIA.
+# Requests are sent on the keep-alive connection of the thread, see http_pool.
+# Failed requests are retried with jittered exponential backoff. If EIA sends
+# a Retry-After header with a rate limit response that wait is honored.
+# Requests, retries, cache hits, bytes and latency are counted in metrics.
+# Without the cache the latency is the time to the response headers,
+# with it the time to download the body as well.
+def open_eia(url, ttl=0, timeout=None, retries=None):
+
+    timeout = REQUEST_TIMEOUT if timeout == None else timeout
+    retries = MAX_RETRIES if retries == None else retries
+    label = request_label(url)
+
+    meta = eia_cache.load_meta(url)
+    if meta != None and (eia_cache.OFFLINE or eia_cache.is_fresh(meta, ttl)):
+        metrics.count('cache_hits', series=label)
+        return eia_cache.open_body(url)
+    if eia_cache.OFFLINE:
+        raise RuntimeError("No cached response in offline mode for {}".format(eia_cache.strip_api_key(url)))
+
+    request = urllib.request.Request(url, headers=eia_cache.revalidation_headers(meta))
+    for attempt in range(retries + 1):
+        wait = BACKOFF_SECONDS * 2**attempt * random.uniform(1 - BACKOFF_JITTER, 1 + BACKOFF_JITTER)
+        t0 = time.perf_counter()
+        try:
+            query = http_pool.urlopen(request, timeout=timeout)
+            metrics.count('http_requests', series=label)
+            # Without the cache the response is read directly from the connection
+            if not eia_cache.ENABLED:
+                metrics.observe('http_request', time.perf_counter() - t0, series=label)
+                return metrics.CountingReader(query, 'http_bytes', series=label)
+            with query:
+                eia_cache.store(url, query, query.headers)
+            metrics.observe('http_request', time.perf_counter() - t0, series=label)
+            f = eia_cache.open_body(url)
+            metrics.count('http_bytes', os.fstat(f.fileno()).st_size, series=label)
+            return f
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and meta != None:
+                metrics.count('http_not_modified', series=label)
+                eia_cache.refresh(url, meta)
+                return eia_cache.open_body(url)
+            if e.code not in RETRY_STATUS_CODES or attempt == retries:
+                metrics.count('http_errors', series=label)
+                raise
+            try:
+                wait = max(wait, float(e.headers.get('Retry-After', 0)))
+            except ValueError:
+                pass # Retry-After can also be an http date, use our own backoff
+            reason = 'HTTP {}'.format(e.code)
+        except (urllib.error.URLError, socket.timeout, http.client.IncompleteRead) as e:
+            # IncompleteRead is raised when the connection drops while the
+            # body is copied to the cache
+            if attempt == retries:
+                metrics.count('http_errors', series=label)
+                raise
+            reason = str(e)
+        metrics.count('http_retries', series=label)
+        print("Request failed ({}), retry {} of {} in {} seconds".format(reason, attempt+1, retries, round(wait, 1)))
+        time.sleep(wait)
+
+
+
+# Open an EIA API url and return the decoded json response, see open_eia
+def query_eia(url, ttl=0, timeout=None, retries=None):
+
+    with open_eia(url, ttl, timeout, retries) as f, metrics.timer('json_parse', series=request_label(url)):
+        return json.load(f)
 
 
 
 # Query EIA to get list of regions for which hourly electricity deman data is available
 def get_regions_data():
 
-    regions_query = urllib.request.urlopen('http://api.eia.gov/category/?api_key={}&category_id=2122628&format=json'.format(os.environ['EIA_API_KEY']))
-    regions_response = regions_query.read().decode('utf-8')
-    regions_data = json.loads(regions_response)
-
-    return regions_data
+    return query_eia('{}/category/?api_key={}&category_id=2122628&format=json'.format(EIA_API_URL, os.environ['EIA_API_KEY']), CATEGORY_CACHE_TTL)
 
 
 
@@ -34,112 +154,406 @@ def get_regions_data():
 # category_id and series_id
 def category_id_to_series_id_demand(category_id):
 
-    region_query = urllib.request.urlopen('http://api.eia.gov/category/?api_key={}&category_id={}&format=json'.format(os.environ['EIA_API_KEY'], category_id))
-    region_response = region_query.read().decode('utf-8')
-    region_data = json.loads(region_response)
+    region_data = query_eia('{}/category/?api_key={}&category_id={}&format=json'.format(EIA_API_URL, os.environ['EIA_API_KEY'], category_id), CATEGORY_CACHE_TTL)
 
     return region_data['category']['childseries'][0]['series_id']
 
 
 
+# Optional start and end parameters restricting a series query to a time range.
+# EIA expects the times in the same format as the returned data, e.g. 20190901T00Z.
+def time_range_parameters(start=None, end=None):
+    params = ''
+    if start != None:
+        params += '&start={}'.format(start)
+    if end != None:
+        params += '&end={}'.format(end)
+    return params
+
+
+
+def series_url(series_id, start=None, end=None):
+    return '{}/series/?api_key={}&series_id={}&format=json{}'.format(EIA_API_URL, os.environ['EIA_API_KEY'], series_id, time_range_parameters(start, end))
+
+
+# The series_id for the forecasted demand is identical to that of the realized demand with a minor string replacement
+def forecast_series_id(series_id):
+    return series_id.replace('-ALL.D.H','-ALL.DF.H')
+
+
+
 # Query EIA for hour electric demand data for a given region
-def get_regional_data(series_id):
+# start and end can be used to only query a subset of the hours
+def get_regional_data(series_id, start=None, end=None):
 
-    region_query = urllib.request.urlopen('http://api.eia.gov/series/?api_key={}&series_id={}&format=json'.format(os.environ['EIA_API_KEY'], series_id))
-    region_response = region_query.read().decode('utf-8')
-    region_data = json.loads(region_response)
+    region_data = query_eia(series_url(series_id, start, end), SERIES_CACHE_TTL)
 
-    # For checking initial raw EIA output
-    #with open('data/{}_raw.csv'.format(series_id), 'w', newline='') as csvfile:
-    #    csvfile.write(json.dumps(region_data, sort_keys=True, indent=4))
+    # The raw EIA output for checking is kept in the response cache,
+    # see eia_cache.CACHE_DIR
 
     return region_data
 
 
 
 # Query EIA for forecasted hourly electric demand data for a given region
-def get_forecast_regional_data(series_id):
+def get_forecast_regional_data(series_id, start=None, end=None):
 
-    # The series_id for the forecasted demand is identical to that of the realized demand with a minor string replacement
-    region_query = urllib.request.urlopen('http://api.eia.gov/series/?api_key={}&series_id={}&format=json'.format(os.environ['EIA_API_KEY'], series_id.replace('-ALL.D.H','-ALL.DF.H')))
-    region_response = region_query.read().decode('utf-8')
-    region_data = json.loads(region_response)
+    region_data = query_eia(series_url(forecast_series_id(series_id), start, end), SERIES_CACHE_TTL)
 
     return region_data
 
 
 
-# Generate full hourly date and time series from start date ending the hour before end date
+# A single [time, value] pair of the series data. Times are matched
+# loosely here and validated by parse_eia_times.
+SERIES_DATA_POINT = re.compile(rb'\s*,?\s*\[\s*"([^"]*)"\s*,\s*(null|[-+.0-9eE]+)\s*\]')
+SERIES_DATA_START = re.compile(rb'"data"\s*:\s*\[')
+
+
+
+# Parse the data of the first series in an EIA series response from a binary
+# file object without loading the whole response. The [time, value] pairs are
+# read chunk by chunk into compact typed buffers, 12 bytes per time and a
+# float64 per value, and returned as (hours, values) arrays like series_to_arrays.
+def parse_series_stream(f, chunk_size=1<<16):
+
+    buf = b''
+    pos = 0
+    in_data = False
+    eof = False
+    times = bytearray()
+    values = array('d')
+
+    while True:
+        if not in_data:
+            series = buf.find(b'"series"')
+            start = SERIES_DATA_START.search(buf, series) if series >= 0 else None
+            if start != None:
+                in_data = True
+                pos = start.end()
+                continue
+            if eof:
+                raise ValueError("No series data found in EIA response: {}".format(buf[:200]))
+        else:
+            match = SERIES_DATA_POINT.match(buf, pos)
+            while match != None and match.end() < len(buf):
+                time, value = match.groups()
+                if len(time) == 12:
+                    times += time
+                    values.append(np.nan if value == b'null' else float(value))
+                pos = match.end()
+                match = SERIES_DATA_POINT.match(buf, pos)
+            if buf[pos:].lstrip().startswith(b']'):
+                break
+            if eof:
+                raise ValueError("Malformed series data in EIA response near: {}".format(buf[pos:pos+200]))
+            # Keep the unparsed tail, which can be a partial data point
+            buf = buf[pos:]
+            pos = 0
+
+        chunk = f.read(chunk_size)
+        eof = len(chunk) == 0
+        buf += chunk
+
+    # Times of the wrong length were already dropped above
+    hours, valid = parse_eia_times(np.frombuffer(times, dtype='S12'))
+    return hours, np.frombuffer(values, dtype=np.float64)[valid]
+
+
+
+# Query EIA for hourly electric demand of a region and stream the response
+# into (hours, values) arrays, see parse_series_stream
+def get_regional_data_arrays(series_id, start=None, end=None):
+
+    with open_eia(series_url(series_id, start, end), SERIES_CACHE_TTL) as f, metrics.timer('json_parse', series=series_id):
+        return parse_series_stream(f)
+
+
+
+# Query EIA for forecasted hourly electric demand of a region as (hours, values) arrays
+def get_forecast_regional_data_arrays(series_id, start=None, end=None):
+
+    with open_eia(series_url(forecast_series_id(series_id), start, end), SERIES_CACHE_TTL) as f, metrics.timer('json_parse', series=forecast_series_id(series_id)):
+        return parse_series_stream(f)
+
+
+
+# Generate full hourly date and time series from start date ending the hour before end date.
+# The hours are returned as a numpy datetime64[h] array.
 def generate_full_time_series(start_date, end_date):
-    full_date_range = []
-    for n in range(int ((end_date - start_date).days)):
-        for h in range(24):
-            full_date_range.append(datetime.datetime.combine(start_date + datetime.timedelta(n), datetime.time(h, 0)))
+    return np.arange(np.datetime64(start_date, 'h'), np.datetime64(end_date, 'h'))
 
-    return full_date_range
 
 
-# Save region hourly electric demand data to a format usable by MEM
-def save_to_MEM_format(series_id, region_data, region_forecast_data, full_date_range):
+# Convert the [time, value] pairs of an EIA series response to an int64
+# column of hours since the epoch and a float64 column of values.
+# Hours which EIA reported as None have a NaN value.
+def series_to_arrays(region_data):
 
-    region_id = series_id.replace('EBA.','').replace('-ALL.D.H','')
+    data = region_data['series'][0]['data']
+    hours, valid = parse_eia_times([point[0] for point in data])
+    values = np.array([point[1] for point in data], dtype=np.float64)
+    return hours, values[valid]
 
-    with open('data/{}.csv'.format(region_id), 'w', newline='') as csvfile:
 
-        fieldnames = ['time', 'year', 'month', 'day', 'hour', 'demand (MW)', 'forecast demand (MW)']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
 
-        full_date_range_dict = OrderedDict()
-        for hour in full_date_range:
-            full_date_range_dict[hour.strftime("%Y%m%dT%HZ")] = ['MISSING', 'MISSING']
+# Place series values on the hourly grid of the output file. Hours outside
+# the grid are skipped. Returns the values on the grid and their status:
+# MISSING if EIA did not report the hour and EMPTY if it was reported as None.
+def align_to_hours(grid, hours, values):
 
-        # Actual realized demand
-        for demand in region_data['series'][0]['data']:
-            # Skip dates outside the specified range
-            if demand[0] not in full_date_range_dict.keys():
-                continue
+    aligned = np.full(len(grid), np.nan)
+    status = np.full(len(grid), region_store.MISSING, dtype=np.uint8)
+    if len(grid) == 0:
+        return aligned, status
+
+    idx = np.searchsorted(grid, hours)
+    match = idx < len(grid)
+    match[match] = grid[idx[match]] == hours[match]
+    aligned[idx[match]] = values[match]
+    status[idx[match]] = np.where(np.isnan(values[match]), region_store.EMPTY, region_store.OK)
+    return aligned, status
+
+
+
+def series_id_to_region_id(series_id):
+    return series_id.replace('EBA.','').replace('-ALL.D.H','')
+
+
+
+# Return the time of the last row in a regional csv file, or None if the
+# file does not exist or has no data rows. Only the end of the file is read.
+def get_last_time(region_id):
+
+    file_path = '{}{}.csv'.format(DATA_DIR, region_id)
+    if not os.path.exists(file_path):
+        return None
+
+    with open(file_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 1024))
+        lines = f.read().splitlines()
+
+    for line in reversed(lines):
+        time = line.split(b',')[0].decode('utf-8')
+        if time == 'time':
+            return None
+        if time != '':
+            return time
+    return None
+
+
+
+# Remove all rows at and after time from a regional csv file so that
+# updated rows can be appended in their place
+def truncate_regional_file(region_id, time):
+
+    with open('{}{}.csv'.format(DATA_DIR, region_id), 'r+b') as f:
+        offset = 0
+        for line in f:
+            # Times are formatted as 20150701T05Z so string order is time order
+            row_time = line.split(b',')[0].decode('utf-8')
+            if row_time != 'time' and row_time >= time:
+                break
+            offset += len(line)
+        f.truncate(offset)
+
+
+
+# Save region hourly electric demand data to a format usable by MEM
+# region_data and region_forecast_data can be EIA series responses or
+# (hours, values) arrays as returned by series_to_arrays.
+# With append=True the existing file is kept up to the first hour in
+# full_date_range and only the rows from that hour onwards are rewritten.
+# With store=True the region is also saved to the columnar region_store.
+def save_to_MEM_format(series_id, region_data, region_forecast_data, full_date_range, append=False, store=False):
+
+    region_id = series_id_to_region_id(series_id)
+
+    hours = np.asarray(full_date_range, dtype='datetime64[h]')
+    # Skip the first 5 hours of July 1st 2015 because they are empty for
+    # all regions
+    hours = hours[~np.isin(hours, np.arange(np.datetime64('2015-07-01T00'), np.datetime64('2015-07-01T05')))]
+    if append:
+        if len(hours) == 0:
+            return
+        truncate_regional_file(region_id, format_eia_times(hours[:1])[0])
+
+    if isinstance(region_data, dict):
+        region_data = series_to_arrays(region_data)
+    if isinstance(region_forecast_data, dict):
+        region_forecast_data = series_to_arrays(region_forecast_data)
+
+    grid = hours.astype(np.int64)
+    columns = {}
+    status = {}
+    # Actual realized demand
+    columns['demand (MW)'], status['demand (MW)'] = align_to_hours(grid, *region_data)
+    # Day ahead forecasted demand
+    columns['forecast demand (MW)'], status['forecast demand (MW)'] = align_to_hours(grid, *region_forecast_data)
+    for name in columns:
+        metrics.count_status(columns[name], status[name], region=region_id, column=name)
+    series = region_store.Series(grid, columns, status)
+
+    with metrics.timer('write_region', region=region_id):
+        series.to_csv('{}{}.csv'.format(DATA_DIR, region_id), append)
+        if store:
+            series.to_store(region_id, append=append, csv_path='{}{}.csv'.format(DATA_DIR, region_id))
+    metrics.count('rows_written', len(series), region=region_id)
+
+    # The forecast errors are summed from the aligned arrays. After an
+    # incremental update only the new hours are in memory, the earlier
+    # hours are those saved by forecast_errors, or if it has none the
+    # whole file is read back.
+    if forecast_errors.ENABLED:
+        if not forecast_errors.record(region_id, series.hours, series.masked('demand (MW)'),
+                series.masked('forecast demand (MW)'), DATA_DIR, grid[0] if append else None):
+            series = region_store.Series.from_csv('{}{}.csv'.format(DATA_DIR, region_id), list(columns))
+            forecast_errors.record(region_id, series.hours, series.masked('demand (MW)'),
+                    series.masked('forecast demand (MW)'), DATA_DIR)
+
+
+
+
+# Return the hours of full_date_range which need to be queried to update
+# an existing regional file. The last revision_hours already in the file
+# are queried again because EIA revises recent values. Returns the full
+# range if there is no usable existing file.
+def get_update_range(region_id, full_date_range, revision_hours=72):
+
+    hours = np.asarray(full_date_range, dtype='datetime64[h]')
+    last_time = get_last_time(region_id)
+    if last_time == None:
+        return hours
+
+    update_start = np.datetime64(datetime.datetime.strptime(last_time, '%Y%m%dT%HZ'), 'h') - revision_hours
+    return hours[hours > update_start]
+
+
+
+# Look up the series_id, download realized and forecast demand and save
+# the MEM formatted csv for a single region.
+# If incremental, only hours newer than the existing file, plus a trailing
+# window of revision_hours, are queried and merged into the file.
+def process_region(region, full_date_range, incremental=False, revision_hours=72, store=False):
+
+    series_id = category_id_to_series_id_demand(region['category_id'])
+
+    update_range = full_date_range
+    if incremental:
+        update_range = get_update_range(series_id_to_region_id(series_id), full_date_range, revision_hours)
+        if len(update_range) == 0:
+            print("No new hours for region: {}".format(region['name']))
+            return series_id
+    append = incremental and len(update_range) < len(full_date_range)
+
+    start, end = None, None
+    if append:
+        start, end = format_eia_times(update_range[[0, -1]])
+        print("Updating data for region: {} with series_id {} from {}".format(region['name'], series_id, start))
+    else:
+        print("Getting data for region: {} with series_id {}".format(region['name'], series_id))
+    with metrics.timer('fetch_region', region=region['name']):
+        region_data = get_regional_data_arrays(series_id, start, end)
+        region_forecast_data = get_forecast_regional_data_arrays(series_id, start, end)
+    save_to_MEM_format(series_id, region_data, region_forecast_data, update_range, append, store)
+    return series_id
+
+
+
+# The settings of a fetch which must match for it to be resumed
+def fetch_settings(full_date_range, incremental=False, revision_hours=72, store=False):
+    hours = np.asarray(full_date_range, dtype='datetime64[h]')
+    return {'start' : str(hours[0]) if len(hours) > 0 else None, 'end' : str(hours[-1]) if len(hours) > 0 else None,
+            'incremental' : incremental, 'revision_hours' : revision_hours, 'store' : store}
+
+
+# Names and series_ids of the regions an earlier fetch with the same
+# settings completed before it was interrupted or regions failed
+def load_manifest(settings):
+    file_path = DATA_DIR+MANIFEST_FILE
+    if not os.path.exists(file_path):
+        return {}
+    try:
+        with open(file_path, 'r') as f:
+            manifest = json.load(f)
+    except ValueError:
+        return {}
+    if manifest.get('settings') != settings:
+        print("Fetch settings changed since the last run, fetching all regions again")
+        return {}
+    return manifest['completed']
+
+
+# The manifest is replaced at once so it is never left half written
+def save_manifest(settings, completed):
+    file_path = DATA_DIR+MANIFEST_FILE
+    with open(file_path+'.tmp', 'w') as f:
+        json.dump({'settings' : settings, 'completed' : completed}, f, indent=4)
+    os.replace(file_path+'.tmp', file_path)
+
+
+
+# Settings of a worker process of fetch_all_regions, which are set at run
+# time in the parent and so not seen by a process which was not forked.
+# region_store looks STORE_DIR up at each call, see region_store.store_base.
+def init_worker(data_dir, store_dir):
+    global DATA_DIR
+    DATA_DIR = data_dir
+    region_store.STORE_DIR = store_dir
+
+
+# Process all regions using a pool of max_workers threads so that the
+# EIA round trips for different regions overlap. Regions which fail after
+# all retries are reported and returned instead of stopping the other regions.
+# Each completed region is recorded in the manifest. With resume, the
+# regions an interrupted or partly failed run with the same settings
+# completed are skipped. The manifest is removed once all regions are done.
+# With processes=True the pool is of processes instead, so parsing the
+# responses and writing the files of the regions uses all cores. The
+# metrics each process records are sent back with its regions and merged,
+# see metrics.collect. The forecast errors of the regions are joined into
+# one table at the end, see forecast_errors.py.
+def fetch_all_regions(regions, full_date_range, max_workers=8, incremental=False, revision_hours=72, store=False, resume=True, processes=False):
+
+    settings = fetch_settings(full_date_range, incremental, revision_hours, store)
+    completed = load_manifest(settings) if resume else {}
+    to_fetch = [region for region in regions if region['name'] not in completed]
+    if len(to_fetch) < len(regions):
+        print("Resuming, {} of {} regions were already fetched".format(len(regions) - len(to_fetch), len(regions)))
+
+    failed = []
+    if processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                initializer=init_worker, initargs=(DATA_DIR, region_store.STORE_DIR))
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    with executor:
+        if processes:
+            futures = {executor.submit(metrics.collect, process_region, region, full_date_range, incremental, revision_hours, store) : region
+                    for region in to_fetch}
+        else:
+            futures = {executor.submit(process_region, region, full_date_range, incremental, revision_hours, store) : region for region in to_fetch}
+        for future in concurrent.futures.as_completed(futures):
+            region = futures[future]
             try:
-                if demand[1] == None:
-                    full_date_range_dict[demand[0]][0] = 'EMPTY'
-                else:
-                    full_date_range_dict[demand[0]][0] = demand[1]
-            except KeyError:
-                print("Check date and time formatting for category {} for time {}".format(region_id, demand[0]))
-
-        # Day ahead forecasted demand
-        for demand in region_forecast_data['series'][0]['data']:
-            # Skip dates outside the specified range
-            if demand[0] not in full_date_range_dict.keys():
+                result = future.result()
+                if processes:
+                    result, worker_metrics = result
+                    metrics.merge(worker_metrics)
+                completed[region['name']] = result
+            except Exception as e:
+                print("Failed to get data for region: {} with error: {}".format(region['name'], e))
+                metrics.count('regions_failed', region=region['name'])
+                failed.append(region)
                 continue
-            try:
-                if demand[1] == None:
-                    full_date_range_dict[demand[0]][1] = 'EMPTY'
-                else:
-                    full_date_range_dict[demand[0]][1] = demand[1]
-            except KeyError:
-                print("Check date and time formatting for forecast category {} for time {}".format(region_id, demand[0]))
-
-        for time, demand in full_date_range_dict.items():
-            # Skip the first 5 hours of July 1st 2015 because they are empty for
-            # all regions
-            if time in [
-                    '20150701T00Z',
-                    '20150701T01Z',
-                    '20150701T02Z',
-                    '20150701T03Z',
-                    '20150701T04Z']: continue
-            dt = datetime.datetime.strptime(time, '%Y%m%dT%HZ')
-            # From EIA form 930 instructions: 
-            # "Report all data as hourly integrated values in megawatts by hour ending time."
-            # Hours are reported as 1-24 in MEM. To align with this, we subtract 1 hour from UTC
-            # time so that 20150702T00Z, which is the EIA integrated value between July 1, 23:00
-            # and July 2 00:00 is reported as July 1, hour 24.
-            mem_format = dt + datetime.timedelta(hours=-1)
-            writer.writerow({'time': time, 
-                'year': mem_format.year, 'month': mem_format.month, 'day': mem_format.day, 'hour': mem_format.hour+1,
-                'demand (MW)': demand[0], 'forecast demand (MW)': demand[1]})
+            save_manifest(settings, completed)
 
+    if len(failed) == 0 and os.path.exists(DATA_DIR+MANIFEST_FILE):
+        os.remove(DATA_DIR+MANIFEST_FILE)
+    if forecast_errors.ENABLED:
+        forecast_errors.write_summary(DATA_DIR)
+    return failed
 
 
 
@@ -152,13 +566,28 @@ if '__main__' in __name__:
     end_date = datetime.date(2019, 9, 1) # Can update this as time progresses
     full_date_range = generate_full_time_series(start_date, end_date)
 
-    for region in regions_data['category']['childcategories']:
+    # Number of regions queried from EIA at the same time
+    max_workers = 8
 
-        series_id = category_id_to_series_id_demand(region['category_id'])
-        print("Getting data for region: {} with series_id {}".format(region['name'], series_id))
-        region_data = get_regional_data(series_id)
-        region_forecast_data = get_forecast_regional_data(series_id)
-        save_to_MEM_format(series_id, region_data, region_forecast_data, full_date_range)
+    # Only query hours newer than those already in data/ plus a trailing
+    # window which is checked for late revisions by EIA
+    incremental = False
+    revision_hours = 72
+
+    # Also save each region to the columnar binary store, see region_store.py
+    store = False
+
+    # Skip the regions an interrupted run with the same settings completed
+    resume = True
+
+    # Query the regions in processes instead of threads, so parsing and
+    # writing them is not limited to one core
+    processes = False
+
+    failed = fetch_all_regions(regions_data['category']['childcategories'], full_date_range,
+            max_workers, incremental, revision_hours, store, resume, processes)
+    if len(failed) > 0:
+        print("Failed regions: {}".format([region['name'] for region in failed]))
 
 
 
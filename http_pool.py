@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# Persistent HTTP connections for the EIA API requests of
+# get_regional_demands.py
+#
+# urllib.request opens a new connection, with a new TLS handshake for
+# https, for every request. Here each thread keeps one keep-alive
+# connection per host and reuses it for all of its requests, so the
+# threads of fetch_all_regions each hold a connection for the whole run.
+#
+# urlopen takes the same Request and timeout as urllib.request.urlopen and
+# raises the same HTTPError and URLError, so the retry handling of
+# open_eia is unchanged. Redirects are followed. If a proxy is configured
+# in the environment, or POOL_CONNECTIONS is False, urllib is used instead.
+
+import io
+import os
+import socket
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+
+POOL_CONNECTIONS = True
+MAX_REDIRECTS = 5
+
+_local = threading.local()
+
+
+
+# A forked process, such as a worker of fetch_all_regions, starts without
+# connections instead of sharing the sockets of its parent
+def _forget_connections():
+    global _local
+    _local = threading.local()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_connections)
+
+
+def _connections():
+    if not hasattr(_local, 'connections'):
+        _local.connections = {}
+    return _local.connections
+
+
+# The connection of this thread to the host of a url, and whether it was
+# used before. It is made if there is none or the timeout changed.
+def _connection(parts, timeout):
+    key = (parts.scheme, parts.netloc)
+    connections = _connections()
+    conn = connections.get(key)
+    if conn != None and conn.timeout == timeout:
+        return conn, True
+    if conn != None:
+        conn.close()
+    if parts.scheme == 'https':
+        conn = http.client.HTTPSConnection(parts.netloc, timeout=timeout)
+    else:
+        conn = http.client.HTTPConnection(parts.netloc, timeout=timeout)
+    connections[key] = conn
+    return conn, False
+
+
+def _drop(parts):
+    conn = _connections().pop((parts.scheme, parts.netloc), None)
+    if conn != None:
+        conn.close()
+
+
+# Close the connections of this thread
+def close_all():
+    for conn in _connections().values():
+        conn.close()
+    _connections().clear()
+
+
+
+# Response of a pooled connection. Closing it reads what is left of the
+# body, so the connection can be used for the next request, or drops the
+# connection if that fails.
+class PooledResponse:
+
+    def __init__(self, response, parts, url):
+        self.response = response
+        self.parts = parts
+        self.url = url
+        self.headers = response.headers
+        self.status = response.status
+
+    def read(self, *args):
+        return self.response.read(*args)
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        try:
+            self.response.read()
+            self.response.close()
+            if self.response.will_close:
+                _drop(self.parts)
+        except (OSError, http.client.HTTPException):
+            _drop(self.parts)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+# Send a GET request on the pooled connection to its host. A connection
+# which was used before may have been closed by the server while idle,
+# then the request is sent once more on a new connection.
+def _get(url, headers, timeout):
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?'+parts.query
+    for attempt in range(2):
+        conn, reused = _connection(parts, timeout)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn.getresponse(), parts
+        except socket.timeout:
+            _drop(parts)
+            raise
+        except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError,
+                BrokenPipeError, http.client.CannotSendRequest, http.client.ResponseNotReady) as e:
+            _drop(parts)
+            if not reused or attempt == 1:
+                raise urllib.error.URLError(e)
+        except (OSError, http.client.HTTPException) as e:
+            _drop(parts)
+            raise urllib.error.URLError(e)
+
+
+def urlopen(request, timeout=None):
+
+    if not POOL_CONNECTIONS or len(urllib.request.getproxies()) > 0:
+        return urllib.request.urlopen(request, timeout=timeout)
+
+    url = request.full_url
+    headers = dict(request.header_items())
+    headers.setdefault('Accept-Encoding', 'identity')
+    for redirect in range(MAX_REDIRECTS + 1):
+        response, parts = _get(url, headers, timeout)
+        if response.status in [301, 302, 303, 307, 308] and response.headers.get('Location'):
+            response.read()
+            if response.will_close:
+                _drop(parts)
+            url = urllib.parse.urljoin(url, response.headers['Location'])
+            continue
+        if response.status >= 300:
+            body = response.read()
+            if response.will_close:
+                _drop(parts)
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+        return PooledResponse(response, parts, url)
+    raise urllib.error.URLError("Too many redirects for {}".format(url))
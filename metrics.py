@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# Timers and counters of the pipeline stages, regions and EIA requests.
+#
+# Each metric has a name and labels, such as stage, region or series:
+#   count('rows_written', 8760, region='CISO')
+#   with timer('combine', aggregate='CAL'):
+#       ...
+# Counters are summed, timers keep the number of calls and the total and
+# longest time. All metrics are kept in memory and are safe to update from
+# threads. Work done in a process pool is run through collect, which sends
+# the metrics of each call back with its result, and the parent process
+# adds them to its own with merge.
+#
+# write_metrics saves them as json or, for a .prom file, in the Prometheus
+# text format which the node exporter textfile collector reads.
+# print_summary prints the slowest timers, so a stage or BA slowing the
+# nightly run down stands out. profile() runs a block under cProfile.
+#
+# With EIA_METRICS=0 in the environment nothing is recorded.
+
+import os
+import re
+import json
+import time
+import threading
+import contextlib
+
+
+
+ENABLED = os.environ.get('EIA_METRICS', '1') != '0'
+PROMETHEUS_PREFIX = 'eia_'
+
+_lock = threading.Lock()
+_counters = {}
+_timers = {}
+
+
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+def count(name, value=1, **labels):
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+# Record one call of a timer taking seconds
+def observe(name, seconds, **labels):
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        calls, total, longest = _timers.get(key, (0, 0., 0.))
+        _timers[key] = (calls + 1, total + seconds, max(longest, seconds))
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0, **labels)
+
+
+# Count MISSING, EMPTY and negative hours of a value column with its status
+# array, see region_store
+def count_status(values, status, **labels):
+    # Imported here so metrics does not load numpy for scripts which do not need it
+    import region_store
+    count('hours_missing', int((status == region_store.MISSING).sum()), **labels)
+    count('hours_empty', int((status == region_store.EMPTY).sum()), **labels)
+    count('hours_negative', int(((status == region_store.OK) & (values < 0)).sum()), **labels)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+
+def snapshot():
+    with _lock:
+        counters = [{'name' : name, 'labels' : dict(labels), 'value' : value}
+                for (name, labels), value in sorted(_counters.items())]
+        timers = [{'name' : name, 'labels' : dict(labels), 'calls' : calls,
+                'seconds' : round(total, 6), 'max_seconds' : round(longest, 6)}
+                for (name, labels), (calls, total, longest) in sorted(_timers.items())]
+    return {'time' : time.strftime('%Y-%m-%dT%H:%M:%S'), 'counters' : counters, 'timers' : timers}
+
+
+# Add the metrics of a snapshot, such as one taken by collect in another
+# process, to the metrics of this process
+def merge(metrics):
+    if not ENABLED:
+        return
+    with _lock:
+        for c in metrics['counters']:
+            key = _key(c['name'], c['labels'])
+            _counters[key] = _counters.get(key, 0) + c['value']
+        for t in metrics['timers']:
+            key = _key(t['name'], t['labels'])
+            calls, total, longest = _timers.get(key, (0, 0., 0.))
+            _timers[key] = (calls + t['calls'], total + t['seconds'], max(longest, t['max_seconds']))
+
+
+# Call function with args in a worker process of a pool and return its
+# result and the metrics it recorded, which the parent passes to merge.
+# The metrics are reset first, as forked workers start with a copy of
+# the parent's and are reused for many calls.
+def collect(function, *args):
+    reset()
+    result = function(*args)
+    return result, snapshot()
+
+
+
+def _prometheus_labels(labels):
+    if len(labels) == 0:
+        return ''
+    text = ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(labels.items()))
+    return '{'+text+'}'
+
+
+def _prometheus_name(name):
+    return PROMETHEUS_PREFIX + re.sub('[^a-zA-Z0-9_]', '_', name)
+
+
+# Metrics in the Prometheus text exposition format. Counters are
+# <name>_total, timers <name>_seconds_sum, _count and _max.
+def to_prometheus(metrics=None):
+    metrics = snapshot() if metrics == None else metrics
+    lines = []
+    typed = set()
+    for c in metrics['counters']:
+        name = _prometheus_name(c['name'])+'_total'
+        if name not in typed:
+            lines.append('# TYPE {} counter'.format(name))
+            typed.add(name)
+        lines.append('{}{} {}'.format(name, _prometheus_labels(c['labels']), c['value']))
+    for t in metrics['timers']:
+        name = _prometheus_name(t['name'])+'_seconds'
+        labels = _prometheus_labels(t['labels'])
+        if name not in typed:
+            lines.append('# TYPE {} summary'.format(name))
+            typed.add(name)
+        lines.append('{}_sum{} {}'.format(name, labels, t['seconds']))
+        lines.append('{}_count{} {}'.format(name, labels, t['calls']))
+        lines.append('{}_max{} {}'.format(name, labels, t['max_seconds']))
+    return '\n'.join(lines)+'\n'
+
+
+# Save the metrics as json, or in the Prometheus text format if file_path
+# ends in .prom. The file is replaced at once so a collector reading it
+# never sees half of it.
+def write_metrics(file_path):
+    metrics = snapshot()
+    text = to_prometheus(metrics) if file_path.endswith('.prom') else json.dumps(metrics, indent=4)
+    tmp_path = file_path+'.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, file_path)
+
+
+# Print the timers taking the most time in total
+def print_summary(top=15):
+    timers = sorted(snapshot()['timers'], key=lambda t: -t['seconds'])
+    if len(timers) == 0:
+        return
+    print("\n{:<24} {:<32} {:>7} {:>10} {:>10}".format('timer', 'labels', 'calls', 'seconds', 'max'))
+    for t in timers[:top]:
+        labels = ','.join('{}={}'.format(k, v) for k, v in t['labels'].items())
+        print("{:<24} {:<32} {:>7} {:>10.3f} {:>10.3f}".format(t['name'], labels, t['calls'], t['seconds'], t['max_seconds']))
+
+
+
+# Run a block under cProfile. The stats are saved to file_path for
+# snakeviz or pstats if given, and the top functions are printed.
+@contextlib.contextmanager
+def profile(file_path=None, top=25):
+    import pstats
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if file_path != None:
+            profiler.dump_stats(file_path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(top)
+
+
+
+# Binary file object which counts the bytes read from it
+class CountingReader:
+
+    def __init__(self, f, name, **labels):
+        self.f = f
+        self.name = name
+        self.labels = labels
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        count(self.name, len(data), **self.labels)
+        return data
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+
+# Command line entry point running the data pipeline from a config file
+# instead of editing the flags in the __main__ of each script:
+#
+#   fetch -> flag -> impute -> merge -> combine -> prep_for_MEM
+#
+#   fetch         get_regional_demands.py, query EIA for all regions
+#   flag          anomaly_flags.py, flag anomalies of the usable BAs
+#   impute        simple_mean_impute.py, mean impute the BA files and/or
+#                 the master file normally sent for MICE imputations
+#   merge         add the MICE imputations to the BA files
+#   combine       combine the BAs into the regions, interconnects and CONUS
+#                 and write the files for MEM of the for_MEM regions
+#   prep_for_MEM  write the files for MEM of other, existing, region files
+#
+# Usage:
+#   ./pipeline.py [--config pipeline.json] [--deps] [--force] [--dry-run] [stage ...]
+#   ./pipeline.py --print-config > pipeline.json
+#   ./pipeline.py --metrics metrics.prom --profile pipeline.prof
+#
+# With no stages all stages are run. --deps also runs the stages the given
+# stages depend on. The config file only needs the settings which differ
+# from DEFAULT_CONFIG.
+#
+# Each stage is split into jobs, such as one per BA file. A job is skipped
+# if its settings and the fingerprints of its input files are the same as
+# when it last ran and its outputs exist. Fingerprints are the size and
+# modification time of the files, or their sha256 with "fingerprint": "hash".
+# They are kept in the state_file.
+#
+# The per-region work of fetch, impute, merge and prep_for_MEM is spread
+# over a pool of processes, as many as the machine has cores when
+# max_workers is null. Only file paths and small results are sent to the
+# processes, the data is read from the region files or, for merge, from
+# memory mapped copies of the master columns. combine runs once all the
+# files it sums are written.
+#
+# The time of each stage, job, region and EIA request, and counts such as
+# rows written and MISSING, EMPTY, negative and imputed hours, are saved to
+# the --metrics file as json, or in the Prometheus text format if it ends
+# in .prom, see metrics.py. --profile runs the pipeline under cProfile.
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import datetime
+import concurrent.futures
+
+import ba_mapping
+import metrics
+
+# The scripts of each stage are imported by its job builder below, so only
+# the stages which are run pay for importing them, numpy and pandas
+
+
+
+DEFAULT_CONFIG = {
+    'state_file' : '.pipeline_state.json',
+    'fingerprint' : 'mtime',
+    'fetch' : {
+        'data_dir' : 'data/',
+        'start' : '2015-07-01', # EIA demand data starts in July of 2015
+        'end' : '2019-09-01',
+        'max_workers' : 8,
+        # Parse and write the regions in processes instead of threads
+        'processes' : True,
+        'incremental' : False,
+        'revision_hours' : 72,
+        'store' : False,
+        'resume' : True,
+    },
+    'flag' : {
+        'data_dir' : 'data/',
+        'checks' : ['NEGATIVE', 'ZERO', 'RUN', 'SPIKE', 'FORECAST'],
+        'store_name' : 'anomaly_flags',
+    },
+    'impute' : {
+        # Simple anomaly ID and mean imputation of the BA and region files
+        'simple' : False,
+        'base' : 'data2/',
+        'checks' : ['NEGATIVE'],
+        # Flags saved by the flag stage, or null to flag the files here.
+        # BAs or hours missing from the flags are flagged here as well.
+        'flags' : 'anomaly_flags',
+        # Processes of each stage, null for one per core
+        'max_workers' : None,
+        # The master file normally sent for MICE imputations, set to null to skip
+        'master' : '~/tmp_data4/csv_MASTER_XXX_v12_2day.csv',
+        'strategies' : ['mean'],
+    },
+    'merge' : {
+        'mice_file' : '~/tmp_data4/csv_MASTER_XXX_v12_2day_mean_impute.csv',
+        'input_dir' : 'data5/',
+        'output_dir' : 'data5_out2/',
+        'max_workers' : None,
+        # The BA files are written by processes sharing the master columns
+        # through memory mapped files, or by threads if false
+        'processes' : True,
+    },
+    'combine' : {
+        'data_dir' : 'data5_out2/',
+        # 'mice' for the MICE imputed BAs, 'simple' for the mean imputed BAs
+        # or 'raw' for the data as queried from EIA
+        'mode' : 'mice',
+        # New regions whose files for MEM are written as they are combined,
+        # in each of the formats, see combine_regional_files.export_for_MEM
+        'for_MEM' : ['EASTERN_from_BAs', 'TEXAS_from_BAs', 'WESTERN_from_BAs', 'CONUS_from_BAs'],
+        'formats' : ['csv'],
+        # Also write the new regions, with the status of each hour, to the
+        # region store, see combine_regional_files.STORE
+        'store' : False,
+    },
+    'prep_for_MEM' : {
+        'data_dir' : 'data5_out2/',
+        'regions' : [],
+        'formats' : ['csv'],
+        'max_workers' : None,
+    },
+}
+
+STAGES = ['fetch', 'flag', 'impute', 'merge', 'combine', 'prep_for_MEM']
+DEPENDS = {
+    'fetch' : [],
+    'flag' : ['fetch'],
+    'impute' : ['flag'],
+    'merge' : ['impute'],
+    'combine' : ['merge'],
+    'prep_for_MEM' : ['combine'],
+}
+
+
+
+# Defaults updated with the settings of a config file
+def load_config(file_path=None):
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    if file_path == None:
+        return config
+    with open(file_path, 'r') as f:
+        user_config = json.load(f)
+    for key, value in user_config.items():
+        if key not in config:
+            raise ValueError("Unknown setting '{}' in {}".format(key, file_path))
+        if isinstance(config[key], dict):
+            config[key].update(value)
+        else:
+            config[key] = value
+    return config
+
+
+def load_state(file_path):
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+
+def save_state(file_path, state):
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, sort_keys=True, indent=4)
+    os.replace(tmp_path, file_path)
+
+
+def file_fingerprint(file_path, method='mtime'):
+    if not os.path.exists(file_path):
+        return None
+    if method == 'hash':
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def job_fingerprint(settings, inputs, method='mtime'):
+    info = {'settings' : settings, 'inputs' : {path : file_fingerprint(path, method) for path in inputs}}
+    return hashlib.sha256(json.dumps(info, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Number of processes of a stage, the cores of the machine if not set
+def stage_workers(settings):
+    return settings['max_workers'] or os.cpu_count() or 1
+
+
+# Call function with each of the argument lists in a pool of max_workers
+# processes, or one after the other if max_workers is 1. function and its
+# arguments are pickled so they are kept to file paths and settings.
+# Returns the results in order, the metrics recorded by the processes are
+# added to those of the pipeline.
+def fan_out(function, arg_lists, max_workers):
+    if max_workers <= 1 or len(arg_lists) <= 1:
+        return [function(*args) for args in arg_lists]
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(max_workers, len(arg_lists))) as executor:
+        for result, worker_metrics in executor.map(metrics.collect, [function]*len(arg_lists), *zip(*arg_lists)):
+            results.append(result)
+            metrics.merge(worker_metrics)
+    return results
+
+
+# A unit of work of a stage. inputs and outputs are file paths, with
+# always=True the job runs every time.
+def job(name, inputs, outputs, run, always=False):
+    return {'name' : name, 'inputs' : inputs, 'outputs' : outputs, 'run' : run, 'always' : always}
+
+
+
+# Each stage returns its jobs, and optionally a function which runs a
+# list of them at once. Otherwise the jobs are run one by one.
+
+def fetch_jobs(settings):
+    import get_regional_demands as grd
+
+    def run():
+        grd.DATA_DIR = settings['data_dir']
+        os.makedirs(grd.DATA_DIR, exist_ok=True)
+        start = datetime.date.fromisoformat(settings['start'])
+        end = datetime.date.fromisoformat(settings['end'])
+        regions_data = grd.get_regions_data()
+        failed = grd.fetch_all_regions(regions_data['category']['childcategories'],
+                grd.generate_full_time_series(start, end), settings['max_workers'],
+                settings['incremental'], settings['revision_hours'], settings['store'], settings['resume'],
+                settings['processes'])
+        if len(failed) > 0:
+            raise RuntimeError("Failed regions: {}".format([region['name'] for region in failed]))
+
+    # Incremental updates pick up new hours so they always run
+    return [job('regions', [], [], run, always=settings['incremental'])], None
+
+
+def flag_jobs(settings):
+    import region_store
+    import anomaly_flags
+    BAs = [BA for BA in ba_mapping.usable_BAs() if os.path.exists(settings['data_dir']+BA+'.csv')]
+    checks = 0
+    for name in settings['checks']:
+        checks |= getattr(anomaly_flags, name)
+
+    def run():
+        if len(BAs) == 0:
+            print("No BA files to flag in {}".format(settings['data_dir']))
+            return
+        print(f"Flagging anomalies of {len(BAs)} BAs")
+        hours, demand, forecast = anomaly_flags.load_demand_matrix(BAs, settings['data_dir'])
+        anomaly_flags.write_flags(settings['store_name'], hours, BAs,
+                anomaly_flags.flag_anomalies(demand, forecast, checks=checks))
+
+    outputs = [os.path.join(region_store.STORE_DIR, settings['store_name'], 'flags.npy')]
+    return [job('BAs', [settings['data_dir']+BA+'.csv' for BA in BAs], outputs, run)], None
+
+
+def impute_jobs(settings):
+    import pandas as pd
+    import region_store
+    import anomaly_flags
+    import simple_mean_impute
+    jobs = []
+    checks = 0
+    for name in settings['checks']:
+        checks |= getattr(anomaly_flags, name)
+
+    flags = []
+    if settings['flags'] != None:
+        flags = [os.path.join(region_store.STORE_DIR, settings['flags'], 'flags.npy')]
+
+    if settings['simple']:
+        base = settings['base']
+        for reg in ba_mapping.usable_BAs() + ba_mapping.usable_regions():
+            jobs.append(job(reg, [base+reg+'.csv'] + flags, [base+reg+'_mean_impute.csv'], None))
+
+    if settings['master'] != None:
+        master_in = os.path.expanduser(settings['master'])
+        master_out = master_in.replace('.csv', '_{}_impute.csv'.format('_'.join(settings['strategies'])))
+
+        def run_master():
+            all_BAs = ba_mapping.usable_BAs()
+            print(f"Running complex anomaly ID and simple impute over {len(all_BAs)} BAs with {settings['strategies']}.")
+            master = pd.read_csv(master_in)
+            if settings['strategies'] == ['mean']:
+                master = simple_mean_impute.impute_columns_with_mean(master, all_BAs)
+            else:
+                master = simple_mean_impute.impute_columns(master, all_BAs, settings['strategies'])
+            master.to_csv(master_out, index=False, na_rep=0)
+
+        jobs.append(job('master', [master_in], [master_out], run_master))
+
+    def run_jobs(to_run):
+        regions = [j['name'] for j in to_run if j['run'] == None]
+        if len(regions) > 0:
+            simple_mean_impute.mean_impute_files(settings['base'], regions, stage_workers(settings), checks, settings['flags'])
+        for j in to_run:
+            if j['run'] != None:
+                j['run']()
+
+    return jobs, run_jobs
+
+
+def merge_jobs(settings):
+    import combine_regional_files as crf
+    mice_file = os.path.expanduser(settings['mice_file'])
+    jobs = [job(BA, [mice_file, settings['input_dir']+BA+'.csv'], [settings['output_dir']+BA+'.csv'], None)
+            for BA in ba_mapping.usable_BAs()]
+
+    # The master file is read once for all BAs which need updating
+    def run_jobs(to_run):
+        crf.MICE_INPUT_DIR = settings['input_dir']
+        crf.DATA_DIR = settings['output_dir']
+        crf.add_MICE_imputations_to_many_files(mice_file, [j['name'] for j in to_run],
+                stage_workers(settings), settings['processes'])
+
+    return jobs, run_jobs
+
+
+def combine_jobs(settings):
+    import combine_regional_files as crf
+    mode = settings['mode']
+    if mode == 'mice':
+        groups = crf.return_hierarchy()
+        members = [leaf for node in groups for leaf in crf.hierarchy_leaves(groups, node)]
+        outputs = list(groups.keys()) + ['CONUS_from_BAs']
+    elif mode == 'simple':
+        groups = crf.return_ICs_from_BAs()
+        members = [region for regions in groups.values() for region in regions]
+        outputs = list(groups.keys())
+    elif mode == 'raw':
+        groups = {**crf.return_ICs_from_REGIONS(), **crf.return_ICs_from_BAs(),
+                **ba_mapping.BAs_per_region(), 'CONUS' : crf.return_usable_BAs()}
+        members = [region for regions in groups.values() for region in regions]
+        outputs = list(groups.keys())
+    else:
+        raise ValueError("Unknown combine mode '{}'".format(mode))
+
+    suffix = '_mean_impute' if mode == 'simple' else ''
+    members = [region for region in dict.fromkeys(members) if ba_mapping.is_usable(region)]
+
+    for_MEM = settings['for_MEM']
+
+    def run():
+        crf.DATA_DIR = settings['data_dir']
+        crf.MEM_FORMATS = settings['formats']
+        crf.STORE = settings['store']
+        if mode == 'mice':
+            # CONUS is summed from the interconnects which are summed from the regions
+            crf.combine_hierarchy(groups, False, True, for_MEM)
+            crf.save_copy('CONUS', 'CONUS_from_BAs', True, 'CONUS_from_BAs' in for_MEM)
+        else:
+            crf.combine_many(groups, mode == 'simple', False, for_MEM=for_MEM)
+
+    outputs = [settings['data_dir']+out+suffix+'.csv' for out in outputs]
+    outputs += [settings['data_dir']+out+suffix+'_for_MEM.'+out_format for out in for_MEM for out_format in settings['formats']]
+    # Regions which are built from other new regions, such as TEXAS_from_REGIONS
+    # from TEX, read files the job writes itself. Those are not inputs, as
+    # they change at every run and the job would never be up to date.
+    inputs = [settings['data_dir']+region+suffix+'.csv' for region in members]
+    inputs = [file_path for file_path in inputs if file_path not in outputs]
+    return [job(mode, inputs, outputs, run)], None
+
+
+def prep_for_MEM_jobs(settings):
+    import combine_regional_files as crf
+    jobs = []
+    for region in settings['regions']:
+        file_path = settings['data_dir']+region+'.csv'
+        jobs.append(job(region, [file_path], [file_path.replace('.csv', '_for_MEM.'+out_format) for out_format in settings['formats']], None))
+
+    # The regions are independent so they are written by a pool of processes
+    def run_jobs(to_run):
+        fan_out(crf.prep_for_MEM, [(j['inputs'][0], settings['formats']) for j in to_run], stage_workers(settings))
+
+    return jobs, run_jobs
+
+
+STAGE_JOBS = {
+    'fetch' : fetch_jobs,
+    'flag' : flag_jobs,
+    'impute' : impute_jobs,
+    'merge' : merge_jobs,
+    'combine' : combine_jobs,
+    'prep_for_MEM' : prep_for_MEM_jobs,
+}
+
+
+
+# The stages and all the stages they depend on, in pipeline order
+def with_dependencies(stages):
+    needed = set()
+    def visit(stage):
+        if stage in needed:
+            return
+        needed.add(stage)
+        for dep in DEPENDS[stage]:
+            visit(dep)
+    for stage in stages:
+        visit(stage)
+    return [stage for stage in STAGES if stage in needed]
+
+
+# Run the jobs of a stage whose inputs or settings changed since they last
+# ran. Returns the names of the jobs which ran.
+def run_stage(stage, config, state, force=False, dry_run=False):
+
+    settings = config[stage]
+    method = config['fingerprint']
+    jobs, run_jobs = STAGE_JOBS[stage](settings)
+
+    def key(j):
+        return stage+':'+j['name']
+
+    def is_stale(j):
+        return (force or j['always'] or state.get(key(j)) != job_fingerprint(settings, j['inputs'], method)
+                or not all([os.path.exists(path) for path in j['outputs']]))
+
+    to_run = [j for j in jobs if is_stale(j)]
+    metrics.count('jobs_skipped', len(jobs) - len(to_run), stage=stage)
+    print("{}: {} of {} jobs to run{}".format(stage, len(to_run), len(jobs),
+            ': '+', '.join([j['name'] for j in to_run]) if 0 < len(to_run) <= 20 else ''))
+    if dry_run or len(to_run) == 0:
+        return [j['name'] for j in to_run]
+
+    # Fingerprints are taken after a job ran, so jobs which rewrite
+    # their own inputs do not rerun next time
+    if run_jobs != None:
+        with metrics.timer('stage', stage=stage):
+            run_jobs(to_run)
+        for j in to_run:
+            state[key(j)] = job_fingerprint(settings, j['inputs'], method)
+        save_state(config['state_file'], state)
+    else:
+        for j in to_run:
+            with metrics.timer('stage', stage=stage), metrics.timer('job', stage=stage, job=j['name']):
+                j['run']()
+            state[key(j)] = job_fingerprint(settings, j['inputs'], method)
+            save_state(config['state_file'], state)
+    metrics.count('jobs_run', len(to_run), stage=stage)
+    return [j['name'] for j in to_run]
+
+
+def run_pipeline(config, stages=STAGES, deps=False, force=False, dry_run=False):
+    stages = with_dependencies(stages) if deps else [stage for stage in STAGES if stage in stages]
+    state = load_state(config['state_file'])
+    ran = {}
+    for stage in stages:
+        ran[stage] = run_stage(stage, config, state, force, dry_run)
+    return ran
+
+
+
+if '__main__' in __name__:
+
+    parser = argparse.ArgumentParser(description="Run the EIA demand data pipeline: {}".format(' -> '.join(STAGES)))
+    parser.add_argument('stages', nargs='*', help="stages to run, all if none are given: {}".format(', '.join(STAGES)))
+    parser.add_argument('--config', help="json file of settings which differ from the defaults")
+    parser.add_argument('--deps', action='store_true', help="also run the stages the given stages depend on")
+    parser.add_argument('--force', action='store_true', help="run jobs even if their inputs did not change")
+    parser.add_argument('--dry-run', action='store_true', help="only print which jobs would run")
+    parser.add_argument('--print-config', action='store_true', help="print the config and exit")
+    parser.add_argument('--metrics', help="file the metrics are saved to, json or Prometheus text for .prom")
+    parser.add_argument('--profile', nargs='?', const='', help="run under cProfile and save the stats to this file if given")
+    args = parser.parse_args()
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error("unknown stage '{}', choose from {}".format(stage, ', '.join(STAGES)))
+
+    config = load_config(args.config)
+    if args.print_config:
+        print(json.dumps(config, indent=4))
+        sys.exit(0)
+
+    stages = args.stages if len(args.stages) > 0 else STAGES
+    if args.profile != None:
+        with metrics.profile(args.profile or None):
+            run_pipeline(config, stages, args.deps, args.force, args.dry_run)
+    else:
+        run_pipeline(config, stages, args.deps, args.force, args.dry_run)
+    metrics.print_summary()
+    if args.metrics != None:
+        metrics.write_metrics(args.metrics)
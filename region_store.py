@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+
+# Storage of hourly regional data.
+#
+# A region is held as an int64 column of hours since the epoch (UTC, the
+# EIA hour ending time), one float64 column per value column, such as
+# 'demand (MW)', and a uint8 status column per value column recording
+# whether the hour was MISSING or EMPTY in the EIA data.
+#
+# In memory a region is a Series, which holds these arrays, 13 bytes per
+# hour and column, instead of the csv text, and returns views of them for
+# a range of hours without copying.
+#
+# Regions can be written as the MEM/SEM csv files, or as a columnar binary
+# store with one .npy file per column which can be memory mapped:
+#   store/<region>/hours.npy
+#   store/<region>/<column>.npy
+#   store/<region>/<column>.status.npy
+#   store/<region>/columns.json    column names and their files
+# A wide matrix of one value column for many BAs, with each BA contiguous
+# on disk, can be stored the same way, see write_matrix.
+#
+# load reads a range of hours of some columns of many regions without
+# reading the rest: from the store, or from the csv files with an index of
+# the byte offset of each row, see csv_index.
+#
+# If run as is this converts all csv files in CSV_DIR to the store.
+
+import os
+import re
+import csv
+import json
+import numpy as np
+
+
+
+STORE_DIR = 'store'
+
+# Status codes of each hour of a value column. NEGATIVE and IMPUTED hours
+# have a value, which is negative or was filled in by an imputation.
+OK = 0
+MISSING = 1
+EMPTY = 2
+NEGATIVE = 3
+IMPUTED = 4
+STATUS_TEXT = {MISSING : 'MISSING', EMPTY : 'EMPTY'}
+STATUS_NAMES = {OK : 'OK', MISSING : 'MISSING', EMPTY : 'EMPTY', NEGATIVE : 'NEGATIVE', IMPUTED : 'IMPUTED'}
+
+MEM_FIELDS = ['time', 'year', 'month', 'day', 'hour']
+
+# Suffix of the row index kept next to a csv file, see csv_index
+INDEX_SUFFIX = '.idx.npy'
+
+
+
+# Convert EIA times, such as 20150701T05Z, to integer hours since the epoch.
+# times can be str or bytes. Returns the hours of the correctly formatted
+# times and a mask of which times were correctly formatted.
+def parse_eia_times(times):
+
+    times = np.asarray(times)
+    if times.dtype.kind != 'S':
+        times = times.astype(str)
+    valid = np.char.str_len(times) == 12
+    if times.dtype.kind == 'S':
+        chars = times.astype('S12').view(np.uint8).reshape(-1, 12)
+    else:
+        chars = times.astype('U12').view(np.uint32).reshape(-1, 12)
+
+    digits = chars[:, [0, 1, 2, 3, 4, 5, 6, 7, 9, 10]].astype(np.int64) - ord('0')
+    valid &= np.all((digits >= 0) & (digits <= 9), axis=1)
+    valid &= (chars[:, 8] == ord('T')) & (chars[:, 11] == ord('Z'))
+    digits = digits[valid]
+
+    year = digits[:, 0]*1000 + digits[:, 1]*100 + digits[:, 2]*10 + digits[:, 3]
+    month = digits[:, 4]*10 + digits[:, 5]
+    day = digits[:, 6]*10 + digits[:, 7]
+    hour = digits[:, 8]*10 + digits[:, 9]
+
+    months = ((year - 1970)*12 + month - 1).astype('datetime64[M]')
+    days_in_month = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
+    ok = (month >= 1) & (month <= 12) & (day >= 1) & (day <= days_in_month) & (hour <= 23)
+    valid[valid] = ok
+
+    days = months.astype('datetime64[D]') + (day - 1)
+    hours = days.astype('datetime64[h]').astype(np.int64) + hour
+    return hours[ok], valid
+
+
+
+# Format hours, as datetime64 or integer hours since the epoch,
+# as EIA times such as 20150701T05Z
+def format_eia_times(hours):
+    times = np.datetime_as_string(np.asarray(hours).astype('datetime64[h]'), unit='h')
+    return np.char.add(np.char.replace(times, '-', ''), 'Z')
+
+
+# Hours since the epoch of a time given as an integer hour, an EIA time
+# such as 20150701T05Z, a datetime, a date or a datetime64
+def to_hour(time):
+    if isinstance(time, (int, np.integer)):
+        return int(time)
+    if isinstance(time, (str, bytes)) and len(time) == 12:
+        hours, valid = parse_eia_times([time])
+        if not valid[0]:
+            raise ValueError("Invalid EIA time {}".format(time))
+        return int(hours[0])
+    return int(np.datetime64(time, 'h').astype(np.int64))
+
+
+
+# From EIA form 930 instructions:
+# "Report all data as hourly integrated values in megawatts by hour ending time."
+# Hours are reported as 1-24 in MEM. To align with this, we subtract 1 hour from UTC
+# time so that 20150702T00Z, which is the EIA integrated value between July 1, 23:00
+# and July 2 00:00 is reported as July 1, hour 24.
+# Returns the MEM year, month, day and hour columns.
+def mem_calendar(hours):
+
+    mem_format = np.asarray(hours).astype('datetime64[h]') - np.timedelta64(1, 'h')
+    mem_years = mem_format.astype('datetime64[Y]')
+    mem_months = mem_format.astype('datetime64[M]')
+    mem_days = mem_format.astype('datetime64[D]')
+    year = mem_years.astype(np.int64) + 1970
+    month = (mem_months - mem_years.astype('datetime64[M]')).astype(np.int64) + 1
+    day = (mem_days - mem_months.astype('datetime64[D]')).astype(np.int64) + 1
+    hour = (mem_format - mem_days.astype('datetime64[h]')).astype(np.int64) + 1
+    return year, month, day, hour
+
+
+
+# True for the hours of a status column which have a value
+def has_value(status):
+    return (status == OK) | (status == NEGATIVE) | (status == IMPUTED)
+
+
+
+# Format a column of values for the csv output. Hours with a MISSING or
+# EMPTY status are written as such, or as na_rep if it is given.
+def format_values(values, status, na_rep=None):
+
+    out = np.full(len(values), 'MISSING' if na_rep == None else na_rep, dtype=object)
+    if na_rep == None:
+        out[status == EMPTY] = 'EMPTY'
+
+    ok = has_value(status) & np.isfinite(values)
+    whole = ok & (values == np.floor(values))
+    out[whole] = values[whole].astype(np.int64).astype(str)
+    fractional = ok & ~whole
+    out[fractional] = [repr(value) for value in values[fractional].tolist()]
+    return out
+
+
+
+# Write hourly data as a MEM formatted csv file with the time, year, month,
+# day and hour columns followed by the value columns in the order of columns.
+# With append=True the rows are added to the end of an existing file.
+def write_csv(file_path, hours, columns, status, append=False, na_rep=None):
+
+    year, month, day, hour = mem_calendar(hours)
+    out = [format_eia_times(hours), year.astype(str), month.astype(str), day.astype(str), hour.astype(str)]
+    for name, values in columns.items():
+        out.append(format_values(values, status[name], na_rep))
+    # Python lists are much faster to join than numpy string arrays
+    rows = ''.join([','.join(row)+'\r\n' for row in zip(*[column.tolist() for column in out])])
+
+    with open(file_path, 'a' if append else 'w', newline='') as csvfile:
+        if not append:
+            csvfile.write(','.join(MEM_FIELDS + list(columns.keys()))+'\r\n')
+        csvfile.write(rows)
+
+
+
+# Read a MEM formatted csv file. Returns the hours, the value columns and
+# their status. MISSING and EMPTY keep their status, NA and blank values
+# are read as MISSING. Only the value columns in column_names are read if given.
+def read_csv(file_path, column_names=None):
+
+    with open(file_path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+    return parse_rows(header, rows, column_names)
+
+
+# Hours, value columns and status of the rows of a csv file, only of the
+# value columns in column_names if given
+def parse_rows(header, rows, column_names=None):
+
+    fields = list(zip(*rows)) if len(rows) > 0 else [()] * len(header)
+    hours = parse_eia_times(np.array(fields[0], dtype=str))[0]
+
+    columns = {}
+    status = {}
+    for i, name in enumerate(header):
+        if name in MEM_FIELDS or (column_names != None and name not in column_names):
+            continue
+        text = np.array(fields[i], dtype=object)
+        col_status = np.full(len(text), OK, dtype=np.uint8)
+        col_status[text == 'EMPTY'] = EMPTY
+        col_status[(text == 'MISSING') | (text == 'NA') | (text == '')] = MISSING
+        values = np.full(len(text), np.nan)
+        ok = col_status == OK
+        values[ok] = text[ok].astype(np.float64)
+        columns[name] = values
+        status[name] = col_status
+    return hours, columns, status
+
+
+
+# File name for a column, e.g. 'demand (MW)' is stored as demand_MW.npy
+def column_file(name):
+    return re.sub(r'[^0-9A-Za-z]+', '_', name).strip('_')
+
+
+def _save(path, array):
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def _load(path, mmap):
+    return np.load(path, mmap_mode='r' if mmap else None)
+
+
+
+# The store directory base, or STORE_DIR if it is None. Functions take
+# base=None and call this, so setting STORE_DIR at runtime takes effect.
+def store_base(base=None):
+    return STORE_DIR if base == None else base
+
+
+# Write a region to the columnar store, replacing any previous version
+def write_store(name, hours, columns, status, base=None):
+
+    base = store_base(base)
+    path = os.path.join(base, name)
+    os.makedirs(path, exist_ok=True)
+    _save(os.path.join(path, 'hours.npy'), np.asarray(hours, dtype=np.int64))
+    files = {}
+    for col, values in columns.items():
+        files[col] = column_file(col)
+        _save(os.path.join(path, files[col]+'.npy'), np.asarray(values, dtype=np.float64))
+        _save(os.path.join(path, files[col]+'.status.npy'), np.asarray(status[col], dtype=np.uint8))
+    with open(os.path.join(path, 'columns.json'), 'w') as f:
+        json.dump({'columns' : list(columns.keys()), 'files' : files}, f, indent=4)
+
+
+
+# Read a region from the columnar store. By default the columns are memory
+# mapped, so only the parts which are used are read from disk.
+# Only the value columns in column_names are read if given.
+def read_store(name, base=None, column_names=None, mmap=True):
+
+    base = store_base(base)
+    path = os.path.join(base, name)
+    with open(os.path.join(path, 'columns.json'), 'r') as f:
+        info = json.load(f)
+
+    hours = _load(os.path.join(path, 'hours.npy'), mmap)
+    columns = {}
+    status = {}
+    for col in info['columns']:
+        if column_names != None and col not in column_names:
+            continue
+        columns[col] = _load(os.path.join(path, info['files'][col]+'.npy'), mmap)
+        status[col] = _load(os.path.join(path, info['files'][col]+'.status.npy'), mmap)
+    return hours, columns, status
+
+
+
+# Replace the hours from hours[0] onwards of a stored region with new data.
+# This is used for incremental updates. If the region is not stored yet
+# the new hours are only the end of it, so it is stored from the whole
+# csv file at csv_path, which already has them, if that is given.
+def append_store(name, hours, columns, status, base=None, csv_path=None):
+
+    base = store_base(base)
+    if not os.path.exists(os.path.join(base, name, 'columns.json')):
+        if csv_path != None and os.path.exists(csv_path):
+            return csv_to_store(csv_path, name, base)
+        return write_store(name, hours, columns, status, base)
+    if len(hours) == 0:
+        return
+
+    old_hours, old_columns, old_status = read_store(name, base, mmap=False)
+    keep = old_hours < hours[0]
+    write_store(name, np.concatenate([old_hours[keep], hours]),
+            {col : np.concatenate([old_columns[col][keep], columns[col]]) for col in columns},
+            {col : np.concatenate([old_status[col][keep], status[col]]) for col in columns},
+            base)
+
+
+
+# Write one value column of many BAs as an hours x BAs matrix. The matrix
+# is stored column major so each BA is contiguous and can be read without copying.
+def write_matrix(name, hours, names, values, status, base=None):
+
+    base = store_base(base)
+    path = os.path.join(base, name)
+    os.makedirs(path, exist_ok=True)
+    _save(os.path.join(path, 'hours.npy'), np.asarray(hours, dtype=np.int64))
+    _save(os.path.join(path, 'values.npy'), np.asfortranarray(values, dtype=np.float64))
+    _save(os.path.join(path, 'status.npy'), np.asfortranarray(status, dtype=np.uint8))
+    with open(os.path.join(path, 'columns.json'), 'w') as f:
+        json.dump({'names' : list(names)}, f, indent=4)
+
+
+
+# Read a matrix written by write_matrix. Returns the hours, the BA names,
+# the values and their status.
+def read_matrix(name, base=None, mmap=True):
+
+    base = store_base(base)
+    path = os.path.join(base, name)
+    with open(os.path.join(path, 'columns.json'), 'r') as f:
+        names = json.load(f)['names']
+    return (_load(os.path.join(path, 'hours.npy'), mmap), names,
+            _load(os.path.join(path, 'values.npy'), mmap), _load(os.path.join(path, 'status.npy'), mmap))
+
+
+
+# Hourly data of a region: sorted int hours since the epoch and, for each
+# value column, its values and uint8 status. Slicing, by rows or with
+# between, returns a Series of views of the same arrays without copying.
+class Series:
+
+    def __init__(self, hours, columns, status):
+        self.hours = np.asarray(hours)
+        self.columns = dict(columns)
+        self.status = dict(status)
+
+    @classmethod
+    def from_csv(cls, file_path, column_names=None):
+        return cls(*read_csv(file_path, column_names))
+
+    @classmethod
+    def from_store(cls, name, base=None, column_names=None, mmap=True):
+        return cls(*read_store(name, base, column_names, mmap))
+
+    def to_csv(self, file_path, append=False, na_rep=None):
+        write_csv(file_path, self.hours, self.columns, self.status, append, na_rep)
+
+    def to_store(self, name, base=None, append=False, csv_path=None):
+        if append:
+            append_store(name, self.hours, self.columns, self.status, base, csv_path)
+        else:
+            write_store(name, self.hours, self.columns, self.status, base)
+
+    def __len__(self):
+        return len(self.hours)
+
+    def __getitem__(self, rows):
+        return Series(self.hours[rows], {name : values[rows] for name, values in self.columns.items()},
+                {name : status[rows] for name, status in self.status.items()})
+
+    def names(self):
+        return list(self.columns.keys())
+
+    # The hours, columns and status as returned by read_csv
+    def arrays(self):
+        return self.hours, self.columns, self.status
+
+    # The hours from start up to, but not including, end, see to_hour
+    def between(self, start=None, end=None):
+        first = 0 if start is None else np.searchsorted(self.hours, to_hour(start))
+        last = len(self.hours) if end is None else np.searchsorted(self.hours, to_hour(end))
+        return self[first:max(first, last)]
+
+    # Values of a column with NaN for the hours without a value
+    def masked(self, name):
+        return np.where(has_value(self.status[name]), self.columns[name], np.nan)
+
+    # Give the negative values of the columns, all by default, the NEGATIVE
+    # status. The status arrays are copied if they are read only.
+    def mark_negative(self, names=None):
+        for name in (self.names() if names == None else names):
+            negative = (self.status[name] == OK) & (self.columns[name] < 0)
+            if not self.status[name].flags.writeable:
+                self.status[name] = self.status[name].copy()
+            self.status[name][negative] = NEGATIVE
+        return self
+
+    # Number of hours of a column with each status
+    def count_status(self, name):
+        counts = np.bincount(self.status[name], minlength=len(STATUS_NAMES))
+        return {STATUS_NAMES[code] : int(counts[code]) for code in STATUS_NAMES}
+
+    # A copy with other dtypes, such as int32 hours and float32 values to
+    # halve the memory when full float64 precision is not needed
+    def astype(self, hours_dtype=np.int64, values_dtype=np.float64):
+        return Series(self.hours.astype(hours_dtype), {name : values.astype(values_dtype) for name, values in self.columns.items()},
+                {name : status.copy() for name, status in self.status.items()})
+
+    @property
+    def nbytes(self):
+        return self.hours.nbytes + sum([values.nbytes + self.status[name].nbytes for name, values in self.columns.items()])
+
+    def __repr__(self):
+        if len(self.hours) == 0:
+            return "Series(0 hours, columns {})".format(self.names())
+        first, last = format_eia_times(self.hours[[0, -1]])
+        return "Series({} hours from {} to {}, columns {})".format(len(self.hours), first, last, self.names())
+
+
+
+# Index of the rows of a csv file: the hour of each row, -1 if its time
+# can not be read, the byte offset of each row followed by the end of the
+# last row, and whether the hours are all readable and increasing. It is
+# saved next to the file as <file>.idx.npy, one int64 array of the size and
+# modification time of the file, whether it is ordered, the hours and the
+# offsets, which is memory mapped, so a lookup only reads the pages it
+# searches. It is built again, by reading the file once, when the size or
+# modification time of the file changed.
+def csv_index(file_path):
+
+    index_path = file_path + INDEX_SUFFIX
+    stat = os.stat(file_path)
+    key = [stat.st_size, stat.st_mtime_ns]
+    if os.path.exists(index_path):
+        try:
+            index = np.load(index_path, mmap_mode='r')
+            if index[:2].tolist() == key:
+                n = (len(index) - 4) // 2
+                return index[3:3+n], index[3+n:], bool(index[2])
+        except (OSError, ValueError):
+            pass
+
+    with open(file_path, 'rb') as f:
+        data = np.frombuffer(f.read(), dtype=np.uint8)
+    offsets = np.flatnonzero(data == ord('\n')) + 1
+    if len(data) > 0 and data[-1] != ord('\n'):
+        offsets = np.append(offsets, len(data))
+    # The first line is the header
+    starts = offsets[:-1]
+    chars = data[np.minimum(starts[:, None] + np.arange(13), max(len(data)-1, 0))] if len(data) > 0 else np.zeros((0, 13), dtype=np.uint8)
+    hours, valid = parse_eia_times(np.ascontiguousarray(chars[:, :12]).view('S12').ravel())
+    hours = np.where(valid & (chars[:, 12] == ord(',')), hours, -1)
+    ordered = bool((hours >= 0).all() and (np.diff(hours) > 0).all())
+
+    try:
+        _save(index_path, np.concatenate([key, [ordered], hours, offsets]).astype(np.int64))
+    except OSError:
+        pass # The index is only kept in memory where it can not be saved
+    return hours, offsets, ordered
+
+
+# Read the rows of a csv file from the hour start up to, but not including,
+# end, see to_hour. Only the bytes of those rows are read, found with the
+# csv_index of the file, and only the value columns in column_names are
+# parsed if given. Returns the same as read_csv.
+def read_csv_range(file_path, start=None, end=None, column_names=None):
+
+    hours, offsets, ordered = csv_index(file_path)
+    if not ordered:
+        # Rows out of order or with unreadable times are read in full
+        series = Series(*read_csv(file_path, column_names))
+        keep = np.ones(len(series), dtype=bool)
+        if start is not None:
+            keep &= series.hours >= to_hour(start)
+        if end is not None:
+            keep &= series.hours < to_hour(end)
+        return series[keep].arrays()
+
+    first = 0 if start is None else int(np.searchsorted(hours, to_hour(start)))
+    last = len(hours) if end is None else max(first, int(np.searchsorted(hours, to_hour(end))))
+    with open(file_path, 'rb') as f:
+        header = next(csv.reader([f.readline().decode('utf-8')]))
+        f.seek(offsets[first])
+        text = f.read(offsets[last] - offsets[first]).decode('utf-8')
+    return parse_rows(header, list(csv.reader(text.splitlines())), column_names)
+
+
+# True if the store of a region was written after its csv file and has
+# the same hours, as a store written from only part of the csv file is
+# newer but does not have all of its rows. The hours are compared by their
+# number, first and last with the csv_index of the file.
+def store_is_current(name, file_path, base=None):
+    base = store_base(base)
+    columns_path = os.path.join(base, name, 'columns.json')
+    if not os.path.exists(columns_path):
+        return False
+    if not os.path.exists(file_path):
+        return True
+    if os.stat(columns_path).st_mtime_ns < os.stat(file_path).st_mtime_ns:
+        return False
+    hours = _load(os.path.join(base, name, 'hours.npy'), True)
+    csv_hours = csv_index(file_path)[0]
+    if len(hours) != len(csv_hours):
+        return False
+    return len(hours) == 0 or (hours[0] == csv_hours[0] and hours[-1] == csv_hours[-1])
+
+
+# The hours from start up to, but not including, end of the columns, all
+# by default, of many regions, see to_hour. Only the data of those hours
+# and columns is read: from the store in base, which is memory mapped, if
+# it is current with the csv file of the region, see store_is_current,
+# otherwise from the csv file in data_dir, see read_csv_range. Set
+# use_store to False to only use the csv files.
+# Returns a Series for each region.
+#   load(['CISO', 'BANC'], '2019-07-01', '2019-07-08', ['demand (MW)'])
+def load(regions, start=None, end=None, columns=None, data_dir='data/', base=None, use_store=True):
+
+    base = store_base(base)
+    if isinstance(regions, str):
+        regions = [regions]
+    series = {}
+    for region in regions:
+        file_path = os.path.join(data_dir, region+'.csv')
+        if use_store and store_is_current(region, file_path, base):
+            series[region] = Series.from_store(region, base, columns).between(start, end)
+        else:
+            series[region] = Series(*read_csv_range(file_path, start, end, columns))
+    return series
+
+
+
+# Convert a csv file to the store and back
+def csv_to_store(file_path, name, base=None):
+    write_store(name, *read_csv(file_path), base)
+
+
+def store_to_csv(name, file_path, base=None, na_rep=None):
+    write_csv(file_path, *read_store(name, base), na_rep=na_rep)
+
+
+
+if '__main__' in __name__:
+
+    CSV_DIR = 'data'
+    for file_name in sorted(os.listdir(CSV_DIR)):
+        if not file_name.endswith('.csv') or file_name == 'balancing_authority_acronyms.csv':
+            continue
+        print("Converting {} to {}/{}".format(file_name, STORE_DIR, file_name[:-4]))
+        csv_to_store(os.path.join(CSV_DIR, file_name), file_name[:-4])
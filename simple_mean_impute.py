@@ -9,12 +9,22 @@
 #
 
 
-import pandas as pd
+import os
 import numpy as np
+import concurrent.futures
+
+import region_store
+import ba_mapping
+import anomaly_flags
+import metrics
+
+# pandas is imported where data frames are made, so the imputation
+# strategies, which only use numpy, can be used without it
 
 
 
 def get_file(file_path):
+    import pandas as pd
     df = pd.read_csv(file_path,
         dtype={'demand (MW)':np.float64},
         parse_dates=True, na_values=['MISSING', 'EMPTY'])
@@ -22,94 +32,264 @@ def get_file(file_path):
     return df
 
 
+# Same as get_file, but load the region from the columnar region_store
+# instead of parsing its csv file
+def get_store_file(region, base=None):
+    import pandas as pd
+    series = region_store.Series.from_store(region, base)
+    year, month, day, hour = region_store.mem_calendar(series.hours)
+    df = pd.DataFrame({'time' : region_store.format_eia_times(series.hours),
+        'year' : year, 'month' : month, 'day' : day, 'hour' : hour})
+    for name in series.names():
+        df[name] = series.masked(name)
+
+    return df
+
+
 def set_negative_to_NA(df):
     df['demand (MW)'] = df['demand (MW)'].mask(df['demand (MW)'] < 0.)
     return df
 
 
+# Set the demand of hours flagged by the checks of anomaly_flags to NA.
+# With checks=anomaly_flags.NEGATIVE this is the same as set_negative_to_NA.
+# flags can be the flags of the rows of df saved by anomaly_flags, see
+# stored_flags, otherwise the rows are flagged here.
+def set_flagged_to_NA(df, checks=anomaly_flags.ALL_FLAGS, flags=None):
+    if flags is None:
+        forecast = None
+        if 'forecast demand (MW)' in df.columns:
+            forecast = df['forecast demand (MW)'].to_numpy(dtype=np.float64)
+        flags = anomaly_flags.flag_anomalies(df['demand (MW)'].to_numpy(dtype=np.float64), forecast, checks=checks)[:, 0]
+    df['demand (MW)'] = df['demand (MW)'].mask((flags & checks) != 0)
+    return df
+
+
+# Flags of the rows of df of region from the flags store name of
+# anomaly_flags, or None if the store does not have region or all of
+# the hours of df
+def stored_flags(df, region, name, base=None):
+    base = region_store.store_base(base)
+    if not os.path.exists(os.path.join(base, name, 'columns.json')):
+        return None
+    hours, names, flags = anomaly_flags.read_flags(name, base)
+    if region not in names:
+        return None
+    df_hours = frame_hours(df)
+    rows = np.minimum(np.searchsorted(hours, df_hours), len(hours)-1)
+    if len(hours) == 0 or (hours[rows] != df_hours).any():
+        return None
+    return np.asarray(flags[rows, names.index(region)])
+
+
+def flagged_message(region, num_nans, num_rows):
+    return "{}: number NANs initially {} for {}pct flagged".format(region, num_nans, round(num_nans/num_rows*100., 4))
+
+
 def impute_with_mean(df, region, col_to_impute='demand (MW)'):
     num_nans = df[col_to_impute].isna().sum()
     mean = np.nanmean(df[col_to_impute])
     df[col_to_impute] = df[col_to_impute].fillna(mean)
-    print("{}: number NANs initially {} for {}pct flagged".format(region, num_nans, round(num_nans/len(df.index)*100., 4)))
+    metrics.count('hours_imputed', int(num_nans), region=region, column=col_to_impute)
+    print(flagged_message(region, num_nans, len(df.index)))
     return df
 
 
+# Imputation strategies over an (hours x BAs) matrix of values with NANs
+# for the hours to impute. Each strategy fills what it can of the NANs
+# in place for all BAs at once and leaves the rest as NANs. hours are
+# integer hours since the epoch (UTC) of the rows.
+# Strategies are chained in impute_matrix, so for example short gaps can be
+# interpolated, longer ones filled with the hourly profile and any
+# remaining ones with the mean.
+
+# Mean of the whole series, as in impute_with_mean
+def fill_mean(values, hours):
+    nans = np.isnan(values)
+    np.copyto(values, np.nanmean(values, axis=0), where=nans)
+    return values
+
+
+# Mean of the same hour of day and day of week (UTC) over the whole series
+def fill_profile(values, hours):
+    days = hours // 24
+    # 1 Jan 1970 was a Thursday, this makes Monday day 0
+    bins, row_bin = np.unique((days + 3) % 7 * 24 + hours % 24, return_inverse=True)
+    order = np.argsort(row_bin, kind='stable')
+    starts = np.searchsorted(row_bin[order], np.arange(len(bins)))
+    nans = np.isnan(values)
+    sums = np.add.reduceat(np.where(nans, 0., values)[order], starts, axis=0)
+    counts = np.add.reduceat((~nans)[order].astype(np.int64), starts, axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        profile = sums / counts
+    np.copyto(values, profile[row_bin], where=nans)
+    return values
+
+
+# Linear interpolation across gaps of up to max_gap hours between two
+# reported values. Longer gaps and those at the ends are left as NANs.
+def fill_interpolate(values, hours, max_gap=6):
+    n = len(values)
+    if n == 0:
+        return values
+    nans = np.isnan(values)
+    rows = np.arange(n)[:, np.newaxis]
+    prev_row = np.maximum.accumulate(np.where(nans, -1, rows), axis=0)
+    next_row = np.minimum.accumulate(np.where(nans, n, rows)[::-1], axis=0)[::-1]
+
+    fill = nans & (prev_row >= 0) & (next_row < n)
+    gap = np.where(fill, hours[np.minimum(next_row, n-1)] - hours[np.maximum(prev_row, 0)] - 1, 0)
+    fill &= gap <= max_gap
+    prev_value = np.take_along_axis(values, np.maximum(prev_row, 0), axis=0)
+    next_value = np.take_along_axis(values, np.minimum(next_row, n-1), axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = (hours[:, np.newaxis] - hours[np.maximum(prev_row, 0)]) / (gap + 1)
+    np.copyto(values, prev_value + (next_value - prev_value) * frac, where=fill)
+    return values
+
+
+# Mean of the reported values within window hours either side
+def fill_rolling(values, hours, window=84):
+    nans = np.isnan(values)
+    sums = np.vstack([np.zeros((1, values.shape[1])), np.cumsum(np.where(nans, 0., values), axis=0)])
+    counts = np.vstack([np.zeros((1, values.shape[1]), dtype=np.int64), np.cumsum(~nans, axis=0)])
+    lo = np.searchsorted(hours, hours - window, side='left')
+    hi = np.searchsorted(hours, hours + window, side='right')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rolling = (sums[hi] - sums[lo]) / (counts[hi] - counts[lo])
+    np.copyto(values, rolling, where=nans)
+    return values
+
+
+# Strategies by name. Others can be added, they take the values and hours
+# and fill the NANs of values in place. Use functools.partial to change
+# the max_gap or window of a strategy.
+IMPUTATION_STRATEGIES = {
+    'mean' : fill_mean,
+    'profile' : fill_profile,
+    'interpolate' : fill_interpolate,
+    'rolling' : fill_rolling,
+}
+
+
+# Fill the NANs of an (hours x BAs) matrix with each strategy in turn.
+# hours must be sorted. Returns a new column major matrix.
+def impute_matrix(values, hours, strategies=['mean']):
+    values = np.asfortranarray(np.array(values, dtype=np.float64))
+    hours = np.asarray(hours, dtype=np.int64)
+    for strategy in strategies:
+        if not np.isnan(values).any():
+            break
+        strategy = IMPUTATION_STRATEGIES[strategy] if isinstance(strategy, str) else strategy
+        values = strategy(values, hours)
+    return values
+
+
+# Integer hours since the epoch of the rows of a region file or MICE master.
+# Rows without a time column are taken as consecutive hours.
+def frame_hours(df):
+    if 'time' in df.columns:
+        return region_store.parse_eia_times(df['time'].to_numpy(dtype=str))[0]
+    if 'date_time' in df.columns:
+        import pandas as pd
+        return pd.to_datetime(df['date_time']).to_numpy().astype('datetime64[h]').astype(np.int64)
+    return np.arange(len(df.index), dtype=np.int64)
+
+
+# Impute the columns in cols of df with the strategies, see impute_matrix.
+# The NAN counts and fills are done for all columns in one pass over a
+# column major copy of the values, so with the mean strategy each column
+# is summed the same way as in impute_with_mean.
+# Columns without NANs are left untouched, keeping their dtype. With
+# report=False the NAN counts are neither printed nor counted in metrics,
+# and with return_counts=True they are returned along with df.
+def impute_columns(df, cols, strategies=['mean'], hours=None, report=True, return_counts=False):
+    hours = frame_hours(df) if hours is None else hours
+    values = df[cols].to_numpy(dtype=np.float64)
+    num_nans = np.isnan(values).sum(axis=0)
+    values = impute_matrix(values, hours, strategies)
+
+    to_fill = num_nans > 0
+    if to_fill.any():
+        df[[col for col, fill in zip(cols, to_fill) if fill]] = values[:, to_fill]
+    for col, n in zip(cols, num_nans):
+        if report:
+            metrics.count('hours_imputed', int(n), column=col)
+            print(flagged_message(col, n, len(df.index)))
+    return (df, num_nans) if return_counts else df
+
+
+# Same as calling impute_with_mean for each column in cols
+def impute_columns_with_mean(df, cols, report=True, return_counts=False):
+    return impute_columns(df, cols, ['mean'], np.arange(len(df.index)), report, return_counts)
+
+
+# Anomaly ID and mean imputation of one region file, by default only
+# negative demand is set to NA. With flags_name the flags saved by
+# anomaly_flags are used if they cover the region, see stored_flags.
+# Returns the region, its number of NANs and rows for the report.
+def mean_impute_file(base, region, checks=anomaly_flags.NEGATIVE, flags_name=None):
+    df = get_file(base+region+'.csv')
+    flags = None if flags_name == None else stored_flags(df, region, flags_name)
+    df = set_flagged_to_NA(df, checks, flags)
+    # Reported by mean_impute_files, in the order of the regions
+    df, num_nans = impute_columns_with_mean(df, ['demand (MW)'], report=False, return_counts=True)
+    df.to_csv(base+region+'_mean_impute.csv', index=False, na_rep=0)
+    return region, num_nans[0], len(df.index)
+
+
+# Run mean_impute_file for all regions. With max_workers > 1 the files are
+# done in a process pool. The report is printed in the order of regions
+# and the imputed hours of each are counted in metrics.
+def mean_impute_files(base, regions, max_workers=1, checks=anomaly_flags.NEGATIVE, flags_name=None):
+    def report(results):
+        for region, num_nans, num_rows in results:
+            metrics.count('hours_imputed', int(num_nans), region=region, column='demand (MW)')
+            print(flagged_message(region, num_nans, num_rows))
+    with metrics.timer('impute_files', files=len(regions)):
+        if max_workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+                report(executor.map(mean_impute_file, [base]*len(regions), regions, [checks]*len(regions),
+                        [flags_name]*len(regions)))
+        else:
+            report(mean_impute_file(base, region, checks, flags_name) for region in regions)
+
+
 if '__main__' in __name__:
+    import pandas as pd
     base = 'data2/'
-    all_BAs = [
-                # BAs
-                'AEC', 'AECI', 'CPLE', 'CPLW',
-                'DUK', 'FMPP', 'FPC',
-                'FPL', 'GVL', 'HST', 'ISNE',
-                'JEA', 'LGEE', 'MISO', 'NSB',
-                'NYIS', 'PJM', 'SC',
-                'SCEG', 'SOCO',
-                'SPA', 'SWPP', 'TAL', 'TEC',
-                'TVA',
-                'ERCO',
-                'AVA', 'AZPS', 'BANC', 'BPAT',
-                'CHPD', 'CISO', 'DOPD',
-                'EPE', 'GCPD',
-                'IID',
-                'IPCO', 'LDWP', 'NEVP', 'NWMT',
-                'PACE', 'PACW', 'PGE', 'PNM',
-                'PSCO', 'PSEI', 'SCL', 'SRP',
-                'TEPC', 'TIDC', 'TPWR', 'WACM',
-                'WALC', 'WAUW',
-                # 'OVEC', 'SEC', # These two do not perform well and we are removing
-                # them from the imputation and comparisons.
-            ]
-    all_BAs_and_regions = [
-                # BAs
-                'AEC', 'AECI', 'CPLE', 'CPLW',
-                'DUK', 'FMPP', 'FPC',
-                'FPL', 'GVL', 'HST', 'ISNE',
-                'JEA', 'LGEE', 'MISO', 'NSB',
-                'NYIS', 'PJM', 'SC',
-                'SCEG', 'SOCO',
-                'SPA', 'SWPP', 'TAL', 'TEC',
-                'TVA',
-                'ERCO',
-                'AVA', 'AZPS', 'BANC', 'BPAT',
-                'CHPD', 'CISO', 'DOPD',
-                'EPE', 'GCPD',
-                'IID',
-                'IPCO', 'LDWP', 'NEVP', 'NWMT',
-                'PACE', 'PACW', 'PGE', 'PNM',
-                'PSCO', 'PSEI', 'SCL', 'SRP',
-                'TEPC', 'TIDC', 'TPWR', 'WACM',
-                'WALC', 'WAUW',
-                # 'OVEC', 'SEC', # These two do not perform well and we are removing
-                # them from the imputation and comparisons.
-
-                # Regions
-                'CENT', 'MIDW', 'TEN', 'SE', 'FLA', 'CAR', 'MIDA', 'NY', 'NE',
-                'TEX',
-                'CAL', 'NW', 'SW'
-            ]
+    # 'OVEC' and 'SEC' do not perform well and are removed
+    # from the imputation and comparisons, see ba_mapping.USABLE_BAS
+    all_BAs = ba_mapping.usable_BAs()
+    all_BAs_and_regions = ba_mapping.usable_BAs() + ba_mapping.usable_regions()
 
     print(f"{len(all_BAs_and_regions)} BAs and regions")
 
     do_simple = False
+    # Number of processes for do_simple, 1 runs the files serially
+    max_workers = 1
+    # Anomaly checks for do_simple, see anomaly_flags, for example
+    # anomaly_flags.ALL_FLAGS. By default only negative demand is removed.
+    anomaly_checks = anomaly_flags.NEGATIVE
     print(f"do simple anomaly ID and simple impute: {do_simple}")
     if do_simple:
-        for reg in all_BAs_and_regions:
-            df = get_file(base+reg+'.csv')
-            df = set_negative_to_NA(df)
-            df = impute_with_mean(df, reg)
-            #print(df.head())
-            df.to_csv(base+reg+'_mean_impute.csv', index=False, na_rep=0)
+        mean_impute_files(base, all_BAs_and_regions, max_workers, anomaly_checks)
 
     # This portion takes the output file that I normally sent to Dave for MICE imputations.
     do_complex = True
+    # Imputation strategies applied in turn, see IMPUTATION_STRATEGIES,
+    # for example ['interpolate', 'profile', 'mean']
+    strategies = ['mean']
     print(f"do complex anomaly ID and simple impute: {do_complex}")
     if do_complex:
-        print(f"Running complex anomaly ID and simple impute over {len(all_BAs)} BAs.")
+        print(f"Running complex anomaly ID and simple impute over {len(all_BAs)} BAs with {strategies}.")
         master = pd.read_csv('/Users/truggles/tmp_data4/csv_MASTER_XXX_v12_2day.csv')
-        for reg in all_BAs:
-            master = impute_with_mean(master, reg, reg)
-        master.to_csv('/Users/truggles/tmp_data4/csv_MASTER_XXX_v12_2day_mean_impute.csv',
+        if strategies == ['mean']:
+            master = impute_columns_with_mean(master, all_BAs)
+        else:
+            master = impute_columns(master, all_BAs, strategies)
+        master.to_csv('/Users/truggles/tmp_data4/csv_MASTER_XXX_v12_2day_{}_impute.csv'.format('_'.join(strategies)),
                 index=False, na_rep=0)
 
 
@@ -0,0 +1,110 @@
+import datetime
+import numpy as np
+
+import region_store
+import forecast_errors
+import combine_regional_files as crf
+import get_regional_demands as grd
+
+
+def write_region(data_dir, region, full_date_range, offset, demand_status=None):
+    hours = np.asarray(full_date_range, dtype='datetime64[h]').astype(np.int64)
+    values = np.arange(len(hours), dtype=np.float64) + offset
+    status = np.zeros(len(hours), dtype=np.uint8)
+    region_store.write_csv(str(data_dir/(region+'.csv')), hours, {'demand (MW)' : values, 'forecast demand (MW)' : values + 1.},
+            {'demand (MW)' : status if demand_status is None else demand_status, 'forecast demand (MW)' : status})
+
+
+def test_group_of_another_group_reads_its_original_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(crf, 'DATA_DIR', str(tmp_path)+'/')
+    full = grd.generate_full_time_series(datetime.date(2015, 7, 1), datetime.date(2015, 7, 10))
+    write_region(tmp_path, 'ERCO', full, 0.)
+    write_region(tmp_path, 'TEX', full, 1000.)
+    with open(tmp_path/'TEX.csv', 'r') as f:
+        original = f.read()
+
+    # TEX is rewritten from ERCO while TEXAS_from_REGIONS is summed from TEX
+    crf.combine_many({'TEX' : ['ERCO'], 'TEXAS_from_REGIONS' : ['TEX']}, max_workers=1)
+
+    with open(tmp_path/'TEXAS_from_REGIONS.csv', 'r') as f:
+        assert f.read() == original
+    hours, columns, status = region_store.read_csv(str(tmp_path/'TEX.csv'))
+    assert columns['demand (MW)'][0] == 0.
+    assert not [name for name in tmp_path.iterdir() if '.tmp' in name.name]
+
+
+def test_combine_after_merge_with_hours_missing_from_MICE(tmp_path, monkeypatch):
+    monkeypatch.setattr(crf, 'MICE_INPUT_DIR', str(tmp_path)+'/')
+    monkeypatch.setattr(crf, 'DATA_DIR', str(tmp_path/'out')+'/')
+    (tmp_path/'out').mkdir()
+    full = grd.generate_full_time_series(datetime.date(2015, 7, 1), datetime.date(2015, 7, 10))
+    write_region(tmp_path, 'CISO', full, 0.)
+    write_region(tmp_path, 'BANC', full, 1000.)
+
+    # The master file does not have the hour of row 50
+    times = region_store.format_eia_times(np.asarray(full, dtype='datetime64[h]').astype(np.int64))
+    with open(tmp_path/'master.csv', 'w') as f:
+        f.write('time,CISO,BANC\n')
+        f.writelines('{},{},{}\n'.format(t, 10*i, 20*i) for i, t in enumerate(times) if i != 50)
+    unmatched = crf.add_MICE_imputations_to_many_files(str(tmp_path/'master.csv'), ['CISO', 'BANC'], max_workers=1)
+    assert unmatched == {'CISO' : 1, 'BANC' : 1}
+
+    crf.combine_regions(['CISO', 'BANC'], 'CAL', grab_MICE=True)
+    with open(tmp_path/'out'/'CAL.csv', 'r') as f:
+        rows = [line.strip().split(',') for line in f][1:]
+    assert [row[7] for row in rows[49:52]] == [str(30*49), '0', str(30*51)]
+
+
+def test_update_combined_hierarchy_rewrites_region_of_only_that_BA(tmp_path, monkeypatch):
+    monkeypatch.setattr(crf, 'DATA_DIR', str(tmp_path)+'/')
+    full = grd.generate_full_time_series(datetime.date(2015, 7, 1), datetime.date(2015, 7, 10))
+    write_region(tmp_path, 'ERCO', full, 100.)
+    write_region(tmp_path, 'CISO', full, 200.)
+    tree = {'TEX' : ['ERCO'], 'CAL' : ['CISO'], 'CONUS' : ['TEX', 'CAL']}
+    loaded, totals = crf.combine_hierarchy(tree)
+
+    write_region(tmp_path, 'ERCO', full, 555.)
+    assert set(crf.update_combined_hierarchy(tree, loaded, totals, 'ERCO')) >= {'TEX', 'CONUS'}
+
+    tex = region_store.read_csv(str(tmp_path/'TEX.csv'))[1]['demand (MW)']
+    conus = region_store.read_csv(str(tmp_path/'CONUS.csv'))[1]['demand (MW)']
+    assert tex[0] == 555.
+    assert conus[0] == 755.
+
+
+def test_store_of_combined_region_keeps_MISSING_and_EMPTY(tmp_path, monkeypatch):
+    monkeypatch.setattr(crf, 'DATA_DIR', str(tmp_path)+'/')
+    monkeypatch.setattr(crf, 'STORE', True)
+    monkeypatch.setattr(region_store, 'STORE_DIR', str(tmp_path/'store'))
+    full = grd.generate_full_time_series(datetime.date(2015, 7, 1), datetime.date(2015, 7, 10))
+    ciso = np.zeros(len(full), dtype=np.uint8)
+    banc = np.zeros(len(full), dtype=np.uint8)
+    ciso[10] = region_store.MISSING
+    banc[[10, 11]] = region_store.EMPTY
+    write_region(tmp_path, 'CISO', full, 0., ciso)
+    write_region(tmp_path, 'BANC', full, 1000., banc)
+
+    crf.combine_regions(['CISO', 'BANC'], 'CAL')
+    hours, columns, status = region_store.read_csv(str(tmp_path/'CAL.csv'))
+    stored = region_store.Series.from_store('CAL')
+    assert np.array_equal(stored.hours, hours)
+    # The csv file has the sum of the reported values, with a status of OK
+    assert columns['demand (MW)'][10:13].tolist() == [0., 11., 1024.]
+    assert stored.columns['demand (MW)'][10:13].tolist() == [0., 11., 1024.]
+    assert stored.status['demand (MW)'][10:13].tolist() == [region_store.MISSING, region_store.EMPTY, region_store.OK]
+    assert (stored.status['forecast demand (MW)'] == region_store.OK).all()
+
+
+def test_copy_of_combined_region_has_its_forecast_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr(crf, 'DATA_DIR', str(tmp_path)+'/')
+    full = grd.generate_full_time_series(datetime.date(2015, 7, 1), datetime.date(2015, 7, 10))
+    write_region(tmp_path, 'CISO', full, 0.)
+    write_region(tmp_path, 'BANC', full, 1000.)
+    crf.combine_regions(['CISO', 'BANC'], 'CONUS')
+    crf.save_copy('CONUS', 'CONUS_from_BAs')
+
+    with open(tmp_path/'CONUS_from_BAs.csv', 'r') as f, open(tmp_path/'CONUS.csv', 'r') as g:
+        assert f.read() == g.read()
+    summary = forecast_errors.read_summary(str(tmp_path))
+    errors = summary[summary['group'] == 'all'].set_index('region')
+    assert errors.loc['CONUS_from_BAs', 'hours'] == errors.loc['CONUS', 'hours'] > 0
@@ -0,0 +1,49 @@
+import numpy as np
+
+import forecast_errors
+
+
+def summary(region, data_dir):
+    with open(data_dir/forecast_errors.ERRORS_DIR/(region+'.csv'), 'r') as f:
+        return f.read()
+
+
+def test_incremental_record_matches_whole_region(tmp_path, monkeypatch):
+    # Only the hours from 400 on are kept, the earlier ones as their sums
+    monkeypatch.setattr(forecast_errors, 'KEEP_HOURS', 100)
+    hours = np.arange(400000, 400500)
+    demand = 1000. + np.arange(500) % 24 * 10.
+    forecast = demand + np.arange(500) % 7 - 3.
+    demand[[5, 450]] = np.nan
+    # The last hours of a region are often missing
+    demand[-3:] = np.nan
+    revised = forecast.copy()
+    revised[440:] += 50.
+
+    assert not forecast_errors.record('A', hours[440:], demand[440:], revised[440:], str(tmp_path), hours[440])
+    forecast_errors.record('A', hours[:480], demand[:480], forecast[:480], str(tmp_path))
+    assert forecast_errors.record('A', hours[440:], demand[440:], revised[440:], str(tmp_path), hours[440])
+    forecast_errors.record('B', hours, demand, revised, str(tmp_path))
+
+    assert summary('A', tmp_path).replace('A,', 'B,') == summary('B', tmp_path)
+
+
+def test_incremental_record_needs_hours_up_to_start(tmp_path):
+    hours = np.arange(400000, 400100)
+    values = np.full(100, 1000.)
+    forecast_errors.record('A', hours[:50], values[:50], values[:50], str(tmp_path))
+    assert not forecast_errors.record('A', hours[60:], values[60:], values[60:], str(tmp_path), hours[60])
+
+
+def test_incremental_record_needs_start_in_kept_hours(tmp_path, monkeypatch):
+    monkeypatch.setattr(forecast_errors, 'KEEP_HOURS', 20)
+    hours = np.arange(400000, 400100)
+    values = np.full(100, 1000.)
+    forecast_errors.record('A', hours, values, values + 10., str(tmp_path))
+    assert len(forecast_errors.load_hours('A', str(tmp_path))['hours']) == 20
+    assert not forecast_errors.record('A', hours[60:], values[60:], values[60:], str(tmp_path), hours[60])
+    assert forecast_errors.record('A', hours[90:], values[90:], values[90:], str(tmp_path), hours[90])
+
+    assert forecast_errors.copy_errors('A', 'B', str(tmp_path))
+    assert summary('A', tmp_path).replace('A,', 'B,') == summary('B', tmp_path)
+    assert 'A,all,all,100,9.0,0.9,9.0' in summary('A', tmp_path)
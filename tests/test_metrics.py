@@ -0,0 +1,23 @@
+import concurrent.futures
+
+import metrics
+
+
+def count_rows(region, rows):
+    metrics.count('rows_written', rows, region=region)
+    with metrics.timer('write_region', region=region):
+        pass
+    return region
+
+
+def test_metrics_of_worker_processes_are_merged():
+    metrics.reset()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+        for result, worker_metrics in executor.map(metrics.collect, [count_rows]*3, ['A', 'B', 'A'], [10, 20, 30]):
+            metrics.merge(worker_metrics)
+
+    counters = {c['labels']['region'] : c['value'] for c in metrics.snapshot()['counters']}
+    timers = {t['labels']['region'] : t['calls'] for t in metrics.snapshot()['timers']}
+    assert counters == {'A' : 40, 'B' : 20}
+    assert timers == {'A' : 2, 'B' : 1}
+    metrics.reset()
@@ -0,0 +1,77 @@
+import datetime
+import multiprocessing
+import concurrent.futures
+import numpy as np
+
+import region_store
+import get_regional_demands as grd
+
+
+def arrays(full_date_range, offset=0.):
+    hours = np.asarray(full_date_range, dtype='datetime64[h]').astype(np.int64)
+    return hours, np.arange(len(hours), dtype=np.float64) + offset
+
+
+def save(full_date_range, append, store, offset=0.):
+    grd.save_to_MEM_format('EBA.TEST-ALL.D.H', arrays(full_date_range, offset), arrays(full_date_range, offset+1),
+            full_date_range, append, store)
+
+
+def test_incremental_update_creates_store_of_whole_csv(tmp_path, monkeypatch):
+    monkeypatch.setattr(region_store, 'STORE_DIR', str(tmp_path/'store'))
+    monkeypatch.setattr(grd, 'DATA_DIR', str(tmp_path)+'/')
+    full = grd.generate_full_time_series(datetime.date(2015, 7, 1), datetime.date(2015, 7, 10))
+    save(full, False, False)
+    save(full[-72:], True, True, 1000.)
+
+    hours, columns, status = region_store.read_csv(str(tmp_path/'TEST.csv'))
+    stored = region_store.Series.from_store('TEST')
+    assert (tmp_path/'store'/'TEST'/'hours.npy').exists()
+    assert len(hours) > 72
+    assert np.array_equal(stored.hours, hours)
+    for name in columns:
+        assert np.array_equal(stored.columns[name], columns[name], equal_nan=True)
+        assert np.array_equal(stored.status[name], status[name])
+
+
+def test_append_store_keeps_earlier_hours(tmp_path):
+    hours = np.arange(100, 110)
+    columns = {'demand (MW)' : np.arange(10.)}
+    status = {'demand (MW)' : np.zeros(10, dtype=np.uint8)}
+    region_store.write_store('A', hours, columns, status, str(tmp_path))
+    region_store.append_store('A', hours[8:] + 1, {'demand (MW)' : np.array([80., 90.])},
+            {'demand (MW)' : np.zeros(2, dtype=np.uint8)}, str(tmp_path))
+    region_store.append_store('A', hours[:0], {'demand (MW)' : np.zeros(0)},
+            {'demand (MW)' : np.zeros(0, dtype=np.uint8)}, str(tmp_path))
+
+    stored = region_store.Series.from_store('A', str(tmp_path))
+    assert stored.hours.tolist() == list(range(100, 111))
+    assert stored.columns['demand (MW)'].tolist() == list(range(9)) + [80., 90.]
+
+
+def test_load_reads_csv_when_store_is_missing_hours(tmp_path):
+    hours = np.arange(400000, 400100)
+    columns = {'demand (MW)' : np.arange(100.)}
+    status = {'demand (MW)' : np.zeros(100, dtype=np.uint8)}
+    region_store.write_csv(str(tmp_path/'A.csv'), hours, columns, status)
+    # A newer store with only the last hours of the csv file
+    region_store.write_store('A', hours[-10:], {'demand (MW)' : columns['demand (MW)'][-10:]},
+            {'demand (MW)' : status['demand (MW)'][-10:]}, str(tmp_path/'store'))
+
+    assert not region_store.store_is_current('A', str(tmp_path/'A.csv'), str(tmp_path/'store'))
+    loaded = region_store.load('A', data_dir=str(tmp_path), base=str(tmp_path/'store'))['A']
+    assert loaded.hours.tolist() == hours.tolist()
+
+    region_store.write_store('A', hours, columns, status, str(tmp_path/'store'))
+    assert region_store.store_is_current('A', str(tmp_path/'A.csv'), str(tmp_path/'store'))
+
+
+def test_fetch_worker_writes_store_to_STORE_DIR_of_parent(tmp_path):
+    full = grd.generate_full_time_series(datetime.date(2015, 7, 1), datetime.date(2015, 7, 3))
+    # A spawned process only gets the settings passed to init_worker
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+            initializer=grd.init_worker, initargs=(str(tmp_path)+'/', str(tmp_path/'store'))) as executor:
+        executor.submit(grd.save_to_MEM_format, 'EBA.TEST-ALL.D.H', arrays(full), arrays(full, 1.), full, False, True).result()
+
+    assert (tmp_path/'TEST.csv').exists()
+    assert np.array_equal(region_store.Series.from_store('TEST', str(tmp_path/'store')).hours, arrays(full)[0][5:])